@@ -2,19 +2,24 @@
 
 Unsupervised methods used in the first part (Cosine Similarity etc).
 
+The TF-IDF vectorizer is fitted once on all titles and bodies of the corpus
+and pickled to VECTORIZER_PATH; later runs reuse it as long as the corpus file
+has not changed.
+
 Usage: python2 2a.py
 """
 
+import os
 import gzip
+import pickle
 import numpy as np
 
-import torch
-import torch.nn.functional as F
-
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from meter import AUCMeter
 
+CORPUS_PATH = "../Android/corpus.tsv.gz"
+VECTORIZER_PATH = "tfidf_vectorizer.pkl"
+
 def read_corpus(path):
     """Creates a dictionary mapping ID to a tuple
     tuple: dictionary for question title string, dictionary for body string"""
@@ -42,11 +47,27 @@ def load_data(filename, positive=True):
 		y = [1 if positive else 0]*len(X)
 	return X, y
 
-# corpus.tsv format:
-# id \t title \t body \n
-raw_corpus, all_sequences = read_corpus("../Android/corpus.tsv.gz")
+def load_vectorizer(path, corpus_path, all_sequences):
+	"""Returns the TF-IDF vectorizer pickled at path if it was fitted on the
+	current corpus_path, otherwise fits it on all_sequences and pickles it.
+	"""
+	corpus_version = (corpus_path, os.path.getmtime(corpus_path))
+	if os.path.exists(path):
+		with open(path, "rb") as f:
+			version, vectorizer = pickle.load(f)
+		if version == corpus_version:
+			print "loaded tfidf from " + path
+			return vectorizer
+	vectorizer = TfidfVectorizer()
+	print "tfidf fit"
+	vectorizer.fit(all_sequences)
+	# 36404 unique words
+	# print len(vectorizer.vocabulary_)
+	with open(path, "wb") as f:
+		pickle.dump((corpus_version, vectorizer), f, pickle.HIGHEST_PROTOCOL)
+	return vectorizer
 
-def calculate_meter(data):
+def calculate_meter(data, raw_corpus, vectorizer):
 	"""Calculate the AUC score.
 	"""
 	positives = {}
@@ -75,35 +96,38 @@ def calculate_meter(data):
 		else:
 			negatives[q1] = [q2]
 
-	vectorizer = TfidfVectorizer()
-	print "tfidf fit"
-	vectorizer.fit(all_sequences)
-	# 36404 unique words
-	# print len(vectorizer.vocabulary_)
-
 	meter = AUCMeter()
 
-	qlabels = []
-	all_questions = []
+	# one (query, candidate, label) entry per labelled pair
+	query_ids = []
+	candidate_ids = []
+	labels = []
 	question_ids = set()
 	question_ids.update(positives.keys())
 	question_ids.update(negatives.keys())
 	for qid in question_ids:
-		questions = [raw_corpus[qid][0] + " " + raw_corpus[qid][1]]
-		questions.extend([raw_corpus[nid][0] + " " + raw_corpus[nid][1] for nid in negatives[qid]])
-		questions.extend([raw_corpus[pid][0] + " " + raw_corpus[pid][1] for pid in positives[qid]])
-		all_questions.append(questions)
-		qlabels.append([0]*len(negatives[qid]) + [1]*len(positives[qid]))
-
-	for question, qlabel in zip(all_questions, qlabels):
-		query = torch.DoubleTensor(vectorizer.transform([question[0]]).todense())
-		examples = torch.DoubleTensor(vectorizer.transform(question[1:]).todense())
-
-		cos_similarity = F.cosine_similarity(query, examples, dim=1)
-		target = torch.DoubleTensor(qlabel)
-		meter.add(cos_similarity, target)
+		candidates = negatives[qid] + positives[qid]
+		query_ids.extend([qid]*len(candidates))
+		candidate_ids.extend(candidates)
+		labels.extend([0]*len(negatives[qid]) + [1]*len(positives[qid]))
+
+	# every question is transformed once; rows are L2-normalized, so the
+	# cosine of a pair is the dot product of its two sparse rows
+	ids = list(set(query_ids) | set(candidate_ids))
+	rows = dict((id, row) for row, id in enumerate(ids))
+	vectors = vectorizer.transform([raw_corpus[id][0] + " " + raw_corpus[id][1] for id in ids])
+	queries = vectors[[rows[id] for id in query_ids]]
+	examples = vectors[[rows[id] for id in candidate_ids]]
+	cos_similarity = np.asarray(queries.multiply(examples).sum(axis=1)).ravel()
+
+	meter.add(cos_similarity, np.array(labels))
 
 	print meter.value(0.05)
 
-calculate_meter("dev")
-calculate_meter("test")
+if __name__ == "__main__":
+	# corpus.tsv format:
+	# id \t title \t body \n
+	raw_corpus, all_sequences = read_corpus(CORPUS_PATH)
+	vectorizer = load_vectorizer(VECTORIZER_PATH, CORPUS_PATH, all_sequences)
+	calculate_meter("dev", raw_corpus, vectorizer)
+	calculate_meter("test", raw_corpus, vectorizer)
@@ -5,7 +5,7 @@ Direct transfer using models trained on the AskUbuntu dataset and then
 evaluated on the Android dataset, without doing any domain adaptation. Uses embeddings and a trained LSTM or CNN model.
 
 Usage: 
-python2 2b.py --corpus <gzipped corpus path> --test <test questions path> --embeddings <gzipped embeddings path> --load_model <model path> [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] [--cuda <0 | 1>]
+python2 2b.py --corpus <gzipped corpus path> --test <test questions path> --embeddings <gzipped embeddings path> --load_model <model path> [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] [--cuda <0 | 1>] [--profile_file <json lines path>] [--profile-steps <a:b> [--profile_dir <profiles>]]
 
 Example Usage:
 (Tao Lei's embeddings trained on Stack Exchange and Wikipedia)
@@ -23,6 +23,7 @@ import numpy as np
 import csv
 
 import corpus
+import profiling
 from evaluation import *
 from meter import AUCMeter
 
@@ -41,7 +42,9 @@ def main(args):
     print("loaded embeddings")
     ids_corpus = corpus.map_corpus(vocab_map, raw_corpus)
 
-    evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, model)
+    with profiling.span("evaluation"):
+        evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, model)
+    profiling.dump(args.profile_file)
 
 def load_model(args):   
     """Load either an LSTM or CNN.
@@ -75,7 +78,10 @@ def evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, model):
     count = 0
     similarities = []
 
+    step_profiler = profiling.StepProfiler(args.profile_steps, args.profile_dir, "2b_" + args.model, args.cuda)
     for batch in val_batches:
+        step_profiler.begin_step()
+        profiling.begin("forward")
         titles, bodies, qlabels = batch
         title_length, title_num_questions = titles.shape
         body_length, body_num_questions = bodies.shape
@@ -149,6 +155,8 @@ def evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, model):
         # 560 x 100
         hidden = (average_title_out + average_body_out) * 0.5
 
+        profiling.end("forward")
+
         query = torch.DoubleTensor(hidden[0].unsqueeze(0).cpu().data.numpy())
         examples = torch.DoubleTensor(hidden[1:].cpu().data.numpy())
 
@@ -156,9 +164,12 @@ def evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, model):
         qlabels = [float(qlabel) for qlabel in list(qlabels)]
         target = torch.DoubleTensor(qlabels)
         meter.add(cos_similarity, target)
+        step_profiler.end_step()
+    step_profiler.close()
 
     print meter.value(0.05)
 
+@profiling.timed("average_questions")
 def average_questions(hidden, ids, padding_id, eps=1e-10):
     """Average the outputs from the hidden states of questions, excluding padding.
     """
@@ -205,7 +216,20 @@ if __name__ == "__main__":
             type = int,
             default = 0
         )
+    argparser.add_argument("--profile_file",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_steps", "--profile-steps",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_dir",
+            type = str,
+            default = "profiles"
+        )
 
     args = argparser.parse_args()
+    profiling.enable(bool(args.profile_file))
     main(args)
     
\ No newline at end of file
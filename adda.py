@@ -2,6 +2,7 @@ import sys
 import os
 import argparse
 import corpus
+import profiling
 
 import numpy as np
 import csv
@@ -35,7 +36,14 @@ class FeedForward(nn.Module):
 def main(args):
     """This file performs domain transfer using an adversarial discriminative domain adaptation network. Example usage:
 
-    python adda.py --ubuntu_path ../askubuntu --android_path ../Android --embeddings ../glove.pruned.txt.gz --load_model cnn_models/cnn_model8/epoch9"""
+    python adda.py --ubuntu_path ../askubuntu --android_path ../Android --embeddings ../glove.pruned.txt.gz --load_model cnn_models/cnn_model8/epoch9
+
+    The source encoder is never updated. With --source_cache memory (or a .npy
+    path, memory-mapped and reused across runs) the whole Ubuntu corpus is
+    encoded with it once, and every step samples source vectors from that
+    cache instead of encoding a new Ubuntu batch:
+
+    python adda.py --ubuntu_path ../askubuntu --android_path ../Android --embeddings ../glove.pruned.txt.gz --load_model cnn_models/cnn_model8/epoch9 --source_cache ubuntu_cnn8.npy"""
 
     ubuntu_corpus = os.path.join(args.ubuntu_path, 'text_tokenized.txt.gz')
     android_corpus = os.path.join(args.android_path, 'corpus.tsv.gz')
@@ -81,6 +89,13 @@ def main(args):
             if args.cuda:
                 cnn.cuda()
 
+    source_cache = None
+    if args.source_cache:
+        if args.model == 'lstm':
+            source_cache = encode_source_corpus(args, lstm, ubuntu_ids_corpus, embeddings, padding_id)
+        else:
+            source_cache = encode_source_corpus(args, cnn, ubuntu_ids_corpus, embeddings, padding_id)
+
     target_cnn = nn.Conv1d(in_channels=300, out_channels=args.hidden_size, kernel_size = 3, padding = 1)
     target_optimizer = Adam(target_cnn.parameters())
     if args.cuda:
@@ -95,6 +110,7 @@ def main(args):
     android_dev_neg_path = os.path.join(args.android_path, 'dev.neg.txt')
     android_dev_annotations = android_pairs_to_annotations(android_dev_pos_path, android_dev_neg_path)
     
+    step_profiler = profiling.StepProfiler(args.profile_steps, args.profile_dir, "adda_" + args.model, args.cuda)
     count = 1
     hidden_states = []
     total_loss = 0.0
@@ -103,6 +119,7 @@ def main(args):
     for epoch in range(20):
         print "epoch = " + str(epoch)
         for batch in ubuntu_training_batches:
+            step_profiler.begin_step()
 
             titles, bodies, triples = batch
 
@@ -114,10 +131,11 @@ def main(args):
                 time_begin = datetime.now()
             count += 1
 
-            ubuntu_batch = corpus.domain_classifier_batch(ubuntu_ids_corpus, ubuntu_train_annotations, padding_id)
-            ubuntu_titles, ubuntu_bodies, _ = ubuntu_batch
             android_batch = corpus.domain_classifier_batch(android_ids_corpus, android_dev_annotations, padding_id)
             android_titles, android_bodies, _ = android_batch
+            if source_cache is None:
+                ubuntu_batch = corpus.domain_classifier_batch(ubuntu_ids_corpus, ubuntu_train_annotations, padding_id)
+                ubuntu_titles, ubuntu_bodies, _ = ubuntu_batch
 
             # print "shapes"
             # print ubuntu_titles.shape
@@ -128,7 +146,16 @@ def main(args):
             else:
                 model = cnn
 
-            hidden_ubuntu_domain = vectorize_question(args, ubuntu_batch, model, vocab_map, embeddings, padding_id)
+            profiling.begin("forward")
+            if source_cache is None:
+                hidden_ubuntu_domain = vectorize_question(args, ubuntu_batch, model, vocab_map, embeddings, padding_id)
+            else:
+                # as many source questions as target questions, sampled from the cache
+                rows = np.sort(np.random.randint(0, len(source_cache), android_titles.shape[1]))
+                hidden_ubuntu_domain = torch.from_numpy(np.asarray(source_cache[rows]))
+                if args.cuda:
+                    hidden_ubuntu_domain = hidden_ubuntu_domain.cuda()
+                hidden_ubuntu_domain = autograd.Variable(hidden_ubuntu_domain)
             hidden_android_domain = vectorize_question(args, android_batch, target_cnn, vocab_map, embeddings, padding_id)
             hidden_combined = torch.cat((hidden_ubuntu_domain, hidden_android_domain))
             input_size = int(hidden_combined.size()[0])
@@ -148,14 +175,62 @@ def main(args):
                 domain_classifier_loss = F.cross_entropy(output, domain_labels)
 
             total_loss += domain_classifier_loss.cpu().data.numpy()[0]
-            domain_classifier_loss.backward()
+            profiling.end("forward")
+            with profiling.span("backward"):
+                domain_classifier_loss.backward()
 
-            target_optimizer.step()
-            feed_forward_optimizer.step()
+            with profiling.span("optimizer_step"):
+                target_optimizer.step()
+                feed_forward_optimizer.step()
+            step_profiler.end_step()
 
         print "time for one epoch: " + str(datetime.now() - time_begin_epoch)
         time_begin_epoch = datetime.now()
-    	evaluation(args, padding_id, android_ids_corpus, target_cnn, vocab_map, embeddings)
+        with profiling.span("evaluation"):
+            evaluation(args, padding_id, android_ids_corpus, target_cnn, vocab_map, embeddings)
+        profiling.dump(args.profile_file, epoch=epoch)
+    step_profiler.close()
+
+def encode_source_corpus(args, model, ids_corpus, embeddings, padding_id):
+    """Vectors of every question of ids_corpus under the frozen source encoder,
+    as a (questions x hidden size) float32 array, kept in memory with
+    --source_cache memory or memory-mapped from the .npy file it names.
+
+    A cache file is reused when its sidecar <path>.json records the same
+    --load_model (path and modification time), --model, --embeddings, source
+    corpus, number of questions and hidden size, and rebuilt otherwise.
+    """
+    import json
+    import encoder
+    from cache import model_version
+    ids = sorted(ids_corpus)
+    info = {"load_model": args.load_model, "model_version": model_version(args.load_model), "model": args.model,
+            "embeddings": args.embeddings, "ubuntu_path": args.ubuntu_path, "num_questions": len(ids),
+            "hidden_size": args.hidden_size}
+    if args.source_cache != "memory" and os.path.exists(args.source_cache + ".json"):
+        with open(args.source_cache + ".json") as fin:
+            if json.load(fin) == info:
+                print("reusing source encodings from " + args.source_cache)
+                return np.load(args.source_cache, mmap_mode="r")
+        # an interrupted rebuild must not be reused under the old sidecar
+        os.remove(args.source_cache + ".json")
+
+    time_begin = datetime.now()
+    if args.source_cache == "memory":
+        vectors = np.zeros((len(ids), args.hidden_size), dtype=np.float32)
+    else:
+        vectors = np.lib.format.open_memmap(args.source_cache, mode="w+", dtype=np.float32,
+                                            shape=(len(ids), args.hidden_size))
+    for start in range(0, len(ids), args.encode_chunk_size):
+        chunk = ids[start:start + args.encode_chunk_size]
+        vectors[start:start + len(chunk)] = encoder.encode_questions(args, model, [ids_corpus[id] for id in chunk],
+                                                                     embeddings, padding_id)
+    print("encoded " + str(len(ids)) + " source questions in " + str(datetime.now() - time_begin))
+    if args.source_cache != "memory":
+        vectors.flush()
+        with open(args.source_cache + ".json", "w") as fout:
+            json.dump(info, fout)
+    return vectors
 
 def evaluation(args, padding_id, android_ids_corpus, model, vocab_map, embeddings):
     print "starting evaluation"
@@ -301,6 +376,7 @@ def vectorize_question(args, batch, model, vocab_map, embeddings, padding_id):
 
     return hidden
 
+@profiling.timed("average_questions")
 def average_questions(hidden, ids, padding_id, eps=1e-10):
     """Average the outputs from the hidden states of questions, excluding padding.
     """
@@ -349,6 +425,14 @@ if __name__ == "__main__":
             type = str,
             default = ""
         )
+    argparser.add_argument("--source_cache",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--encode_chunk_size",
+            type = int,
+            default = 10000
+        )
     argparser.add_argument("--save_model", 
             type = int,
             default = 1
@@ -364,7 +448,20 @@ if __name__ == "__main__":
             type = str,
             default = 1e-6
         )
+    argparser.add_argument("--profile_file",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_steps", "--profile-steps",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_dir",
+            type = str,
+            default = "profiles"
+        )
 
     args = argparser.parse_args()
+    profiling.enable(bool(args.profile_file))
     main(args)
     
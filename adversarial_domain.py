@@ -2,6 +2,7 @@ import sys
 import os
 import argparse
 import corpus
+import profiling
 
 import numpy as np
 import csv
@@ -15,6 +16,21 @@ import torch.nn.functional as F
 from torch.optim import Adam
 import torch.autograd as autograd
 
+class GradientReversal(autograd.Function):
+    """Identity on the forward pass; multiplies the gradient by -lam on the
+    backward pass, so that minimizing a loss computed after it trains the
+    layers before it to maximize that loss.
+    """
+
+    @staticmethod
+    def forward(ctx, inputs, lam):
+        ctx.lam = lam
+        return inputs.view_as(inputs)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output.neg() * ctx.lam, None
+
 class FeedForward(nn.Module):
     def __init__(self, args):
         super(FeedForward, self).__init__()
@@ -84,12 +100,13 @@ def main(args):
     feed_forward = FeedForward(args)
     if args.cuda:
         feed_forward.cuda()
-    feed_forward_optimizer = Adam(feed_forward.parameters(), lr=-0.001)
+    feed_forward_optimizer = Adam(feed_forward.parameters())
 
     android_dev_pos_path = os.path.join(args.android_path, 'dev.pos.txt')
     android_dev_neg_path = os.path.join(args.android_path, 'dev.neg.txt')
     android_dev_annotations = android_pairs_to_annotations(android_dev_pos_path, android_dev_neg_path)
     
+    step_profiler = profiling.StepProfiler(args.profile_steps, args.profile_dir, "adversarial_" + args.model, args.cuda)
     count = 1
     hidden_states = []
     total_encoder_loss = 0.0
@@ -100,10 +117,12 @@ def main(args):
     for epoch in range(20):
         print "epoch = " + str(epoch)
         for batch in ubuntu_training_batches:
+            step_profiler.begin_step()
 
             titles, bodies, triples = batch
 
             optimizer.zero_grad()
+            feed_forward_optimizer.zero_grad()
             if count%10 == 0:
                 print(count)
                 print "average encoder loss: " + str((total_encoder_loss/float(count)))
@@ -127,16 +146,19 @@ def main(args):
             else:
                 model = cnn
 
-            hidden_ubuntu = vectorize_question(args, batch, model, vocab_map, embeddings, padding_id)
-            hidden_ubuntu_domain = vectorize_question(args, ubuntu_batch, model, vocab_map, embeddings, padding_id)
-            hidden_android_domain = vectorize_question(args, android_batch, model, vocab_map, embeddings, padding_id)
-            hidden_combined = torch.cat((hidden_ubuntu_domain, hidden_android_domain))
-            input_size = int(hidden_combined.size()[0])
-
-            output = feed_forward.forward(hidden_combined)
+            profiling.begin("forward")
+            # one encoder pass over the label batch and both domain batches
+            combined_batch = concatenate_batches([batch, ubuntu_batch, android_batch], padding_id)
+            hidden = vectorize_question(args, combined_batch, model, vocab_map, embeddings, padding_id)
+            num_label, num_ubuntu, num_android = combined_batch[2]
+            hidden_ubuntu = hidden[:num_label]
+            hidden_domain = hidden[num_label:]
 
+            # the discriminator minimizes the domain loss; the reversed gradient
+            # makes the encoder maximize it, scaled by lam
+            output = feed_forward(GradientReversal.apply(hidden_domain, args.lam))
 
-            domain_labels = [1]*int(hidden_ubuntu_domain.size()[0]) + [0]*int(hidden_android_domain.size()[0])
+            domain_labels = [1]*num_ubuntu + [0]*num_android
             if args.cuda:
                 domain_labels = autograd.Variable(torch.LongTensor(domain_labels).cuda())
             else:
@@ -155,33 +177,29 @@ def main(args):
                 targets = autograd.Variable(torch.zeros(triples.shape[0]).type(torch.LongTensor).cuda())
             else:
                 targets = autograd.Variable(torch.zeros(triples.shape[0]).type(torch.LongTensor))
-            if args.cuda:
-                encoder_loss = F.multi_margin_loss(cos_similarity, targets, margin = args.margin).cuda()
-            else:
-                encoder_loss = F.multi_margin_loss(cos_similarity, targets, margin=args.margin)
+            encoder_loss = F.multi_margin_loss(cos_similarity, targets, margin=args.margin)
             total_encoder_loss += encoder_loss.cpu().data.numpy()[0]
 
-            # if args.cuda:
-            #     domain_loss_func = nn.CrossEntropyLoss().cuda()
-            # else:
-            #     domain_loss_func = nn.CrossEntropyLoss()
-            # domain_classifier_loss = domain_loss_func(output, domain_labels)
-            if args.cuda:
-                domain_classifier_loss = F.cross_entropy(output, domain_labels).cuda()
-            else:
-                domain_classifier_loss = F.cross_entropy(output, domain_labels)
+            domain_classifier_loss = F.cross_entropy(output, domain_labels)
             total_domain_loss += domain_classifier_loss.cpu().data.numpy()[0]
 
-            combined_loss = encoder_loss - args.lam * domain_classifier_loss
-            total_loss += combined_loss.cpu().data.numpy()[0]
-            combined_loss.backward()
+            combined_loss = encoder_loss + domain_classifier_loss
+            total_loss += (encoder_loss - args.lam * domain_classifier_loss).cpu().data.numpy()[0]
+            profiling.end("forward")
+            with profiling.span("backward"):
+                combined_loss.backward()
 
-            optimizer.step()
-            feed_forward_optimizer.step()
+            with profiling.span("optimizer_step"):
+                optimizer.step()
+                feed_forward_optimizer.step()
+            step_profiler.end_step()
 
         print "time for one epoch: " + str(datetime.now() - time_begin_epoch)
         time_begin_epoch = datetime.now()
-    	evaluation(args, padding_id, android_ids_corpus, model, vocab_map, embeddings)
+        with profiling.span("evaluation"):
+            evaluation(args, padding_id, android_ids_corpus, model, vocab_map, embeddings)
+        profiling.dump(args.profile_file, epoch=epoch)
+    step_profiler.close()
 
 def evaluation(args, padding_id, android_ids_corpus, model, vocab_map, embeddings):
     print "starting evaluation"
@@ -242,6 +260,19 @@ def android_pairs_to_annotations(pos_path, neg_path):
     android_annotations = corpus.android_annotations(android_positives, android_negatives)
     return android_annotations
 
+def concatenate_batches(batches, padding_id):
+    """Stack the padded titles and bodies of several batches into one batch,
+    padding to the longest title and body. The third element is the number
+    of questions of each batch, in order.
+    """
+    title_length = max(titles.shape[0] for titles, _, _ in batches)
+    body_length = max(bodies.shape[0] for _, bodies, _ in batches)
+    titles = np.hstack([np.pad(titles, ((0, title_length - titles.shape[0]), (0, 0)), 'constant', constant_values=padding_id)
+                        for titles, _, _ in batches])
+    bodies = np.hstack([np.pad(bodies, ((0, body_length - bodies.shape[0]), (0, 0)), 'constant', constant_values=padding_id)
+                        for _, bodies, _ in batches])
+    return titles, bodies, [batch[0].shape[1] for batch in batches]
+
 def vectorize_question(args, batch, model, vocab_map, embeddings, padding_id):
 
     if args.model == 'lstm':
@@ -327,6 +358,7 @@ def vectorize_question(args, batch, model, vocab_map, embeddings, padding_id):
 
     return hidden
 
+@profiling.timed("average_questions")
 def average_questions(hidden, ids, padding_id, eps=1e-10):
     """Average the outputs from the hidden states of questions, excluding padding.
     """
@@ -383,14 +415,27 @@ if __name__ == "__main__":
             type = str
         )
     argparser.add_argument("--margin",
-            type = str,
+            type = float,
             default = 0.3
         )
     argparser.add_argument("--lam",
-            type = str,
+            type = float,
             default = 1e-6
         )
+    argparser.add_argument("--profile_file",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_steps", "--profile-steps",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_dir",
+            type = str,
+            default = "profiles"
+        )
 
     args = argparser.parse_args()
+    profiling.enable(bool(args.profile_file))
     main(args)
     
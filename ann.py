@@ -0,0 +1,343 @@
+"""
+Approximate nearest-neighbour indexes over the question vectors of a
+VectorStore (see build_index.py), for interactive retrieval where exact search
+(search.py) is too slow.
+
+IVFIndex is pure numpy: the vectors are clustered with spherical k-means and
+a query is only compared with the vectors of its nprobe closest clusters.
+HNSWIndex wraps the optional hnswlib library when it is installed; ef_search
+is its recall/latency knob.
+
+Usage:
+python2 ann.py --index <index directory> --build [--type <ivf | hnsw>] [--nlist <sqrt(N)>] [--M <16>] [--ef_construction <200>]
+python2 ann.py --index <index directory> --benchmark [--type <ivf | hnsw>] [--knobs <1,2,4,8,16,32>] [--num_queries <1000>] [--k <10>]
+
+Example Usage:
+python2 ann.py --index indexes/askubuntu_lstm3 --build --type ivf
+python2 ann.py --index indexes/askubuntu_lstm3 --benchmark --type ivf --knobs 1,4,16,64
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import search
+from vector_store import VectorStore, normalize
+
+def kmeans(vectors, num_clusters, iterations=10, sample_size=100000, block_size=16384, seed=1, spherical=True):
+    """Returns (num_clusters x dim) centroids fitted on a random sample of the
+    rows of vectors. Spherical k-means (cosine, unit-norm centroids) by default,
+    plain euclidean k-means otherwise.
+    """
+    rng = np.random.RandomState(seed)
+    if len(vectors) > sample_size:
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    else:
+        sample = np.asarray(vectors)
+    centroids = sample[rng.choice(len(sample), num_clusters, replace=len(sample) < num_clusters)].copy()
+    for _ in range(iterations):
+        assignment = assign(sample, centroids, block_size, spherical)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        empty = counts == 0
+        # restart empty clusters from random points
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        counts[empty] = 1
+        centroids = normalize(sums) if spherical else sums / counts[:, None].astype(sums.dtype)
+    return centroids
+
+def assign(vectors, centroids, block_size=16384, spherical=True):
+    """Index of the most similar (or, when not spherical, closest) centroid for
+    every row of vectors.
+    """
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    squared_norms = (centroids * centroids).sum(axis=1)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size])
+        if spherical:
+            assignment[start:start + block_size] = np.argmax(np.dot(block, centroids.T), axis=1)
+        else:
+            assignment[start:start + block_size] = np.argmin(squared_norms - 2 * np.dot(block, centroids.T), axis=1)
+    return assignment
+
+def top_k(scores, rows, k):
+    """(row, score) of the k best scores, sorted by (-score, row).
+    """
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, rows = scores[keep], rows[keep]
+    order = np.lexsort((rows, -scores))
+    return rows[order], scores[order]
+
+def assign_rows(store, centroids, start=0, block_size=16384, spherical=True):
+    """Closest centroid of every store row from start on.
+    """
+    assignments = [np.zeros(0, dtype=np.int64)]
+    for offset, block in store.blocks(block_size):
+        if offset + len(block) <= start:
+            continue
+        assignments.append(assign(block[max(0, start - offset):], centroids, block_size, spherical))
+    return np.concatenate(assignments)
+
+class IVFIndex(object):
+    """Inverted-file index. The vectors of each cluster are kept contiguous in
+    memory: rows[offsets[c]:offsets[c + 1]] are the store rows of cluster c.
+    segments are the store segments the index covers (see refresh).
+    """
+    FILE = "ivf.npz"
+
+    def __init__(self, store, centroids, rows, offsets, segments):
+        self.store = store
+        self.centroids = centroids
+        self.rows = rows
+        self.offsets = offsets
+        self.segments = list(segments)
+        self.vectors = None
+        if store.rows_since(self.segments) is not None:
+            self.vectors = store.to_array()[rows]
+
+    @staticmethod
+    def build(store, nlist=0, iterations=10):
+        vectors = store.to_array()[store.live]
+        nlist = nlist or max(1, int(np.sqrt(len(vectors))))
+        centroids = kmeans(vectors, nlist, iterations)
+        index = IVFIndex(store, centroids, np.zeros(0, dtype=np.int64), np.zeros(nlist + 1, dtype=np.int64), [])
+        index.refresh()
+        return index
+
+    def refresh(self):
+        """Bring the index up to date with its store: rows appended since the
+        last refresh are assigned to their closest cluster and rows that are no
+        longer live are dropped. After store.compact() every row is assigned
+        again (the centroids are kept).
+        """
+        start = self.store.rows_since(self.segments)
+        if start is None:
+            start = 0
+            rows = np.zeros(0, dtype=np.int64)
+            assignment = np.zeros(0, dtype=np.int64)
+        else:
+            rows = self.rows
+            assignment = np.repeat(np.arange(len(self.centroids)), np.diff(self.offsets))
+        rows = np.concatenate([rows, np.arange(start, len(self.store))])
+        assignment = np.concatenate([assignment, assign_rows(self.store, self.centroids, start)])
+        keep = self.store.live[rows]
+        rows, assignment = rows[keep], assignment[keep]
+        order = np.argsort(assignment, kind="mergesort")
+        self.rows = rows[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(self.centroids)))])
+        self.segments = self.store.segment_list()
+        self.vectors = self.store.to_array()[self.rows]
+
+    def save(self, path=None):
+        path = path or os.path.join(self.store.path, self.FILE)
+        np.savez(path, centroids=self.centroids, rows=self.rows, offsets=self.offsets,
+                 segments=np.array(self.segments, dtype=str))
+
+    @staticmethod
+    def load(store, path=None):
+        data = np.load(path or os.path.join(store.path, IVFIndex.FILE))
+        return IVFIndex(store, data["centroids"], data["rows"], data["offsets"], [str(x) for x in data["segments"]])
+
+    def search(self, queries, k=10, nprobe=8):
+        """Returns, for every row of queries, up to k (question id, cosine score)
+        pairs, best first, looking only at the nprobe closest clusters.
+        """
+        if self.vectors is None:
+            # the store was compacted since the index was saved
+            self.refresh()
+        queries = normalize(np.atleast_2d(queries))
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(-np.dot(queries, self.centroids.T), axis=1)[:, :nprobe]
+        results = []
+        for query, lists in zip(queries, probes):
+            positions = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in lists])
+            # rows deleted since the last refresh
+            positions = positions[self.store.live[self.rows[positions]]]
+            rows, scores = top_k(np.dot(self.vectors[positions], query), self.rows[positions], k)
+            results.append([(self.store.ids[row], float(score)) for row, score in zip(rows, scores)])
+        return results
+
+class HNSWIndex(object):
+    """Graph index backed by hnswlib (optional dependency). Labels are store
+    rows; segments are the store segments the index covers (see refresh).
+    """
+    FILE = "hnsw.bin"
+
+    def __init__(self, store, index, segments):
+        self.store = store
+        self.index = index
+        self.segments = list(segments)
+        # number of store tombstones marked in the graph (None: not known)
+        self.num_deleted = None
+
+    @staticmethod
+    def new_index(store):
+        import hnswlib
+        return hnswlib.Index(space="ip", dim=store.dim)
+
+    @staticmethod
+    def build(store, M=16, ef_construction=200):
+        index = HNSWIndex.new_index(store)
+        index.init_index(max_elements=max(1, len(store)), M=M, ef_construction=ef_construction)
+        index = HNSWIndex(store, index, [])
+        index.refresh()
+        return index
+
+    def refresh(self):
+        """Add the rows appended to the store since the last refresh and mark
+        the rows that are no longer live as deleted. After store.compact() the
+        graph is built again.
+        """
+        start = self.store.rows_since(self.segments)
+        if start is None:
+            rebuilt = HNSWIndex.build(self.store, self.index.M, self.index.ef_construction)
+            self.index, self.segments = rebuilt.index, rebuilt.segments
+            return
+        if len(self.store) > self.index.get_max_elements():
+            self.index.resize_index(len(self.store))
+        for offset, block in self.store.blocks():
+            if offset + len(block) <= start:
+                continue
+            skip = max(0, start - offset)
+            self.index.add_items(np.asarray(block[skip:]), np.arange(offset + skip, offset + len(block)))
+        self.mark_deleted()
+        self.segments = self.store.segment_list()
+
+    def mark_deleted(self):
+        """Mark the rows of the graph that are no longer live in the store as
+        deleted, so that knn_query skips them instead of returning them in
+        place of live neighbours.
+        """
+        for row in np.nonzero(~self.store.live[:self.index.get_current_count()])[0]:
+            try:
+                self.index.mark_deleted(int(row))
+            except RuntimeError:
+                # already marked
+                pass
+        self.num_deleted = len(self.store) - self.store.num_live()
+
+    def save(self, path=None):
+        path = path or os.path.join(self.store.path, self.FILE)
+        self.index.save_index(path)
+        with open(path + ".segments", "w") as fout:
+            for name in self.segments:
+                fout.write(name + "\n")
+
+    @staticmethod
+    def load(store, path=None):
+        path = path or os.path.join(store.path, HNSWIndex.FILE)
+        index = HNSWIndex.new_index(store)
+        index.load_index(path, max_elements=max(1, len(store)))
+        with open(path + ".segments") as fin:
+            segments = [line.rstrip("\n") for line in fin]
+        return HNSWIndex(store, index, segments)
+
+    def search(self, queries, k=10, ef_search=64):
+        if self.store.rows_since(self.segments) is None:
+            # the store was compacted since the index was saved
+            self.refresh()
+        if self.num_deleted != len(self.store) - self.store.num_live():
+            # questions deleted since the last refresh
+            self.mark_deleted()
+        queries = normalize(np.atleast_2d(queries))
+        self.index.set_ef(max(ef_search, k))
+        k = min(k, int(self.store.live[:self.index.get_current_count()].sum()))
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+        labels, distances = self.index.knn_query(queries, k=k)
+        # hnswlib's inner product distance is 1 - similarity
+        return [[(self.store.ids[row], float(1.0 - d)) for row, d in zip(rows, ds) if self.store.live[row]]
+                for rows, ds in zip(labels, distances)]
+
+INDEX_TYPES = {"ivf": IVFIndex, "hnsw": HNSWIndex}
+
+def benchmark(index, store, qids, k=10, knobs=(1, 2, 4, 8, 16, 32)):
+    """For every value of the index's recall/latency knob (nprobe or ef_search),
+    returns (knob, recall@k against exact search, queries per second), querying
+    with the stored vectors of the questions qids. A query's own question is
+    left out of both result lists (the index is searched for k + 1), so that it
+    does not count as a hit.
+    """
+    queries = store.get(qids)
+    exact = search.search_ids(store, qids, k)
+    exact = [set(id for id, _ in result) for result in exact]
+    rows = []
+    for knob in knobs:
+        time_begin = time.time()
+        approximate = index.search(queries, k + 1, knob)
+        elapsed = time.time() - time_begin
+        approximate = [[id for id, _ in result if id != qid][:k] for qid, result in zip(qids, approximate)]
+        recall = np.mean([len(truth & set(result)) / float(len(truth))
+                          for truth, result in zip(exact, approximate) if truth])
+        rows.append((knob, recall, len(queries) / elapsed))
+    return rows
+
+def main(args):
+    store = VectorStore(args.index)
+    print("loaded index of " + str(len(store)) + " questions")
+    index_type = INDEX_TYPES[args.type]
+    if args.build:
+        time_begin = time.time()
+        if args.type == "ivf":
+            index = IVFIndex.build(store, args.nlist)
+        else:
+            index = HNSWIndex.build(store, args.M, args.ef_construction)
+        index.save()
+        print("built " + args.type + " index in " + str(time.time() - time_begin) + "s")
+    if args.benchmark:
+        index = index_type.load(store)
+        rng = np.random.RandomState(1)
+        live_rows = np.nonzero(store.live)[0]
+        qids = [store.ids[row] for row in rng.choice(live_rows, min(args.num_queries, len(live_rows)), replace=False)]
+        knobs = [int(x) for x in args.knobs.split(",")]
+        print("knob\trecall@" + str(args.k) + "\tqueries/s")
+        for knob, recall, qps in benchmark(index, store, qids, args.k, knobs):
+            print(str(knob) + "\t" + ("%.4f" % recall) + "\t" + ("%.1f" % qps))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--index",
+            type = str
+        )
+    argparser.add_argument("--type",
+            type = str,
+            default = "ivf"
+        )
+    argparser.add_argument("--build",
+            action = "store_true"
+        )
+    argparser.add_argument("--benchmark",
+            action = "store_true"
+        )
+    argparser.add_argument("--nlist",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--M",
+            type = int,
+            default = 16
+        )
+    argparser.add_argument("--ef_construction",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--knobs",
+            type = str,
+            default = "1,2,4,8,16,32"
+        )
+    argparser.add_argument("--num_queries",
+            type = int,
+            default = 1000
+        )
+    argparser.add_argument("--k",
+            type = int,
+            default = 10
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,5 @@
+"""Reproducible performance benchmarks that need none of the external
+datasets: synthetic.py generates an AskUbuntu-like corpus, embeddings and
+annotation files, and run.py times every stage of the pipeline on them and
+stores the results as JSON for comparison between commits.
+"""
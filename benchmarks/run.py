@@ -0,0 +1,257 @@
+"""
+Times every stage of the pipeline on a synthetic dataset (see synthetic.py,
+generated into --output_dir first unless it holds one generated with the same
+options) and writes the results
+to a JSON file named after the current commit, so that two commits can be
+compared with --compare.
+
+Stages: read_corpus, load_embeddings, map_corpus, read_annotations,
+create_batches, create_eval_batches, get_embeddings, then, with torch
+installed, embed (encoder.py's gather), forward and forward_backward (margin
+loss, backward and Adam step) of the LSTM and CNN encoders, and AUCMeter;
+Evaluation metrics are timed in any case. Each stage is run --repeats times;
+its median, min, mean and p95 seconds and items per second (of the median)
+are reported.
+
+Usage (from the repository root):
+python2 -m benchmarks.run [--output_dir <bench_data>] [--results <json path>] [--repeats <5>] [--batches <20>] [--hidden_size <100>] [synthetic.py options]
+python2 -m benchmarks.run --compare <old json path> <new json path> [--threshold <1.1>]
+
+Example Usage:
+python2 -m benchmarks.run --questions 20000 --repeats 5
+python2 -m benchmarks.run --compare benchmark_results/<old commit>.json benchmark_results/<new commit>.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+
+import corpus
+from evaluation import Evaluation
+from benchmarks import synthetic
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def stats(times, items):
+    times = np.array(times)
+    median = float(np.median(times))
+    return {"repeats": len(times), "median_s": median, "min_s": float(times.min()), "mean_s": float(times.mean()),
+            "p95_s": float(np.percentile(times, 95)), "items": items,
+            "items_per_s": items / median if median > 0 else None}
+
+def bench(results, name, function, repeats, items):
+    """Time function repeats times into results[name]; returns its last value.
+    items is the number of items it processes, or a function of that value
+    giving it.
+    """
+    times = []
+    for _ in range(repeats):
+        time_begin = time.time()
+        value = function()
+        times.append(time.time() - time_begin)
+    results[name] = stats(times, items(value) if callable(items) else items)
+    print(name + ": " + ("%.4f" % results[name]["median_s"]) + "s")
+    return value
+
+def seeded(seed, function):
+    """function with the global random seeded before every call: corpus.py
+    shuffles batches and initializes the padding embedding with it, so every
+    repeat and every run gets the same data.
+    """
+    def call():
+        random.seed(seed)
+        return function()
+    return call
+
+def ranked_labels(rng, queries):
+    """Labels of 20-candidate rankings with 1 to 3 positives, as Evaluation takes them.
+    """
+    labels = np.zeros((queries, 20), dtype=np.int32)
+    for row in range(queries):
+        labels[row, rng.choice(20, rng.randint(1, 4), replace=False)] = 1
+    return list(labels)
+
+def encoder_stages(args, results, batches, embeddings, padding_id):
+    import encoder
+    from distill import triple_scores
+    from torch.optim import Adam
+    import torch.nn.functional as F
+    import torch.autograd as autograd
+
+    questions = sum(titles.shape[1] for titles, _, _ in batches)
+    bench(results, "embed", lambda: [encoder.embed(args, ids, embeddings) for titles, bodies, _ in batches
+                                     for ids in (titles, bodies)], args.repeats, questions)
+    for model_type in ("lstm", "cnn"):
+        args.model = model_type
+        torch.manual_seed(args.seed)
+        model = encoder.create_model(args)
+        optimizer = Adam(model.parameters())
+
+        def forward():
+            for titles, bodies, _ in batches:
+                encoder.encode_batch(args, model, titles, bodies, embeddings, padding_id)
+
+        def forward_backward():
+            for titles, bodies, triples in batches:
+                optimizer.zero_grad()
+                hidden = encoder.encode_batch(args, model, titles, bodies, embeddings, padding_id)
+                targets = autograd.Variable(torch.zeros(triples.shape[0]).type(torch.LongTensor))
+                loss = F.multi_margin_loss(triple_scores(args, hidden, triples, args.hidden_size), targets, margin=0.2)
+                loss.backward()
+                optimizer.step()
+
+        bench(results, model_type + "_forward", forward, args.repeats, questions)
+        bench(results, model_type + "_forward_backward", forward_backward, args.repeats, questions)
+
+def metrics(labels):
+    evaluator = Evaluation(labels)
+    return [evaluator.MAP(), evaluator.MRR(), evaluator.Precision(1), evaluator.Precision(5)]
+
+def auc_meter(scores, labels):
+    from meter import AUCMeter
+    meter = AUCMeter()
+    for query_scores, query_labels in zip(scores, labels):
+        meter.add(query_scores, query_labels)
+    return meter.value(0.05)
+
+def run(args):
+    paths = dict((name, os.path.join(args.output_dir, filename)) for name, filename in
+                 (("corpus", "corpus.txt.gz"), ("embeddings", "vectors.txt.gz"),
+                  ("train", "train.txt"), ("dev", "dev.txt"), ("test", "test.txt")))
+    generated = synthetic.generated_params(args.output_dir)
+    if generated != synthetic.params(args) or not all(os.path.exists(path) for path in paths.values()):
+        if generated is not None and generated != synthetic.params(args):
+            print(args.output_dir + " was generated with other options, generating it again")
+        print("generating synthetic data in " + args.output_dir)
+        paths = synthetic.generate(args)
+
+    results = {}
+    raw_corpus = bench(results, "read_corpus", lambda: corpus.read_corpus(paths["corpus"]),
+                       args.repeats, len)
+    list_words, vocab_map, embeddings, padding_id = bench(
+        results, "load_embeddings",
+        seeded(args.seed, lambda: corpus.load_embeddings(corpus.load_embedding_iterator(paths["embeddings"]))),
+        args.repeats, lambda loaded: len(loaded[0]) - 1)
+    ids_corpus = bench(results, "map_corpus", lambda: corpus.map_corpus(vocab_map, raw_corpus),
+                       args.repeats, len(raw_corpus))
+    annotations = bench(results, "read_annotations", lambda: corpus.read_annotations(paths["train"]),
+                        args.repeats, len)
+    batches = bench(results, "create_batches",
+                    seeded(args.seed, lambda: corpus.create_batches(ids_corpus, annotations, args.batch_size, padding_id)),
+                    args.repeats, len(annotations))
+    eval_data = corpus.read_annotations(paths["dev"])
+    bench(results, "create_eval_batches", lambda: corpus.create_eval_batches(ids_corpus, eval_data, padding_id),
+          args.repeats, len(eval_data))
+
+    batches = batches[:args.batches]
+    questions = sum(titles.shape[1] for titles, _, _ in batches)
+    bench(results, "get_embeddings", lambda: [corpus.get_embeddings(titles, bodies, vocab_map, embeddings)
+                                              for titles, bodies, _ in batches], args.repeats, questions)
+    if torch is not None:
+        torch.set_num_threads(args.threads)
+        args.embedding_size = embeddings.shape[1]
+        args.cuda = 0
+        encoder_stages(args, results, batches, embeddings, padding_id)
+
+    rng = np.random.RandomState(args.seed)
+    labels = ranked_labels(rng, args.metric_queries)
+    bench(results, "evaluation", lambda: metrics(labels), args.repeats, len(labels))
+    if torch is not None:
+        scores = [rng.random_sample(20) for _ in labels]
+        targets = [label.astype(np.int64) for label in labels]
+        bench(results, "auc_meter", lambda: auc_meter(scores, targets), args.repeats, len(labels))
+
+    meta = {"commit": commit(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "torch": torch.__version__ if torch is not None else None,
+            "machine": platform.machine(), "processor": platform.processor(), "threads": args.threads,
+            "dataset": synthetic.params(args),
+            "batches": args.batches, "batch_size": args.batch_size, "hidden_size": args.hidden_size,
+            "metric_queries": args.metric_queries}
+    path = args.results or os.path.join("benchmark_results", meta["commit"] + ".json")
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as fout:
+        json.dump({"meta": meta, "stages": results}, fout, indent=2, sort_keys=True)
+    print("wrote " + path)
+
+def compare(old_path, new_path, threshold):
+    """Print the median time of every stage in both runs; stages slower by more
+    than threshold are marked.
+    """
+    with open(old_path) as fin:
+        old = json.load(fin)
+    with open(new_path) as fin:
+        new = json.load(fin)
+    print("\t".join(["stage", old["meta"]["commit"], new["meta"]["commit"], "ratio"]))
+    for name in sorted(set(old["stages"]) | set(new["stages"])):
+        if name not in old["stages"] or name not in new["stages"]:
+            print(name + "\t(only in one run)")
+            continue
+        before = old["stages"][name]["median_s"]
+        after = new["stages"][name]["median_s"]
+        ratio = after / before if before > 0 else float("inf")
+        print("\t".join([name, "%.4f" % before, "%.4f" % after, "%.2f" % ratio]) +
+              ("\tSLOWER" if ratio > threshold else ""))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    synthetic.add_arguments(argparser)
+    argparser.add_argument("--results",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--repeats",
+            type = int,
+            default = 5
+        )
+    argparser.add_argument("--batches",
+            type = int,
+            default = 20
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 25
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--metric_queries",
+            type = int,
+            default = 10000
+        )
+    argparser.add_argument("--threads",
+            type = int,
+            default = 1
+        )
+    argparser.add_argument("--compare",
+            type = str,
+            nargs = 2,
+            default = None
+        )
+    argparser.add_argument("--threshold",
+            type = float,
+            default = 1.1
+        )
+
+    args = argparser.parse_args()
+    if args.compare:
+        compare(args.compare[0], args.compare[1], args.threshold)
+    else:
+        run(args)
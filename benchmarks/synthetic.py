@@ -0,0 +1,173 @@
+"""
+Generates a synthetic AskUbuntu-like dataset in the formats the repo reads:
+
+    corpus.txt.gz      id \t title \t body            (corpus.read_corpus)
+    vectors.txt.gz     word v1 ... vN                 (corpus.load_embedding_iterator)
+    train.txt          id \t similar ids \t negatives (corpus.read_annotations, like train_random.txt)
+    dev.txt, test.txt  id \t similar ids \t 20 candidates \t scores (like dev.txt / test.txt)
+
+Words follow a Zipf distribution over the vocabulary and title and body
+lengths are log-normal (by default a median of 8 title and 60 body tokens with
+a long tail of bodies over 100), roughly as in AskUbuntu. The rarest
+--oov_fraction of the vocabulary has no embedding. The same --seed always
+gives the same files. The options they were generated with are written last,
+to params.json.
+
+Usage (from the repository root):
+python2 -m benchmarks.synthetic --output_dir <directory> [--questions <20000>] [--vocab_size <50000>] [--embedding_size <200>] [--train_queries <2000>] [--eval_queries <200>] [--seed <1>]
+
+Example Usage:
+python2 -m benchmarks.synthetic --output_dir bench_data --questions 50000
+"""
+
+import os
+import sys
+import gzip
+import json
+import argparse
+
+import numpy as np
+
+# the options that determine the generated files
+PARAMS = ("questions", "vocab_size", "oov_fraction", "embedding_size", "title_median", "body_median",
+          "train_queries", "eval_queries", "seed")
+PARAMS_FILE = "params.json"
+
+def params(args):
+    return dict((name, getattr(args, name)) for name in PARAMS)
+
+def generated_params(output_dir):
+    """The params of the dataset in output_dir, or None when there is no
+    complete one.
+    """
+    path = os.path.join(output_dir, PARAMS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        return json.load(fin)
+
+def zipf_sampler(vocab_size, rng, exponent=1.0):
+    """Returns a function drawing n word ranks with P(rank) ~ 1 / (rank + 2.7)^exponent.
+    """
+    cumulative = np.cumsum(1.0 / (np.arange(vocab_size) + 2.7) ** exponent)
+    cumulative /= cumulative[-1]
+    return lambda n: np.minimum(np.searchsorted(cumulative, rng.random_sample(n)), vocab_size - 1)
+
+def lengths(rng, n, median, sigma, maximum):
+    return np.clip(np.round(rng.lognormal(np.log(median), sigma, n)), 1, maximum).astype(np.int64)
+
+def word(rank):
+    return "w" + str(rank)
+
+def write_lines(path, lines):
+    fopen = gzip.open if path.endswith(".gz") else open
+    with fopen(path, "wb") as fout:
+        for line in lines:
+            fout.write((line + "\n").encode("utf-8"))
+
+def corpus_lines(args, rng):
+    sample = zipf_sampler(args.vocab_size, rng)
+    title_lengths = lengths(rng, args.questions, args.title_median, 0.4, 40)
+    body_lengths = lengths(rng, args.questions, args.body_median, 0.9, 1000)
+    for i in range(args.questions):
+        title = " ".join(word(rank) for rank in sample(title_lengths[i]))
+        body = " ".join(word(rank) for rank in sample(body_lengths[i]))
+        yield str(i) + "\t" + title + "\t" + body
+
+def embedding_lines(args, rng):
+    template = " ".join(["%.5f"] * args.embedding_size)
+    for rank in range(int(args.vocab_size * (1 - args.oov_fraction))):
+        yield word(rank) + " " + template % tuple(rng.uniform(-0.5, 0.5, args.embedding_size))
+
+def annotation_lines(args, rng, queries, num_negatives, candidates):
+    """With candidates, 20 candidates that include the similar questions and a
+    fourth column of scores, like dev.txt; otherwise num_negatives random
+    negatives, like train_random.txt.
+    """
+    for qid in queries:
+        similar = [x for x in rng.choice(args.questions, rng.randint(1, 4), replace=False) if x != qid]
+        if not similar:
+            continue
+        negatives = [x for x in rng.randint(0, args.questions, num_negatives) if x != qid and x not in similar]
+        columns = [str(qid), " ".join(str(x) for x in similar)]
+        if candidates:
+            listed = list(similar) + negatives[:20 - len(similar)]
+            rng.shuffle(listed)
+            columns += [" ".join(str(x) for x in listed), " ".join("%.3f" % x for x in rng.uniform(0, 100, len(listed)))]
+        else:
+            columns.append(" ".join(str(x) for x in negatives))
+        yield "\t".join(columns)
+
+def generate(args):
+    """Writes the dataset to args.output_dir; returns the paths by name.
+    """
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    if os.path.exists(os.path.join(args.output_dir, PARAMS_FILE)):
+        # incomplete until rewritten at the end
+        os.remove(os.path.join(args.output_dir, PARAMS_FILE))
+    rng = np.random.RandomState(args.seed)
+    paths = dict((name, os.path.join(args.output_dir, filename)) for name, filename in
+                 (("corpus", "corpus.txt.gz"), ("embeddings", "vectors.txt.gz"),
+                  ("train", "train.txt"), ("dev", "dev.txt"), ("test", "test.txt")))
+    write_lines(paths["corpus"], corpus_lines(args, rng))
+    write_lines(paths["embeddings"], embedding_lines(args, rng))
+    queries = rng.permutation(args.questions)
+    train_queries = queries[:args.train_queries]
+    dev_queries = queries[args.train_queries:args.train_queries + args.eval_queries]
+    test_queries = queries[args.train_queries + args.eval_queries:args.train_queries + 2 * args.eval_queries]
+    write_lines(paths["train"], annotation_lines(args, rng, train_queries, 100, False))
+    write_lines(paths["dev"], annotation_lines(args, rng, dev_queries, 40, True))
+    write_lines(paths["test"], annotation_lines(args, rng, test_queries, 40, True))
+    with open(os.path.join(args.output_dir, PARAMS_FILE), "w") as fout:
+        json.dump(params(args), fout, indent=2, sort_keys=True)
+    return paths
+
+def add_arguments(argparser):
+    argparser.add_argument("--output_dir",
+            type = str,
+            default = "bench_data"
+        )
+    argparser.add_argument("--questions",
+            type = int,
+            default = 20000
+        )
+    argparser.add_argument("--vocab_size",
+            type = int,
+            default = 50000
+        )
+    argparser.add_argument("--oov_fraction",
+            type = float,
+            default = 0.1
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--title_median",
+            type = float,
+            default = 8
+        )
+    argparser.add_argument("--body_median",
+            type = float,
+            default = 60
+        )
+    argparser.add_argument("--train_queries",
+            type = int,
+            default = 2000
+        )
+    argparser.add_argument("--eval_queries",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--seed",
+            type = int,
+            default = 1
+        )
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    add_arguments(argparser)
+    args = argparser.parse_args()
+    for name, path in sorted(generate(args).items()):
+        print(name + ": " + path)
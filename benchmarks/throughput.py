@@ -0,0 +1,180 @@
+"""
+Encoder throughput for capacity planning: questions encoded per second by
+the LSTM and CNN encoders of encoder.py over every combination of model,
+hidden size, embedding size, batch size, title length, body length and torch
+thread count. Batches go through encoder.encode_questions, the inference path
+of build_index.py, server.py and rerank.py (length sorting, padding, no
+autograd graph and the copy to numpy included).
+
+Inputs are random word ids over random embeddings, every title and body of a
+batch exactly the given length, so no dataset is needed. Each configuration
+is encoded --warmup times untimed and then --iterations times; the latency of
+one batch is reported as mean, p50, p90 and p99 milliseconds next to
+questions per second (batch size / mean latency). p99 is left empty with
+fewer than 100 iterations, where it would only be the slowest batch.
+
+Every configuration is one row of --results_file (CSV, one column per swept
+dimension, ready for plotting); the table is also printed, and with --plot
+(needs matplotlib) questions per second against batch size is drawn to a PNG.
+
+Usage (from the repository root):
+python2 -m benchmarks.throughput --results_file <csv path> [--models <lstm,cnn>] [--hidden_sizes <100,200,300>] [--embedding_sizes <200,300>] [--batch_sizes <1,16,64,256>] [--title_lengths <10>] [--body_lengths <50,100>] [--threads <1,2,4>] [--iterations <100>] [--warmup <3>] [--plot <png path>]
+
+Example Usage:
+python2 -m benchmarks.throughput --results_file throughput.csv --threads 1,4,8 --plot throughput.png
+"""
+
+import sys
+import csv
+import time
+import argparse
+import itertools
+
+import numpy as np
+
+import torch
+
+import encoder
+
+HEADER = ["model", "hidden_size", "embedding_size", "batch_size", "title_length", "body_length", "threads",
+          "questions/s", "mean ms", "p50 ms", "p90 ms", "p99 ms"]
+
+# fewer iterations than this make p99 the maximum
+P99_ITERATIONS = 100
+
+def ints(text):
+    return [int(x) for x in text.split(",")]
+
+def measure(args, model_args, model, embeddings, batch_size, title_length, body_length):
+    """Per-batch latencies in seconds of encoding random batches of the given
+    shape with encoder.encode_questions.
+    """
+    rng = np.random.RandomState(args.seed)
+    vocab = embeddings.shape[0] - 1
+    batches = [[(rng.randint(0, vocab, title_length), rng.randint(0, vocab, body_length)) for _ in range(batch_size)]
+               for _ in range(min(args.iterations, 5))]
+    times = []
+    for i in range(args.warmup + args.iterations):
+        questions = batches[i % len(batches)]
+        time_begin = time.time()
+        encoder.encode_questions(model_args, model, questions, embeddings, vocab, batch_size)
+        if i >= args.warmup:
+            times.append(time.time() - time_begin)
+    return np.array(times)
+
+def run(args):
+    rows = []
+    rng = np.random.RandomState(args.seed)
+    for threads in ints(args.threads):
+        torch.set_num_threads(threads)
+        for model_type, hidden_size, embedding_size in itertools.product(args.models.split(","), ints(args.hidden_sizes),
+                                                                          ints(args.embedding_sizes)):
+            model_args = argparse.Namespace(model=model_type, hidden_size=hidden_size, embedding_size=embedding_size, cuda=0)
+            torch.manual_seed(args.seed)
+            model = encoder.new_model(model_args)
+            model.eval()
+            embeddings = rng.uniform(-0.5, 0.5, (args.vocab_size + 1, embedding_size)).astype(np.float32)
+            for batch_size, title_length, body_length in itertools.product(ints(args.batch_sizes), ints(args.title_lengths),
+                                                                            ints(args.body_lengths)):
+                ms = measure(args, model_args, model, embeddings, batch_size, title_length, body_length) * 1000.0
+                row = [model_type, hidden_size, embedding_size, batch_size, title_length, body_length, threads,
+                       batch_size * 1000.0 / ms.mean(), ms.mean(), np.percentile(ms, 50), np.percentile(ms, 90),
+                       np.percentile(ms, 99) if len(ms) >= P99_ITERATIONS else ""]
+                print("\t".join(str(x) if not isinstance(x, float) else "%.2f" % x for x in row))
+                rows.append(row)
+    return rows
+
+def plot(rows, path):
+    """questions/s against batch size, one line per model, hidden size,
+    embedding size and thread count, for the first title and body length.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    lengths = (rows[0][4], rows[0][5])
+    lines = {}
+    for row in rows:
+        if (row[4], row[5]) == lengths:
+            key = row[0] + " h" + str(row[1]) + " e" + str(row[2]) + " t" + str(row[6])
+            lines.setdefault(key, []).append((row[3], row[7]))
+    plt.figure(figsize=(10, 6))
+    for key in sorted(lines):
+        points = sorted(lines[key])
+        plt.plot([x for x, _ in points], [y for _, y in points], marker="o", label=key)
+    plt.xscale("log")
+    plt.yscale("log")
+    plt.xlabel("batch size")
+    plt.ylabel("questions/s")
+    plt.title("title length " + str(lengths[0]) + ", body length " + str(lengths[1]))
+    plt.legend(fontsize="small", ncol=2)
+    plt.savefig(path)
+    print("wrote " + path)
+
+def main(args):
+    print("\t".join(HEADER))
+    rows = run(args)
+    with open(args.results_file, "w") as results_file:
+        writer = csv.writer(results_file, dialect="excel")
+        writer.writerow(HEADER)
+        for row in rows:
+            writer.writerow(row)
+    if args.plot:
+        plot(rows, args.plot)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--results_file",
+            type = str,
+            default = "throughput.csv"
+        )
+    argparser.add_argument("--models",
+            type = str,
+            default = "lstm,cnn"
+        )
+    argparser.add_argument("--hidden_sizes",
+            type = str,
+            default = "100,200,300"
+        )
+    argparser.add_argument("--embedding_sizes",
+            type = str,
+            default = "200,300"
+        )
+    argparser.add_argument("--batch_sizes",
+            type = str,
+            default = "1,16,64,256"
+        )
+    argparser.add_argument("--title_lengths",
+            type = str,
+            default = "10"
+        )
+    argparser.add_argument("--body_lengths",
+            type = str,
+            default = "50,100"
+        )
+    argparser.add_argument("--threads",
+            type = str,
+            default = "1,2,4"
+        )
+    argparser.add_argument("--vocab_size",
+            type = int,
+            default = 20000
+        )
+    argparser.add_argument("--iterations",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--warmup",
+            type = int,
+            default = 3
+        )
+    argparser.add_argument("--seed",
+            type = int,
+            default = 1
+        )
+    argparser.add_argument("--plot",
+            type = str,
+            default = ""
+        )
+
+    args = argparser.parse_args()
+    main(args)
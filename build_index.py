@@ -0,0 +1,157 @@
+"""
+Encodes every question of a corpus with a trained LSTM or CNN and writes the
+L2-normalized question vectors to an on-disk VectorStore (see vector_store.py),
+for use by retrieval instead of re-encoding from token ids every time.
+
+The corpus is streamed and encoded --chunk_size questions at a time, each chunk
+written as its own memory-mapped segment, so corpora larger than memory work.
+Running the same command again resumes an interrupted build: questions already
+in the store are skipped. An existing store built with another model,
+checkpoint, embeddings or corpus is refused.
+
+Usage:
+python2 build_index.py --corpus <gzipped corpus path> --embeddings <gzipped embeddings path> --load_model <model path> --output <index directory> [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] [--batch_size <512>] [--chunk_size <50000>] [--num_threads <cores>] [--cuda <0 | 1>]
+
+Example Usage:
+(AskUbuntu)
+python2 build_index.py --corpus ../askubuntu/text_tokenized.txt.gz --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --load_model lstm_models/lstm_model3/epoch9 --model lstm --output indexes/askubuntu_lstm3
+
+(Android)
+python2 build_index.py --corpus ../Android/corpus.tsv.gz --embeddings ../glove.pruned.txt.gz --load_model cnn_models/cnn_model8/epoch5 --model cnn --embedding_size 300 --output indexes/android_cnn8
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+from datetime import datetime
+
+import torch
+
+import corpus
+import encoder
+from cache import model_version
+from vector_store import VectorStore, question_hash
+
+def main(args):
+    torch.set_num_threads(args.num_threads or multiprocessing.cpu_count())
+    model = encoder.load_model(args)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    print("loaded embeddings")
+
+    store = open_index(args.output, args)
+    if store.num_live() > 0:
+        print("resuming: " + str(store.num_live()) + " questions already encoded")
+
+    build_index(args, store, model, vocab_map, embeddings, padding_id)
+    print("encoded " + str(store.num_live()) + " questions into " + args.output)
+
+def index_meta(args):
+    """What is recorded in meta.json of a store built from args.
+    """
+    return {"dim": args.hidden_size, "model": args.model, "checkpoint": args.load_model,
+            "model_version": model_version(args.load_model), "embeddings": args.embeddings,
+            "embedding_size": args.embedding_size, "hidden_size": args.hidden_size, "corpus": args.corpus}
+
+def check_checkpoint(meta, path):
+    """Raises ValueError unless a store with meta was built with the checkpoint
+    at path, and the file has not changed since (when the store recorded its
+    model_version).
+    """
+    built = meta.get("checkpoint") or ""
+    if os.path.normpath(path) == os.path.normpath(built) and \
+            ("model_version" not in meta or meta["model_version"].rsplit("@", 1)[-1] == str(os.path.getmtime(path))):
+        return
+    raise ValueError("the index was built with " + meta.get("model_version", built) + ", not "
+                     + model_version(path))
+
+def open_index(path, args):
+    """Create the store at path, or open it to resume an interrupted build;
+    exits if it was built with other settings than args.
+    """
+    try:
+        return VectorStore.create(path, index_meta(args))
+    except ValueError as e:
+        sys.exit(str(e))
+
+def build_index(args, store, model, vocab_map, embeddings, padding_id, changed_only=False, seen=None,
+                reencode=False):
+    """Encode every question of args.corpus that is not in the store yet (or,
+    with changed_only, whose text changed since it was encoded, or with
+    reencode, every question), appending one segment per args.chunk_size
+    questions. The ids read are added to seen.
+    """
+    ids = []
+    questions = []
+    hashes = []
+    time_begin = datetime.now()
+    for id, title, body in corpus.iter_corpus(args.corpus):
+        if seen is not None:
+            seen.add(id)
+        h = question_hash(title, body)
+        if not reencode and id in store and (not changed_only or store.hashes.get(id) == h):
+            continue
+        ids.append(id)
+        questions.append(corpus.map_question(vocab_map, title, body))
+        hashes.append(h)
+        if len(ids) == args.chunk_size:
+            write_chunk(args, store, model, ids, questions, hashes, embeddings, padding_id)
+            print("time for chunk: " + str(datetime.now() - time_begin))
+            time_begin = datetime.now()
+            ids = []
+            questions = []
+            hashes = []
+    write_chunk(args, store, model, ids, questions, hashes, embeddings, padding_id)
+
+def write_chunk(args, store, model, ids, questions, hashes, embeddings, padding_id):
+    if not ids:
+        return
+    vectors = encoder.encode_questions(args, model, questions, embeddings, padding_id, args.batch_size)
+    store.append(ids, vectors, hashes)
+    print("encoded " + str(store.num_live()) + " questions")
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--corpus",
+            type = str
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--load_model",
+            type = str
+        )
+    argparser.add_argument("--output",
+            type = str
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 512
+        )
+    argparser.add_argument("--chunk_size",
+            type = int,
+            default = 50000
+        )
+    argparser.add_argument("--num_threads",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,83 @@
+"""Bounded, thread-safe LRU cache of question encodings, so that the same
+question (reposts, retries, popular queries) is not run through the encoder
+again.
+
+Entries are keyed by a hash of the title and body id arrays and the model
+version; changing the version (when a new checkpoint is loaded) empties the
+cache.
+"""
+
+import os
+import hashlib
+import threading
+import collections
+
+import numpy as np
+
+def model_version(path):
+    """A version string for a checkpoint file: its path and modification time.
+    """
+    return path + "@" + str(os.path.getmtime(path))
+
+class EncodingCache(object):
+
+    def __init__(self, max_entries=100000, max_bytes=0, version=""):
+        """max_entries and max_bytes (0 for no limit) bound the cache; the least
+        recently used entries are evicted first.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = version
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, title, body, version=None):
+        digest = hashlib.sha1()
+        digest.update(np.array([len(title), len(body)], dtype=np.int64).tobytes())
+        digest.update(np.asarray(title, dtype=np.int64).tobytes())
+        digest.update(np.asarray(body, dtype=np.int64).tobytes())
+        digest.update((self.version if version is None else version).encode("utf-8"))
+        return digest.digest()
+
+    def get(self, key):
+        """Returns the cached vector for key, or None.
+        """
+        with self.lock:
+            vector = self.entries.pop(key, None)
+            if vector is None:
+                self.misses += 1
+                return None
+            self.entries[key] = vector
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[key] = vector
+            self.nbytes += vector.nbytes
+            while self.entries and ((self.max_entries and len(self.entries) > self.max_entries)
+                                    or (self.max_bytes and self.nbytes > self.max_bytes)):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def set_version(self, version):
+        """Switch to a new model version, dropping every cached encoding if it
+        changed.
+        """
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.entries.clear()
+                self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries),
+                    "bytes": self.nbytes, "hit_rate": self.hits / float(lookups) if lookups else 0.0}
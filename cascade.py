@@ -0,0 +1,207 @@
+"""
+Cascaded retrieval on AskUbuntu: a cheap first-stage encoding retrieves a
+shortlist of the --depths most similar questions from the whole corpus, and
+only the query and that shortlist are run through the full title + body
+encoder to re-rank it.
+
+The first stage (--first_stage) is either the trained model run over titles
+only ("title"), which skips the long bodies, or the averaged word embeddings
+of title and body ("bag"), which runs no model at all. First-stage vectors of
+the corpus are computed once into a VectorStore at --first_stage_index (see
+build_index.py) and reused by later runs made with the same first stage,
+checkpoint and embeddings; a store made with others is refused, unless
+--rebuild 1 replaces it.
+
+For every depth it reports MAP, MRR, P@1, P@5 and recall over the full-corpus
+ranking with the mean and p95 end-to-end latency per query. The first-stage
+ranking alone and, with --index (a store of full encodings), the full
+encoder's exact ranking are reported as reference rows.
+
+Usage:
+python2 cascade.py --data_path <askubuntu directory> --embeddings <gzipped embeddings path> --load_model <model path> --first_stage_index <index directory> [--first_stage <title | bag>] [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200>] [--depths <20,50,100,200>] [--splits <test>] [--index <index directory>] [--rebuild <0 | 1>]
+
+Example Usage:
+python2 cascade.py --data_path ../askubuntu --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --load_model lstm_models/lstm_model3/epoch9 --first_stage title --first_stage_index indexes/askubuntu_lstm3_titles
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import corpus
+import encoder
+import search
+from hybrid import NeuralScorer, read_eval_set, evaluate, latency
+from cache import model_version
+from vector_store import VectorStore
+
+def first_stage_vectors(args, model, questions, embeddings, padding_id):
+    if args.first_stage == "title":
+        return encoder.encode_titles(args, model, questions, embeddings, padding_id, args.batch_size)
+    return encoder.bag_of_embeddings(questions, embeddings, padding_id)
+
+def first_stage_meta(args, embeddings):
+    """What is recorded in meta.json of the first-stage store; the model only
+    matters for title encodings.
+    """
+    meta = {"first_stage": args.first_stage, "embeddings": args.embeddings}
+    if args.first_stage == "title":
+        meta.update({"dim": args.hidden_size, "model": args.model, "checkpoint": args.load_model,
+                     "model_version": model_version(args.load_model)})
+    else:
+        meta["dim"] = embeddings.shape[1]
+    return meta
+
+def build_first_stage(args, model, ids_corpus, embeddings, padding_id):
+    """Open (building or completing it first) the store of first-stage vectors
+    of every corpus question. A store whose meta.json does not match args is
+    refused, or with --rebuild 1 removed and built again.
+    """
+    meta = first_stage_meta(args, embeddings)
+    try:
+        store = VectorStore.create(args.first_stage_index, meta)
+    except ValueError as e:
+        if not args.rebuild:
+            sys.exit(str(e) + "; pass --rebuild 1 to rebuild it")
+        print("rebuilding " + args.first_stage_index)
+        VectorStore(args.first_stage_index).remove()
+        store = VectorStore.create(args.first_stage_index, meta)
+    todo = [id for id in ids_corpus if id not in store]
+    for start in range(0, len(todo), args.chunk_size):
+        ids = todo[start:start + args.chunk_size]
+        store.append(ids, first_stage_vectors(args, model, [ids_corpus[id] for id in ids], embeddings, padding_id))
+        print("encoded " + str(store.num_live()) + " questions (" + args.first_stage + ")")
+    return store
+
+def run_split(args, queries, first_store, scorer, depths, pool):
+    """Returns the report rows of one evaluation split.
+    """
+    max_depth = max(depths)
+    shortlists = []
+    first_times = []
+    for qid, _, _, _ in queries:
+        time_begin = time.time()
+        query = first_stage_vectors(args, scorer.model, [scorer.ids_corpus[qid]], scorer.embeddings, scorer.padding_id)
+        result = search.search_vectors(first_store, query, max_depth + 1, pool=pool)[0]
+        first_times.append(time.time() - time_begin)
+        shortlists.append([id for id, _ in result if id != qid][:max_depth])
+
+    rows = [["first stage", max_depth] + evaluate(shortlists, [{}] * len(queries), queries, "askubuntu")
+            + latency(first_times)]
+    for depth in depths:
+        ranked = []
+        total_times = []
+        for (qid, _, _, _), shortlist, first_time in zip(queries, shortlists, first_times):
+            time_begin = time.time()
+            ranking, _ = scorer.rerank(qid, shortlist[:depth])
+            total_times.append(first_time + time.time() - time_begin)
+            ranked.append(ranking)
+        rows.append(["cascade", depth] + evaluate(ranked, [{}] * len(queries), queries, "askubuntu")
+                    + latency(total_times))
+
+    if args.index:
+        full_store = VectorStore(args.index)
+        ranked = []
+        search_times = []
+        for qid, _, _, _ in queries:
+            time_begin = time.time()
+            result = search.search_vectors(full_store, scorer.encode([qid]), max_depth + 1, pool=pool)[0]
+            search_times.append(time.time() - time_begin)
+            ranked.append([id for id, _ in result if id != qid][:max_depth])
+        rows.append(["full", max_depth] + evaluate(ranked, [{}] * len(queries), queries, "askubuntu")
+                    + latency(search_times))
+    return rows
+
+def main(args):
+    raw_corpus = corpus.read_corpus(os.path.join(args.data_path, "text_tokenized.txt.gz"))
+    model = encoder.load_model(args)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    ids_corpus = corpus.map_corpus(vocab_map, raw_corpus)
+    print("loaded corpus of " + str(len(ids_corpus)) + " questions")
+
+    time_begin = time.time()
+    first_store = build_first_stage(args, model, ids_corpus, embeddings, padding_id)
+    print("first-stage index ready in " + ("%.1f" % (time.time() - time_begin)) + "s")
+    # candidates are encoded with the full encoder at query time
+    scorer = NeuralScorer(args, model, ids_corpus, embeddings, padding_id)
+    pool = ThreadPool(args.num_threads or multiprocessing.cpu_count())
+
+    depths = [int(x) for x in args.depths.split(",")]
+    print("\t".join(["split", "ranking", "depth", "MAP", "MRR", "P@1", "P@5", "recall", "latency ms", "latency p95"]))
+    for split in args.splits.split(","):
+        queries = read_eval_set("askubuntu", args.data_path, split)
+        for row in run_split(args, queries, first_store, scorer, depths, pool):
+            print("\t".join([split, row[0], str(row[1])] + ["%.4f" % x for x in row[2:]]))
+    pool.close()
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--data_path",
+            type = str,
+            default = "../askubuntu"
+        )
+    argparser.add_argument("--splits",
+            type = str,
+            default = "test"
+        )
+    argparser.add_argument("--depths",
+            type = str,
+            default = "20,50,100,200"
+        )
+    argparser.add_argument("--first_stage",
+            type = str,
+            default = "title"
+        )
+    argparser.add_argument("--first_stage_index",
+            type = str
+        )
+    argparser.add_argument("--index",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--rebuild",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--load_model",
+            type = str
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 512
+        )
+    argparser.add_argument("--chunk_size",
+            type = int,
+            default = 50000
+        )
+    argparser.add_argument("--num_threads",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
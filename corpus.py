@@ -2,17 +2,26 @@ import gzip
 import random
 import numpy as np
 
-def read_corpus(path):
-    """Creates a dictionary mapping ID to a tuple
-    tuple: dictionary for question title, dictionary for body"""
-    raw_corpus = {}
+import profiling
+
+def iter_corpus(path):
+    """Yields (id, title tokens, body tokens) one question at a time, so that
+    corpora larger than memory can be streamed"""
     fopen = gzip.open if path.endswith(".gz") else open
     with fopen(path) as fin:
         for line in fin:
             id, title, body = line.split("\t")
             title = title.lower().strip().split()
             body = body.lower().strip().split()
-            raw_corpus[id] = (title, body)
+            yield id, title, body
+
+@profiling.timed("corpus_read")
+def read_corpus(path):
+    """Creates a dictionary mapping ID to a tuple
+    tuple: dictionary for question title, dictionary for body"""
+    raw_corpus = {}
+    for id, title, body in iter_corpus(path):
+        raw_corpus[id] = (title, body)
     return raw_corpus
 
 def load_embedding_iterator(path):
@@ -26,6 +35,7 @@ def load_embedding_iterator(path):
                 vals = np.array([ float(x) for x in parts[1:] ])
                 yield word, vals
 
+@profiling.timed("embedding_load")
 def load_embeddings(embeddings):
     """Returns:
     1. list of words in embeddings
@@ -56,16 +66,22 @@ def questions_to_ids(vocab_map, words):
     vocab map generated by load_embeddings"""
     return np.array([vocab_map.get(x) for x in words if x in vocab_map])
 
+@profiling.timed("id_mapping")
 def map_corpus(vocab_map, raw_corpus, max_len=100):
     """Returns a dictionary mapping question id to a tuple of two arrays:
     ids for question title, and ids for question body"""
     ids_corpus = { }
     for id, pair in raw_corpus.iteritems():
-        item = (questions_to_ids(vocab_map, pair[0]),
-                          questions_to_ids(vocab_map,pair[1])[:max_len])
-        ids_corpus[id] = item  
+        ids_corpus[id] = map_question(vocab_map, pair[0], pair[1], max_len)
     return ids_corpus
 
+def map_question(vocab_map, title, body, max_len=100):
+    """Maps one tokenized question to (title ids, body ids), truncating the body
+    to max_len ids like map_corpus"""
+    return (questions_to_ids(vocab_map, title),
+            questions_to_ids(vocab_map, body)[:max_len])
+
+@profiling.timed("embedding_gather")
 def get_embeddings(titles, bodies, vocab_map, emb_vals):
     """Returns a numpy arrays [[title_word x # words] x # questions] and [[body_word x # words] x # questions]
     """
@@ -118,6 +134,7 @@ def android_annotations(positives, negatives):
             result.append((query, qids, qlabels))
     return result
 
+@profiling.timed("batch_build")
 def domain_classifier_batch(ids_corpus, data, padding_id):
     data_order = range(len(data))
     random.shuffle(data_order)
@@ -155,6 +172,7 @@ def domain_classifier_batch(ids_corpus, data, padding_id):
             triples = create_hinge_batch(triples)
             return (titles, bodies, triples)
 
+@profiling.timed("batch_build")
 def create_batches(ids_corpus, data, batch_size, padding_id):
     data_order = range(len(data))
     random.shuffle(data_order)
@@ -198,6 +216,7 @@ def create_batches(ids_corpus, data, batch_size, padding_id):
     title1 = batches[0][0]
     return batches
 
+@profiling.timed("batch_build")
 def create_eval_batches(ids_corpus, data, padding_id):
     lst = [ ]
     for pid, qids, qlabels in data:
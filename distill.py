@@ -0,0 +1,245 @@
+"""Knowledge distillation of a trained LSTM into a faster student encoder.
+
+The student is the CNN of main.py or the MLP over averaged word embeddings of
+encoder.py. It is trained on the batches of main.py (AskUbuntu training
+annotations) to reproduce the teacher's question vectors (--objective vectors,
+cosine distance; needs the same hidden size) or the teacher's cosine scores of
+every query against its candidates (--objective scores, mean squared error).
+--alpha > 0 adds main.py's margin loss on the labels.
+
+Teacher vectors are computed once, before training. After every epoch the
+student's MAP, MRR, P@1 and P@5 on --test are written to --results_file next to
+its encoding throughput (questions per second), and the teacher's are reported
+once for comparison.
+
+Usage:
+python2 distill.py --corpus <gzipped corpus path> --embeddings <gzipped embeddings path> --train <train questions path> --test <test questions path> --teacher <lstm model path> --student <cnn | mlp> --results_file <csv path> [--objective <vectors | scores>] [--teacher_hidden_size <100>] [--hidden_size <100>] [--embedding_size <200>] [--batch_size <25>] [--epochs <10>] [--alpha <0>] [--cuda <0 | 1>] [--save_model <0 | 1>]
+
+Example Usage:
+python2 distill.py --corpus ../askubuntu/text_tokenized.txt.gz --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --train ../askubuntu/train_random.txt --test ../askubuntu/dev.txt --teacher lstm_models/lstm_model3/epoch9 --student cnn --results_file distill_cnn_results.csv
+"""
+
+import os
+import sys
+import csv
+import copy
+import time
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+import torch
+from torch.optim import Adam
+import torch.nn.functional as F
+import torch.autograd as autograd
+
+import corpus
+import encoder
+from evaluation import Evaluation
+
+def new_model_dir(kind):
+    """Next free <kind>_models/<kind>_model<N> directory, as main.py numbers them.
+    """
+    root = kind + "_models"
+    if not os.path.exists(root):
+        os.makedirs(root)
+    nums = [int(d[len(kind + "_model"):]) for d in os.listdir(root) if d.startswith(kind + "_model")]
+    path = os.path.join(root, kind + "_model" + str(max(nums) + 1 if nums else 0))
+    print("creating new model " + path)
+    os.makedirs(path)
+    return path
+
+def teacher_targets(teacher_args, teacher, batches, embeddings, padding_id):
+    """The teacher's (questions x hidden size) vectors of every training batch.
+    """
+    targets = []
+    with encoder.inference():
+        for titles, bodies, triples in batches:
+            hidden = encoder.encode_batch(teacher_args, teacher, titles, bodies, embeddings, padding_id)
+            targets.append(hidden.cpu().data.numpy())
+    return targets
+
+def triple_scores(args, hidden, triples, hidden_size):
+    """Cosines of every query of triples with its candidates, as in main.py.
+    """
+    rows = torch.LongTensor(triples.ravel())
+    if args.cuda:
+        rows = rows.cuda()
+    vectors = hidden[rows]
+    vectors = vectors.view(triples.shape[0], triples.shape[1], hidden_size)
+    return F.cosine_similarity(vectors[:, 0, :].unsqueeze(1), vectors[:, 1:, :], dim=2)
+
+def distill_loss(args, hidden, target, triples):
+    if args.objective == "vectors":
+        loss = (1 - F.cosine_similarity(hidden, target, dim=1)).mean()
+    else:
+        scores = triple_scores(args, hidden, triples, args.hidden_size)
+        target_scores = triple_scores(args, target, triples, args.teacher_hidden_size)
+        loss = ((scores - target_scores) ** 2).mean()
+    if args.alpha > 0:
+        scores = triple_scores(args, hidden, triples, args.hidden_size)
+        labels = torch.zeros(triples.shape[0]).type(torch.LongTensor)
+        if args.cuda:
+            labels = labels.cuda()
+        loss = loss + args.alpha * F.multi_margin_loss(scores, autograd.Variable(labels), margin=args.margin)
+    return loss
+
+def evaluate(args, model, eval_batches, vocab_map, embeddings, padding_id):
+    """[MAP, MRR, P@1, P@5] of re-ranking the candidates of eval_batches.
+    """
+    similarities = []
+    with encoder.inference():
+        for batch in eval_batches:
+            titles, bodies, qlabels = batch
+            hidden = encoder.vectorize_question(args, batch, model, vocab_map, embeddings, padding_id)
+            cos_similarity = F.cosine_similarity(hidden[0].unsqueeze(0), hidden[1:], dim=1).cpu().data.numpy()
+            similarities.append(qlabels[np.argsort(-1*cos_similarity)])
+    evaluator = Evaluation(similarities)
+    return [evaluator.MAP(), evaluator.MRR(), evaluator.Precision(1), evaluator.Precision(5)]
+
+def throughput(args, model, questions, embeddings, padding_id):
+    """Questions encoded per second.
+    """
+    time_begin = time.time()
+    encoder.encode_questions(args, model, questions, embeddings, padding_id, args.batch_size * 10)
+    return len(questions) / (time.time() - time_begin)
+
+def main(args):
+    time1 = datetime.now()
+    raw_corpus = corpus.read_corpus(args.corpus)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    print("loaded embeddings")
+    ids_corpus = corpus.map_corpus(vocab_map, raw_corpus)
+    annotations = corpus.read_annotations(args.train)
+    training_batches = corpus.create_batches(ids_corpus, annotations, args.batch_size, padding_id)
+    eval_batches = corpus.create_eval_batches(ids_corpus, corpus.read_annotations(args.test), padding_id)
+    benchmark = [ids_corpus[id] for id in sorted(ids_corpus)[:args.throughput_questions]]
+    print("time to preprocess: " + str(datetime.now() - time1))
+
+    teacher_args = copy.copy(args)
+    teacher_args.model = "lstm"
+    teacher_args.hidden_size = args.teacher_hidden_size
+    teacher = encoder.load_model(teacher_args, args.teacher)
+    if args.objective == "vectors":
+        assert args.hidden_size == args.teacher_hidden_size, "--objective vectors needs the teacher's hidden size"
+    targets = teacher_targets(teacher_args, teacher, training_batches, embeddings, padding_id)
+    teacher_metrics = evaluate(teacher_args, teacher, eval_batches, vocab_map, embeddings, padding_id)
+    teacher_speed = throughput(teacher_args, teacher, benchmark, embeddings, padding_id)
+    print("teacher MAP: " + str(teacher_metrics[0]) + " MRR: " + str(teacher_metrics[1])
+          + " questions/s: " + str(teacher_speed))
+
+    args.model = args.student
+    student = encoder.create_model(args)
+    optimizer = Adam(student.parameters())
+    if args.save_model:
+        model_dir = new_model_dir(args.student)
+
+    with open(os.path.join(sys.path[0], args.results_file), 'a') as evaluate_file:
+        writer = csv.writer(evaluate_file, dialect='excel')
+        writer.writerow(['Model', 'Epoch', 'MAP', 'MRR', 'P@1', 'P@5', 'questions/s'])
+        writer.writerow(['teacher', ''] + teacher_metrics + [teacher_speed])
+
+    count = 1
+    total_loss = 0.0
+    for epoch in range(args.epochs):
+        print("epoch = " + str(epoch))
+        time_begin = datetime.now()
+        for (titles, bodies, triples), target in zip(training_batches, targets):
+            optimizer.zero_grad()
+            hidden = encoder.encode_batch(args, student, titles, bodies, embeddings, padding_id)
+            target = autograd.Variable(torch.from_numpy(target))
+            if args.cuda:
+                target = target.cuda()
+            loss = distill_loss(args, hidden, target, triples)
+            total_loss += float(loss.cpu().data.numpy())
+            loss.backward()
+            optimizer.step()
+            count += 1
+            if count % 100 == 0:
+                print("average loss: " + str(total_loss / float(count)))
+        print("time for epoch: " + str(datetime.now() - time_begin))
+
+        metrics = evaluate(args, student, eval_batches, vocab_map, embeddings, padding_id)
+        speed = throughput(args, student, benchmark, embeddings, padding_id)
+        print("MAP: " + str(metrics[0]) + " MRR: " + str(metrics[1]) + " P@1: " + str(metrics[2])
+              + " P@5: " + str(metrics[3]) + " questions/s: " + str(speed))
+        with open(os.path.join(sys.path[0], args.results_file), 'a') as evaluate_file:
+            writer = csv.writer(evaluate_file, dialect='excel')
+            writer.writerow([args.student, epoch] + metrics + [speed])
+
+        if args.save_model:
+            print("Saving " + args.student + " model epoch " + str(epoch) + " to " + model_dir)
+            torch.save(student.state_dict(), os.path.join(model_dir, "epoch" + str(epoch)))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--corpus",
+            type = str
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--train",
+            type = str
+        )
+    argparser.add_argument("--test",
+            type = str
+        )
+    argparser.add_argument("--teacher",
+            type = str
+        )
+    argparser.add_argument("--student",
+            type = str,
+            default = "cnn"
+        )
+    argparser.add_argument("--objective",
+            type = str,
+            default = "vectors"
+        )
+    argparser.add_argument("--alpha",
+            type = float,
+            default = 0.0
+        )
+    argparser.add_argument("--margin",
+            type = float,
+            default = 0.2
+        )
+    argparser.add_argument("--results_file",
+            type = str
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 25
+        )
+    argparser.add_argument("--epochs",
+            type = int,
+            default = 10
+        )
+    argparser.add_argument("--teacher_hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--throughput_questions",
+            type = int,
+            default = 5000
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--save_model",
+            type = int,
+            default = 1
+        )
+
+    args = argparser.parse_args()
+    main(args)
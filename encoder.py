@@ -0,0 +1,213 @@
+"""Helpers for loading a trained question encoder (LSTM, CNN or the MLP
+student of distill.py) and turning questions into vectors outside of the
+training scripts.
+
+The encoding is the same as in main.py: run the model over title and body,
+average the hidden states of each (excluding padding) and average the two.
+"""
+
+import contextlib
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.autograd as autograd
+
+import corpus
+import profiling
+
+# non-empty inside inference() on torch versions without torch.no_grad
+_VOLATILE = []
+
+@contextlib.contextmanager
+def inference():
+    """Encode without building autograd graphs: torch.no_grad, or volatile
+    Variables on torch versions that do not have it.
+    """
+    if hasattr(torch, "no_grad"):
+        with torch.no_grad():
+            yield
+    else:
+        _VOLATILE.append(True)
+        try:
+            yield
+        finally:
+            _VOLATILE.pop()
+
+class MeanEmbeddingMLP(nn.Module):
+    """Encoder without recurrence or convolution (a distill.py student): a
+    two-layer MLP over the averaged word embeddings of a title or body.
+    """
+
+    def __init__(self, embedding_size, hidden_size):
+        super(MeanEmbeddingMLP, self).__init__()
+        self.hidden = nn.Linear(embedding_size, hidden_size)
+        self.output = nn.Linear(hidden_size, hidden_size)
+
+    def forward(self, pooled):
+        return self.output(F.tanh(self.hidden(pooled)))
+
+def new_model(args):
+    """An untrained (CPU) LSTM, CNN or MLP encoder from args.model,
+    args.embedding_size and args.hidden_size.
+    """
+    if args.model == 'lstm':
+        return nn.LSTM(input_size=args.embedding_size, hidden_size=args.hidden_size)
+    elif args.model == 'mlp':
+        return MeanEmbeddingMLP(args.embedding_size, args.hidden_size)
+    return nn.Conv1d(in_channels=args.embedding_size, out_channels=args.hidden_size, kernel_size = 3, padding = 1)
+
+def create_model(args):
+    """Create an untrained encoder, on the GPU with args.cuda.
+    """
+    model = new_model(args)
+    if args.cuda:
+        model.cuda()
+    return model
+
+def load_model(args, path=None):
+    """Load an LSTM, CNN or MLP checkpoint (args.load_model unless path is given).
+    """
+    path = path or args.load_model
+    print("loading " + path)
+    model = new_model(args)
+    if args.cuda:
+        model.load_state_dict(torch.load(path))
+        model.cuda()
+    else:
+        model.load_state_dict(torch.load(path, map_location=lambda storage, loc: storage))
+    return model
+
+@profiling.timed("embedding_gather")
+def embed(args, ids, embeddings):
+    """Word embeddings of a (sequence length x questions) matrix of word ids.
+    """
+    inputs = torch.from_numpy(embeddings[ids.astype(np.int64)].astype(np.float32))
+    if args.cuda:
+        inputs = inputs.cuda()
+    if _VOLATILE:
+        return autograd.Variable(inputs, volatile=True)
+    return autograd.Variable(inputs)
+
+def run_encoder(args, model, ids, embeddings):
+    """Run the encoder over a (sequence length x questions) matrix of word ids.
+    Returns the hidden states as (sequence length x questions x hidden size).
+    """
+    length, num_questions = ids.shape
+    inputs = embed(args, ids, embeddings)
+
+    if args.model == 'lstm':
+        hidden = torch.zeros(1, num_questions, args.hidden_size)
+        cell = torch.zeros(1, num_questions, args.hidden_size)
+        if args.cuda:
+            hidden, cell = hidden.cuda(), cell.cuda()
+        out, _ = model(inputs, (autograd.Variable(hidden), autograd.Variable(cell)))
+    else:
+        out = model(inputs.transpose(0,1).transpose(1,2))
+        out = F.tanh(out)
+        out = out.transpose(1,2).transpose(0,1)
+    return out
+
+@profiling.timed("average_questions")
+def average_questions(args, hidden, ids, padding_id, eps=1e-10):
+    """Average the outputs from the hidden states of questions, excluding padding.
+    """
+    # sequence (title or body) x questions x 1
+    mask = torch.from_numpy(1 * (ids != padding_id)).type(torch.FloatTensor).unsqueeze(2)
+    if args.cuda:
+        mask = mask.cuda()
+    mask = autograd.Variable(mask)
+    # questions x hidden
+    masked_sum = torch.sum(mask * hidden, dim=0)
+
+    # questions x 1
+    lengths = torch.sum(mask, dim=0)
+
+    return masked_sum / (lengths + eps)
+
+def encode_batch(args, model, titles, bodies, embeddings, padding_id):
+    """Returns the (questions x hidden size) representation of a padded batch
+    as built by corpus.create_one_batch.
+    """
+    return (encode_sequences(args, model, titles, embeddings, padding_id)
+            + encode_sequences(args, model, bodies, embeddings, padding_id)) * 0.5
+
+def encode_sequences(args, model, ids, embeddings, padding_id):
+    """(questions x hidden size) representation of a padded (sequence length x
+    questions) matrix of titles or bodies: the hidden states averaged over
+    the words, or, for the MLP, the MLP of the averaged word embeddings.
+    """
+    if args.model == 'mlp':
+        return model(average_questions(args, embed(args, ids, embeddings), ids, padding_id))
+    return average_questions(args, run_encoder(args, model, ids, embeddings), ids, padding_id)
+
+def vectorize_question(args, batch, model, vocab_map, embeddings, padding_id):
+    """Drop-in for the vectorize_question of the training scripts: encodes a
+    (titles, bodies, _) batch.
+    """
+    titles, bodies, _ = batch
+    return encode_batch(args, model, titles, bodies, embeddings, padding_id)
+
+def encode_questions(args, model, questions, embeddings, padding_id, batch_size=256, cache=None):
+    """Encode a list of (title ids, body ids) pairs into a float32 numpy array
+    (questions x hidden size), in the order given.
+
+    Questions are sorted by length before batching so that each batch carries
+    as little padding as possible. With an EncodingCache (see cache.py), only
+    the questions missing from it are encoded.
+    """
+    vectors = np.zeros((len(questions), args.hidden_size), dtype=np.float32)
+    todo = range(len(questions))
+    if cache is not None:
+        version = cache.version
+        keys = [cache.key(title, body, version) for title, body in questions]
+        todo = []
+        for i, key in enumerate(keys):
+            vector = cache.get(key)
+            if vector is None:
+                todo.append(i)
+            else:
+                vectors[i] = vector
+    order = sorted(todo, key=lambda i: (len(questions[i][1]), len(questions[i][0])))
+    with inference():
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            titles, bodies = corpus.create_one_batch([questions[i][0] for i in rows],
+                                                     [questions[i][1] for i in rows], padding_id)
+            hidden = encode_batch(args, model, titles, bodies, embeddings, padding_id)
+            vectors[rows] = hidden.cpu().data.numpy()
+            if cache is not None:
+                for i in rows:
+                    cache.put(keys[i], vectors[i].copy())
+    return vectors
+
+def encode_titles(args, model, questions, embeddings, padding_id, batch_size=256):
+    """Title-only encoding of (title ids, body ids) pairs, as a float32 numpy
+    array (questions x hidden size). Bodies are most of the encoding cost and
+    are not run through the model; a cheap first stage for retrieval.
+    """
+    vectors = np.zeros((len(questions), args.hidden_size), dtype=np.float32)
+    order = sorted(range(len(questions)), key=lambda i: len(questions[i][0]))
+    with inference():
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            titles, _ = corpus.create_one_batch([questions[i][0] for i in rows], [np.zeros(0)] * len(rows), padding_id)
+            hidden = encode_sequences(args, model, titles, embeddings, padding_id)
+            vectors[rows] = hidden.cpu().data.numpy()
+    return vectors
+
+def bag_of_embeddings(questions, embeddings, padding_id):
+    """Averaged word embeddings of (title ids, body ids) pairs, title and body
+    averaged like encode_batch, as a float32 numpy array (questions x embedding
+    size). No model is run.
+    """
+    vectors = np.zeros((len(questions), embeddings.shape[1]), dtype=np.float32)
+    for i, (title, body) in enumerate(questions):
+        for ids in (title, body):
+            ids = np.asarray(ids, dtype=np.int64)
+            ids = ids[ids != padding_id]
+            if len(ids):
+                vectors[i] += 0.5 * embeddings[ids].mean(axis=0)
+    return vectors
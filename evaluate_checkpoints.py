@@ -0,0 +1,197 @@
+"""
+Evaluates every saved checkpoint matching a glob, loading the corpora,
+embeddings and evaluation batches only once.
+
+The batches are built in the parent process before the worker pool is
+forked, so every worker shares them and only loads its checkpoints. Each
+checkpoint gets the MAP, MRR, P@1 and P@5 of main.py on --test (AskUbuntu)
+and, with --android_corpus and --android_test, the AUC(0.05) of 2b.py.
+Results go to one CSV in the shape of lstm_results.csv / cnn_results.csv,
+with the checkpoint run and model type in front.
+
+The model type is read from the checkpoint path (lstm_models/..., cnn_models/...,
+mlp_models/...), falling back to --model; --hidden_size and --embedding_size
+apply to every checkpoint, so a glob should only match checkpoints trained with
+the given embeddings.
+
+Usage:
+python2 evaluate_checkpoints.py --checkpoints "<glob>" --corpus <gzipped corpus path> --test <test questions path> --embeddings <gzipped embeddings path> --results_file <csv path> [--android_corpus <gzipped Android corpus path> --android_test <Android test questions path>] [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] [--processes <0>] [--threads <1>] [--cuda <0 | 1>]
+
+Example Usage:
+python2 evaluate_checkpoints.py --checkpoints "lstm_models/*/epoch*" --corpus ../askubuntu/text_tokenized.txt.gz --test ../askubuntu/dev.txt --android_corpus ../Android/corpus.tsv.gz --android_test android_test.txt --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --results_file all_lstm_results.csv
+"""
+
+import os
+import re
+import sys
+import csv
+import copy
+import glob
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+import corpus
+import encoder
+from evaluation import Evaluation
+from meter import AUCMeter
+
+# set in the parent before the pool forks, read by the workers
+SHARED = {}
+
+def checkpoint_key(path):
+    """Sort key: run directory, then epoch number.
+    """
+    match = re.search(r"epoch(\d+)$", path)
+    return (os.path.dirname(path), int(match.group(1)) if match else -1)
+
+def checkpoint_args(args, path):
+    """args with the model type of the checkpoint's <type>_models directory.
+    """
+    checkpoint = copy.copy(args)
+    for kind in ("lstm", "cnn", "mlp"):
+        if kind + "_models" in path.split(os.sep):
+            checkpoint.model = kind
+    return checkpoint
+
+def cosines(args, model, batches, embeddings, padding_id):
+    """For every (titles, bodies, labels) batch, the cosines of the query with
+    its candidates as a numpy array.
+    """
+    scores = []
+    with encoder.inference():
+        for titles, bodies, _ in batches:
+            hidden = encoder.encode_batch(args, model, titles, bodies, embeddings, padding_id)
+            scores.append(F.cosine_similarity(hidden[0].unsqueeze(0), hidden[1:], dim=1).cpu().data.numpy())
+    return scores
+
+def evaluate_checkpoint(path):
+    """[run, model, epoch, MAP, MRR, P@1, P@5, (AUC), seconds] of one checkpoint.
+    """
+    args = checkpoint_args(SHARED["args"], path)
+    time_begin = time.time()
+    model = encoder.load_model(args, path)
+    model.eval()
+    embeddings = SHARED["embeddings"]
+    padding_id = SHARED["padding_id"]
+
+    batches = SHARED["eval_batches"]
+    similarities = [batch[2][np.argsort(-1 * scores)]
+                    for batch, scores in zip(batches, cosines(args, model, batches, embeddings, padding_id))]
+    evaluator = Evaluation(similarities)
+    row = [os.path.dirname(path), args.model, checkpoint_key(path)[1],
+           evaluator.MAP(), evaluator.MRR(), evaluator.Precision(1), evaluator.Precision(5)]
+
+    if SHARED["android_batches"] is not None:
+        meter = AUCMeter()
+        batches = SHARED["android_batches"]
+        for batch, scores in zip(batches, cosines(args, model, batches, embeddings, padding_id)):
+            meter.add(scores.astype(np.float64), batch[2].astype(np.int64))
+        row.append(meter.value(0.05))
+    return row + [time.time() - time_begin]
+
+def init_worker(threads):
+    torch.set_num_threads(threads)
+
+def main(args):
+    paths = sorted(glob.glob(args.checkpoints), key=checkpoint_key)
+    if not paths:
+        print("no checkpoints match " + args.checkpoints)
+        return
+    print("evaluating " + str(len(paths)) + " checkpoints")
+
+    time_begin = time.time()
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    print("loaded embeddings")
+    ids_corpus = corpus.map_corpus(vocab_map, corpus.read_corpus(args.corpus))
+    SHARED["eval_batches"] = corpus.create_eval_batches(ids_corpus, corpus.read_annotations(args.test), padding_id)
+    SHARED["android_batches"] = None
+    if args.android_corpus and args.android_test:
+        android_corpus = corpus.map_corpus(vocab_map, corpus.read_corpus(args.android_corpus))
+        SHARED["android_batches"] = corpus.create_eval_batches(android_corpus, corpus.read_annotations(args.android_test), padding_id)
+    SHARED["args"] = args
+    SHARED["embeddings"] = embeddings
+    SHARED["padding_id"] = padding_id
+    print("time to preprocess: " + ("%.1f" % (time.time() - time_begin)) + "s")
+
+    if args.cuda:
+        # CUDA does not survive a fork; evaluate in this process
+        rows = [evaluate_checkpoint(path) for path in paths]
+    else:
+        pool = multiprocessing.Pool(args.processes or multiprocessing.cpu_count(), init_worker, (args.threads,))
+        rows = pool.map(evaluate_checkpoint, paths, chunksize=1)
+        pool.close()
+        pool.join()
+
+    header = ['Run', 'Model', 'Epoch', 'MAP', 'MRR', 'P@1', 'P@5']
+    if SHARED["android_batches"] is not None:
+        header.append('AUC(0.05)')
+    with open(args.results_file, 'w') as evaluate_file:
+        writer = csv.writer(evaluate_file, dialect='excel')
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row[:-1])
+
+    print("\t".join(header + ["seconds"]))
+    for row in rows:
+        print("\t".join([str(x) if not isinstance(x, float) else "%.4f" % x for x in row]))
+    best = max(rows, key=lambda row: row[3])
+    print("best MAP: " + best[0] + " epoch " + str(best[2]))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--checkpoints",
+            type = str
+        )
+    argparser.add_argument("--corpus",
+            type = str
+        )
+    argparser.add_argument("--test",
+            type = str
+        )
+    argparser.add_argument("--android_corpus",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--android_test",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--results_file",
+            type = str
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--processes",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--threads",
+            type = int,
+            default = 1
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -1,5 +1,12 @@
 
 # helper class used for computing information retrieval metrics, including MAP / MRR / and Precision @ x
+#
+# the ranked labels of all queries are packed into one zero-padded matrix once;
+# every metric is then computed with numpy over the queries that have at least
+# one positive, and cached. Sums run in the same order as a Python loop would,
+# so the numbers are identical to the original per-query implementation.
+
+import numpy as np
 
 
 class Evaluation():
@@ -7,43 +14,89 @@ class Evaluation():
 	def __init__(self,data):
 
 		self.data = data
+		self.cache = {}
+		self.packed = None
+
+
+	def pack(self):
+		if self.packed is None:
+			lengths = np.array([len(item) for item in self.data], dtype=np.int64)
+			width = max(1, lengths.max()) if len(lengths) > 0 else 1
+			relevant = np.zeros((len(self.data), width), dtype=bool)
+			for row, item in enumerate(self.data):
+				relevant[row, :len(item)] = np.asarray(item) == 1
+			# only queries with a positive are scored
+			keep = relevant.any(axis=1)
+			relevant = relevant[keep]
+			lengths = lengths[keep]
+			# number of positives at or above each rank
+			hits = np.cumsum(relevant, axis=1)
+			self.packed = (relevant, lengths, hits)
+		return self.packed
+
+
+	def mean(self, scores):
+		# sequential sum, like sum(list)
+		return np.cumsum(scores)[-1] / len(scores) if len(scores) > 0 else 0.0
+
+
+	def cached(self, key, compute):
+		if key not in self.cache:
+			self.cache[key] = float(compute())
+		return self.cache[key]
 
 
 	def Precision(self,precision_at):
-		scores = []
-		for item in self.data:
-			temp = item[:precision_at]
-			if any(val==1 for val in item):
-				scores.append(sum([1 if val==1 else 0 for val in temp])*1.0 / len(temp) if len(temp) > 0 else 0.0)
-		return sum(scores)/len(scores) if len(scores) > 0 else 0.0
+		def compute():
+			relevant, lengths, hits = self.pack()
+			if len(lengths) == 0:
+				return 0.0
+			cutoff = np.minimum(lengths, precision_at)
+			found = hits[np.arange(len(lengths)), np.maximum(cutoff, 1) - 1]
+			return self.mean(np.where(cutoff > 0, found * 1.0 / np.maximum(cutoff, 1), 0.0))
+		return self.cached(("P", precision_at), compute)
 
 
 	def MAP(self):
-		scores = []
-		missing_MAP = 0
-		for item in self.data:
-			temp = []
-			count = 0.0
-			for i,val in enumerate(item):
-				if val == 1:
-					count += 1.0
-					temp.append(count/(i+1))
-			if len(temp) > 0:
-				scores.append(sum(temp) / len(temp))
-			else:
-				missing_MAP += 1
-		return sum(scores)/len(scores) if len(scores) > 0 else 0.0
+		def compute():
+			relevant, lengths, hits = self.pack()
+			if len(lengths) == 0:
+				return 0.0
+			ranks = np.arange(1, relevant.shape[1] + 1)
+			precisions = np.where(relevant, hits * 1.0 / ranks, 0.0)
+			return self.mean(np.cumsum(precisions, axis=1)[:, -1] / hits[:, -1])
+		return self.cached(("MAP",), compute)
 
 
 	def MRR(self):
+		def compute():
+			relevant, lengths, hits = self.pack()
+			if len(lengths) == 0:
+				return 0.0
+			return self.mean(1.0 / (np.argmax(relevant, axis=1) + 1))
+		return self.cached(("MRR",), compute)
 
-		scores = []
-		for item in self.data:
-			for i,val in enumerate(item):
-				if val == 1:
-					scores.append(1.0/(i+1))
-					break
 
-		return sum(scores)/len(scores) if len(scores) > 0 else 0.0
+	def Recall(self,recall_at):
+		# fraction of a query's positives ranked in its top recall_at
+		def compute():
+			relevant, lengths, hits = self.pack()
+			if len(lengths) == 0:
+				return 0.0
+			found = hits[:, min(recall_at, relevant.shape[1]) - 1] if recall_at > 0 else np.zeros(len(lengths))
+			return self.mean(found * 1.0 / hits[:, -1])
+		return self.cached(("R", recall_at), compute)
 
 
+	def NDCG(self,ndcg_at):
+		# binary gains, log2 discount; the ideal ranking puts all positives first
+		def compute():
+			relevant, lengths, hits = self.pack()
+			if len(lengths) == 0 or ndcg_at <= 0:
+				return 0.0
+			cutoff = min(ndcg_at, relevant.shape[1])
+			discounts = 1.0 / np.log2(np.arange(2, cutoff + 2))
+			dcg = np.cumsum(np.where(relevant[:, :cutoff], discounts, 0.0), axis=1)[:, -1]
+			ideal = np.cumsum(discounts)[np.minimum(hits[:, -1], cutoff) - 1]
+			return self.mean(dcg / ideal)
+		return self.cached(("NDCG", ndcg_at), compute)
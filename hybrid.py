@@ -0,0 +1,251 @@
+"""
+Two-stage retrieval: a sparse inverted index (TF-IDF or BM25, see lexical.py)
+returns the --depths best lexical candidates of every query from the whole
+corpus, and only those are re-ranked by the cosine of their LSTM / CNN
+encodings.
+
+For every candidate depth it reports MAP, MRR, P@1, P@5 and recall of the
+labelled similar questions over the full-corpus ranking (and, on Android, the
+AUC(0.05) of the dev/test pairs), with the mean and p95 per-query latency of
+both stages. The purely lexical ranking and, with --index, the purely neural
+ranking over the whole vector store are reported as reference rows.
+
+Candidate vectors are read from the vector store given by --index (see
+build_index.py) when there is one; otherwise they are encoded at query time.
+Queries are always encoded.
+
+Usage:
+python2 hybrid.py --dataset <askubuntu | android> --data_path <dataset directory> --embeddings <gzipped embeddings path> --load_model <model path> [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] [--depths <50,100,200,500>] [--splits <dev,test>] [--scheme <tfidf | bm25>] [--index <index directory>]
+
+Example Usage:
+python2 hybrid.py --dataset askubuntu --data_path ../askubuntu --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --load_model lstm_models/lstm_model3/epoch9 --model lstm
+python2 hybrid.py --dataset android --data_path ../Android --embeddings ../glove.pruned.txt.gz --embedding_size 300 --load_model cnn_models/cnn_model8/epoch5 --model cnn
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import corpus
+import encoder
+import lexical
+from meter import AUCMeter
+from evaluation import Evaluation
+from vector_store import VectorStore, normalize
+
+CORPUS_FILES = {"askubuntu": "text_tokenized.txt.gz", "android": "corpus.tsv.gz"}
+
+def read_eval_set(dataset, data_path, split):
+    """Returns (query id, set of similar question ids, labelled candidate ids,
+    their 0/1 labels) for every query of an evaluation split.
+    """
+    queries = []
+    if dataset == "askubuntu":
+        with open(os.path.join(data_path, split + ".txt")) as fin:
+            for line in fin:
+                pid, pos, neg = line.split("\t")[:3]
+                pos = pos.split()
+                candidates = neg.split() + [id for id in pos if id not in neg.split()]
+                queries.append((pid, set(pos), candidates, [1 if id in pos else 0 for id in candidates]))
+        return queries
+    positives = {}
+    negatives = {}
+    for labelled, name in ((positives, ".pos.txt"), (negatives, ".neg.txt")):
+        pairs, _ = corpus.load_android_pairs(os.path.join(data_path, split + name))
+        for q1, q2 in pairs:
+            labelled.setdefault(q1, []).append(q2)
+    for qid in positives:
+        if qid in negatives:
+            candidates = negatives[qid] + positives[qid]
+            queries.append((qid, set(positives[qid]), candidates,
+                            [0] * len(negatives[qid]) + [1] * len(positives[qid])))
+    return queries
+
+class NeuralScorer(object):
+    """Encodings of corpus questions, from a vector store or the encoder.
+    """
+
+    def __init__(self, args, model, ids_corpus, embeddings, padding_id, store=None):
+        self.args = args
+        self.model = model
+        self.ids_corpus = ids_corpus
+        self.embeddings = embeddings
+        self.padding_id = padding_id
+        self.store = store
+
+    def encode(self, ids):
+        return normalize(encoder.encode_questions(self.args, self.model, [self.ids_corpus[id] for id in ids],
+                                                  self.embeddings, self.padding_id))
+
+    def vectors(self, ids):
+        if self.store is not None:
+            return self.store.get(ids)
+        return self.encode(ids)
+
+    def rerank(self, qid, candidates):
+        """Returns (candidates ordered by cosine with qid, their cosines).
+        """
+        if not candidates:
+            return [], np.zeros(0)
+        scores = np.dot(self.vectors(candidates), self.encode([qid])[0])
+        order = np.argsort(-scores, kind="mergesort")
+        return [candidates[i] for i in order], scores[order]
+
+def evaluate(ranked, scores, queries, dataset):
+    """Metrics of full-corpus rankings. ranked[i] is the ranked id list of the
+    i-th query, scores[i] a {id: score} of its labelled candidates.
+
+    Every metric is averaged over all queries with labelled positives: a query
+    none of whose positives made it into its (possibly truncated) ranking
+    scores 0, so that shallow rankings are not rewarded for dropping queries.
+    """
+    labels = [np.array([1 if id in positives else 0 for id in ranking], dtype=np.int64)
+              for ranking, (_, positives, _, _) in zip(ranked, queries)]
+    evaluator = Evaluation(labels)
+    # Evaluation averages over the queries with a positive in their ranking only
+    share = (sum(1 for label in labels if label.any())
+             / float(max(1, sum(1 for _, positives, _, _ in queries if positives))))
+    recall = np.mean([len(positives & set(ranking)) / float(len(positives))
+                      for ranking, (_, positives, _, _) in zip(ranked, queries) if positives])
+    metrics = [share * evaluator.MAP(), share * evaluator.MRR(), share * evaluator.Precision(1),
+               share * evaluator.Precision(5), recall]
+    if dataset == "android":
+        meter = AUCMeter()
+        for query_scores, (_, _, candidates, candidate_labels) in zip(scores, queries):
+            meter.add(np.array([query_scores[id] for id in candidates], dtype=np.float64),
+                      np.array(candidate_labels, dtype=np.int64))
+        metrics.append(meter.value(0.05))
+    return metrics
+
+def latency(times):
+    times = np.array(times) * 1000.0
+    return [np.mean(times), np.percentile(times, 95)]
+
+def run_split(args, dataset, queries, index, texts, scorer, depths):
+    """Returns the report rows of one evaluation split.
+    """
+    max_depth = max(depths)
+    shortlists = []
+    lexical_scores = []
+    lexical_times = []
+    for qid, _, candidates, _ in queries:
+        time_begin = time.time()
+        shortlist, _ = index.search(texts[qid], max_depth, exclude=[qid])
+        lexical_times.append(time.time() - time_begin)
+        shortlists.append(shortlist)
+        lexical_scores.append(dict(zip(candidates, index.score(texts[qid], candidates))))
+
+    rows = []
+    rows.append(["lexical", max_depth] + evaluate(shortlists, lexical_scores, queries, dataset)
+                + latency(lexical_times) + [0.0, 0.0])
+
+    for depth in depths:
+        ranked = []
+        scores = []
+        rerank_times = []
+        for (qid, _, candidates, _), shortlist, query_lexical in zip(queries, shortlists, lexical_scores):
+            time_begin = time.time()
+            ranking, neural = scorer.rerank(qid, shortlist[:depth])
+            rerank_times.append(time.time() - time_begin)
+            ranked.append(ranking)
+            # candidates outside the shortlist rank below it (cosines are >= -1), in lexical order
+            query_scores = dict(zip(ranking, neural))
+            scores.append(dict((id, query_scores[id] if id in query_scores else -2.0 - 1.0 / (1.0 + query_lexical[id]))
+                               for id in candidates))
+        rows.append(["hybrid", depth] + evaluate(ranked, scores, queries, dataset)
+                    + latency(lexical_times) + latency(rerank_times))
+
+    if scorer.store is not None:
+        import search
+        ranked = []
+        scores = []
+        search_times = []
+        for qid, _, candidates, _ in queries:
+            time_begin = time.time()
+            query = scorer.encode([qid])
+            result = search.search_vectors(scorer.store, query, max_depth + 1)
+            search_times.append(time.time() - time_begin)
+            ranked.append([id for id, _ in result[0] if id != qid][:max_depth])
+            scores.append(dict(zip(candidates, np.dot(scorer.vectors(candidates), query[0]))))
+        rows.append(["neural", max_depth] + evaluate(ranked, scores, queries, dataset)
+                    + [0.0, 0.0] + latency(search_times))
+    return rows
+
+def main(args):
+    raw_corpus = corpus.read_corpus(os.path.join(args.data_path, CORPUS_FILES[args.dataset]))
+    print("loaded corpus of " + str(len(raw_corpus)) + " questions")
+    texts = dict((id, lexical.question_text(*raw_corpus[id])) for id in raw_corpus)
+    index = lexical.InvertedIndex(args.scheme).index(texts.keys(), texts.values())
+    print("built " + args.scheme + " index")
+
+    model = encoder.load_model(args)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    ids_corpus = corpus.map_corpus(vocab_map, raw_corpus)
+    store = VectorStore(args.index) if args.index else None
+    scorer = NeuralScorer(args, model, ids_corpus, embeddings, padding_id, store)
+
+    depths = [int(x) for x in args.depths.split(",")]
+    header = ["split", "ranking", "depth", "MAP", "MRR", "P@1", "P@5", "recall"]
+    if args.dataset == "android":
+        header.append("AUC(0.05)")
+    header += ["lexical ms", "lexical p95", "rerank ms", "rerank p95"]
+    print("\t".join(header))
+    for split in args.splits.split(","):
+        queries = read_eval_set(args.dataset, args.data_path, split)
+        for row in run_split(args, args.dataset, queries, index, texts, scorer, depths):
+            print("\t".join([split, row[0], str(row[1])] + ["%.4f" % x for x in row[2:]]))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--dataset",
+            type = str,
+            default = "askubuntu"
+        )
+    argparser.add_argument("--data_path",
+            type = str,
+            default = "../askubuntu"
+        )
+    argparser.add_argument("--splits",
+            type = str,
+            default = "dev,test"
+        )
+    argparser.add_argument("--depths",
+            type = str,
+            default = "50,100,200,500"
+        )
+    argparser.add_argument("--scheme",
+            type = str,
+            default = "tfidf"
+        )
+    argparser.add_argument("--index",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--load_model",
+            type = str
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
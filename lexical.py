@@ -0,0 +1,221 @@
+"""
+Sparse inverted-index scoring of questions by TF-IDF cosine or BM25, for the
+lexical baseline of 2a.py and the first stage of hybrid.py.
+
+Every term has a postings list of (document row, weight) sorted by row; a
+query is scored by walking the postings of its own terms only, so neither the
+queries nor the documents are ever turned into dense vocabulary-wide vectors.
+TF-IDF weights follow sklearn's TfidfVectorizer defaults (same tokenization,
+smoothed idf, L2-normalized rows), which gives the same AUC as 2a.py.
+
+Usage:
+python2 lexical.py --android_path <Android directory> [--scheme <tfidf | bm25>]
+python2 lexical.py --corpus <gzipped corpus path> --query_ids <id,id,...> [--scheme <tfidf | bm25>] [--k <10>]
+
+Example Usage:
+python2 lexical.py --android_path ../Android --scheme bm25
+python2 lexical.py --corpus ../askubuntu/text_tokenized.txt.gz --query_ids 262144,399541 --k 20
+"""
+
+import os
+import re
+import sys
+import math
+import argparse
+import collections
+
+import numpy as np
+
+import corpus
+from meter import AUCMeter
+
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+def tokenize(text):
+    """Same tokens as TfidfVectorizer's default analyzer.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+def question_text(title, body):
+    return " ".join(title) + " " + " ".join(body)
+
+class InvertedIndex(object):
+    """scheme is "tfidf" (cosine of smoothed TF-IDF vectors) or "bm25" (Okapi
+    BM25 with parameters k1, b).
+    """
+
+    def __init__(self, scheme="tfidf", k1=1.2, b=0.75):
+        assert scheme in ("tfidf", "bm25"), "unknown scheme " + scheme
+        self.scheme = scheme
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = None
+
+    def fit(self, texts):
+        """Vocabulary and document frequencies, from texts (by default the
+        indexed documents themselves).
+        """
+        df = collections.Counter()
+        num_docs = 0
+        for text in texts:
+            df.update(set(tokenize(text)))
+            num_docs += 1
+        self.vocabulary = dict((term, i) for i, term in enumerate(sorted(df)))
+        df = np.array([df[term] for term in sorted(df)], dtype=np.float64)
+        if self.scheme == "tfidf":
+            self.idf = np.log((1.0 + num_docs) / (1.0 + df)) + 1.0
+        else:
+            self.idf = np.log((num_docs - df + 0.5) / (df + 0.5) + 1.0)
+        return self
+
+    def term_counts(self, text):
+        counts = collections.Counter(term for term in tokenize(text) if term in self.vocabulary)
+        terms = np.array([self.vocabulary[term] for term in counts], dtype=np.int64)
+        return terms, np.array(list(counts.values()), dtype=np.float64)
+
+    def index(self, ids, texts):
+        """Build the postings of documents texts, known by ids.
+        """
+        texts = list(texts)
+        if self.vocabulary is None:
+            self.fit(texts)
+        self.ids = list(ids)
+        self.id2row = dict((id, row) for row, id in enumerate(self.ids))
+        terms, rows, tfs = [], [], []
+        lengths = np.zeros(len(texts), dtype=np.float64)
+        for row, text in enumerate(texts):
+            doc_terms, doc_tfs = self.term_counts(text)
+            terms.append(doc_terms)
+            rows.append(np.full(len(doc_terms), row, dtype=np.int64))
+            tfs.append(doc_tfs)
+            lengths[row] = doc_tfs.sum()
+        terms = np.concatenate(terms) if terms else np.zeros(0, dtype=np.int64)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        tfs = np.concatenate(tfs) if tfs else np.zeros(0)
+
+        order = np.lexsort((rows, terms))
+        terms, rows, tfs = terms[order], rows[order], tfs[order]
+        if self.scheme == "tfidf":
+            weights = tfs * self.idf[terms]
+            norms = np.sqrt(np.bincount(rows, weights ** 2, minlength=len(texts)))
+            weights /= np.maximum(norms[rows], 1e-300)
+        else:
+            average = max(lengths.mean(), 1e-10) if len(lengths) else 1.0
+            weights = self.idf[terms] * tfs * (self.k1 + 1) / (tfs + self.k1 * (1 - self.b + self.b * lengths[rows] / average))
+        self.offsets = np.searchsorted(terms, np.arange(len(self.vocabulary) + 1))
+        self.rows = rows
+        self.weights = weights
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, text):
+        """(term ids, weights) of a query text.
+        """
+        terms, tfs = self.term_counts(text)
+        if self.scheme == "tfidf":
+            weights = tfs * self.idf[terms]
+            norm = math.sqrt((weights ** 2).sum())
+            return terms, weights / norm if norm > 0 else weights
+        return terms, tfs
+
+    def postings(self, term):
+        return self.rows[self.offsets[term]:self.offsets[term + 1]], self.weights[self.offsets[term]:self.offsets[term + 1]]
+
+    def score(self, text, ids):
+        """Scores of the documents ids (which must be indexed) for a query,
+        e.g. to re-rank a given candidate list.
+        """
+        rows = np.array([self.id2row[id] for id in ids], dtype=np.int64)
+        scores = np.zeros(len(rows), dtype=np.float64)
+        for term, weight in zip(*self.query(text)):
+            posting_rows, posting_weights = self.postings(term)
+            if not len(posting_rows):
+                continue
+            positions = np.minimum(np.searchsorted(posting_rows, rows), len(posting_rows) - 1)
+            hit = posting_rows[positions] == rows
+            scores[hit] += weight * posting_weights[positions[hit]]
+        return scores
+
+    def search(self, text, k=10, exclude=()):
+        """The k best documents for a query as (ids, scores), best first, ties
+        broken by index order. Documents sharing no term with the query and
+        the ids in exclude are never returned.
+        """
+        scores = np.zeros(len(self.ids), dtype=np.float64)
+        touched = np.zeros(len(self.ids), dtype=bool)
+        for term, weight in zip(*self.query(text)):
+            posting_rows, posting_weights = self.postings(term)
+            scores[posting_rows] += weight * posting_weights
+            touched[posting_rows] = True
+        for id in exclude:
+            if id in self.id2row:
+                touched[self.id2row[id]] = False
+        rows = np.nonzero(touched)[0]
+        order = np.lexsort((rows, -scores[rows]))[:k]
+        return [self.ids[row] for row in rows[order]], scores[rows[order]]
+
+def android_auc(index, texts, pos_path, neg_path, max_fpr=0.05):
+    """AUC(max_fpr) of re-ranking the labelled Android pairs as in 2a.py.
+    """
+    positives = {}
+    negatives = {}
+    for labelled, path in ((positives, pos_path), (negatives, neg_path)):
+        pairs, _ = corpus.load_android_pairs(path)
+        for q1, q2 in pairs:
+            labelled.setdefault(q1, []).append(q2)
+    meter = AUCMeter()
+    for qid in set(positives) | set(negatives):
+        candidates = negatives.get(qid, []) + positives.get(qid, [])
+        labels = [0] * len(negatives.get(qid, [])) + [1] * len(positives.get(qid, []))
+        meter.add(index.score(texts[qid], candidates), np.array(labels, dtype=np.int64))
+    return meter.value(max_fpr)
+
+def main(args):
+    path = args.corpus or os.path.join(args.android_path, "corpus.tsv.gz")
+    raw_corpus = corpus.read_corpus(path)
+    ids = list(raw_corpus.keys())
+    texts = dict((id, question_text(*raw_corpus[id])) for id in ids)
+    index = InvertedIndex(args.scheme)
+    if args.android_path:
+        # idf over titles and bodies as separate documents, like 2a.py
+        index.fit(" ".join(part) for id in ids for part in raw_corpus[id])
+    index.index(ids, [texts[id] for id in ids])
+    print("indexed " + str(len(index)) + " questions, " + str(len(index.vocabulary)) + " terms")
+
+    if args.query_ids:
+        for qid in args.query_ids.split(","):
+            result_ids, scores = index.search(texts[qid], args.k, exclude=[qid])
+            print(qid + "\t" + " ".join(id + ":" + ("%.4f" % score) for id, score in zip(result_ids, scores)))
+    else:
+        for split in ("dev", "test"):
+            print(split + " AUC(0.05): " + str(android_auc(index, texts,
+                                                             os.path.join(args.android_path, split + ".pos.txt"),
+                                                             os.path.join(args.android_path, split + ".neg.txt"))))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--android_path",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--corpus",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--query_ids",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--scheme",
+            type = str,
+            default = "tfidf"
+        )
+    argparser.add_argument("--k",
+            type = int,
+            default = 10
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -3,7 +3,7 @@
 Question Retrieval for question answering forums.
 
 Usage:
-python2 main.py --corpus <gzipped corpus path> --embeddings <gzipped embeddings path> --train <train questions path> --dev <dev questions path> --test <test questions path> --model <lstm | cnn> --results_file <csv path> --batch_size <int batch size> --hidden_size <100> --embedding_size <200 | 300> --cuda <0 | 1>--save_model <0 | 1> --margin <float margin>
+python2 main.py --corpus <gzipped corpus path> --embeddings <gzipped embeddings path> --train <train questions path> --dev <dev questions path> --test <test questions path> --model <lstm | cnn> --results_file <csv path> --batch_size <int batch size> --hidden_size <100> --embedding_size <200 | 300> --cuda <0 | 1>--save_model <0 | 1> --margin <float margin> [--profile_file <json lines path>] [--profile-steps <a:b> [--profile_dir <profiles>]]
 
 Example Usage: 
 (LSTM)
@@ -17,6 +17,7 @@ import sys
 import os
 import argparse
 import corpus
+import profiling
 
 import numpy as np
 import csv
@@ -107,6 +108,7 @@ def main(args):
     # lstm tutorial: http://pytorch.org/tutorials/beginner/nlp/sequence_models_tutorial.html
     # lstm documentation: http://pytorch.org/docs/master/nn.html?highlight=nn%20lstm#torch.nn.LSTM
     
+    step_profiler = profiling.StepProfiler(args.profile_steps, args.profile_dir, "main_" + args.model, args.cuda)
     count = 1
     hidden_states = []
     total_loss = 0.0
@@ -114,12 +116,14 @@ def main(args):
     for epoch in range(10):
         print "epoch = " + str(epoch)
         for batch in training_batches:
+            step_profiler.begin_step()
             optimizer.zero_grad()
             if count%10 == 0:
                 print(count)
                 print "average loss: " + str((total_loss/float(count)))
                 print("time for 10 batches: " + str(datetime.now() - time_begin))
                 time_begin = datetime.now()
+            profiling.begin("forward")
             titles, bodies, triples = batch
             title_length, title_num_questions = titles.shape
             body_length, body_num_questions = bodies.shape
@@ -215,19 +219,25 @@ def main(args):
             else:
                 loss = F.multi_margin_loss(cos_similarity, targets, margin=args.margin)
             total_loss += loss.cpu().data.numpy()[0]
-            loss.backward()
+            profiling.end("forward")
+            with profiling.span("backward"):
+                loss.backward()
 
-            optimizer.step() 
+            with profiling.span("optimizer_step"):
+                optimizer.step()
+            step_profiler.end_step()
 
         result_headers = ['Epoch', 'MAP', 'MRR', 'P@1', 'P@5']
         with open(os.path.join(sys.path[0], args.results_file), 'a') as evaluate_file:
             writer = csv.writer(evaluate_file, dialect='excel')
             writer.writerow(result_headers)
 
-        if args.model == 'lstm':
-            evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, lstm, epoch)
-        else:
-            evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, cnn, epoch)
+        with profiling.span("evaluation"):
+            if args.model == 'lstm':
+                evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, lstm, epoch)
+            else:
+                evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, cnn, epoch)
+        profiling.dump(args.profile_file, epoch=epoch)
 
         if args.save_model:
             # saving the model
@@ -237,6 +247,7 @@ def main(args):
             else:
                 print "Saving cnn model epoch " + str(epoch) + " to cnn_model" + str(new_model_num)
                 torch.save(cnn.state_dict(), "cnn_models/cnn_model" + str(new_model_num) + '/' + "epoch" + str(epoch))
+    step_profiler.close()
 
 def evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, model, epoch):
     print "starting evaluation"
@@ -332,16 +343,18 @@ def evaluation(args, padding_id, ids_corpus, vocab_map, embeddings, model, epoch
         similarities.append(positive_similarity)
 
     evaluator = Evaluation(similarities)
-    metrics = [epoch, evaluator.MAP(), evaluator.MRR(), str(evaluator.Precision(1)), str(evaluator.Precision(5))]
-    print "precision at 1: " + str(evaluator.Precision(1))
-    print "precision at 5: " + str(evaluator.Precision(5))
-    print "MAP: " + str(evaluator.MAP())
-    print "MRR: " + str(evaluator.MRR())
+    MAP, MRR, precision_1, precision_5 = evaluator.MAP(), evaluator.MRR(), evaluator.Precision(1), evaluator.Precision(5)
+    metrics = [epoch, MAP, MRR, str(precision_1), str(precision_5)]
+    print "precision at 1: " + str(precision_1)
+    print "precision at 5: " + str(precision_5)
+    print "MAP: " + str(MAP)
+    print "MRR: " + str(MRR)
 
     with open(os.path.join(sys.path[0],args.results_file), 'a') as evaluate_file:
         writer = csv.writer(evaluate_file, dialect='excel')
         writer.writerow(metrics)
 
+@profiling.timed("average_questions")
 def average_questions(hidden, ids, padding_id, eps=1e-10):
     """Average the outputs from the hidden states of questions, excluding padding.
     """
@@ -414,7 +427,20 @@ if __name__ == "__main__":
             type = int,
             default = 200
         )
+    argparser.add_argument("--profile_file",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_steps", "--profile-steps",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--profile_dir",
+            type = str,
+            default = "profiles"
+        )
 
     args = argparser.parse_args()
+    profiling.enable(bool(args.profile_file))
     main(args)
     
\ No newline at end of file
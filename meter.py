@@ -35,13 +35,31 @@ class AUCMeter(Meter):
     labeled (for instance, the output of a signoid function); and (2) the `target`
     contains only values 0 (for negative examples) and 1 (for positive examples).
     """
-    def __init__(self):
+    def __init__(self, capacity=1024):
         super(AUCMeter, self).__init__()
+        self.capacity = capacity
         self.reset()
 
     def reset(self):
-        self.scores = torch.DoubleTensor(torch.DoubleStorage()).numpy()
-        self.targets = torch.LongTensor(torch.LongStorage()).numpy()
+        # amortized growable buffers; only the first self.n entries are used
+        self.score_buffer = np.zeros(self.capacity, dtype=np.float64)
+        self.target_buffer = np.zeros(self.capacity, dtype=np.int64)
+        self.n = 0
+        self.sortind = None
+
+    @property
+    def scores(self):
+        return self.score_buffer[:self.n]
+
+    @property
+    def targets(self):
+        return self.target_buffer[:self.n]
+
+    def reserve(self, size):
+        if size > len(self.score_buffer):
+            capacity = max(size, 2 * len(self.score_buffer))
+            self.score_buffer = np.concatenate([self.scores, np.zeros(capacity - self.n, dtype=np.float64)])
+            self.target_buffer = np.concatenate([self.targets, np.zeros(capacity - self.n, dtype=np.int64)])
 
     def add(self, output, target):
         if torch.is_tensor(output):
@@ -59,44 +77,51 @@ class AUCMeter(Meter):
         assert np.all(np.add(np.equal(target, 1), np.equal(target, 0))), \
             'targets should be binary (0, 1)'
 
-        self.scores = np.append(self.scores, output)
-        self.targets = np.append(self.targets, target)
+        self.reserve(self.n + output.shape[0])
+        self.score_buffer[self.n:self.n + output.shape[0]] = output
+        self.target_buffer[self.n:self.n + output.shape[0]] = target
+        self.n += output.shape[0]
         self.sortind = None
 
+    def merge(self, other):
+        """Add everything accumulated by another AUCMeter (e.g. one per worker).
+        """
+        self.reserve(self.n + other.n)
+        self.score_buffer[self.n:self.n + other.n] = other.scores
+        self.target_buffer[self.n:self.n + other.n] = other.targets
+        self.n += other.n
+        self.sortind = None
 
     def value(self, max_fpr=1.0):
         assert max_fpr > 0
 
         # case when number of elements added are 0
-        if self.scores.shape[0] == 0:
+        if self.n == 0:
             return 0.5
 
         # sorting the arrays
         if self.sortind is None:
-            scores, sortind = torch.sort(torch.from_numpy(self.scores), dim=0, descending=True)
+            scores, sortind = torch.sort(torch.from_numpy(self.scores.copy()), dim=0, descending=True)
             scores = scores.numpy()
             self.sortind = sortind.numpy()
         else:
             scores, sortind = self.scores, self.sortind
 
         # creating the roc curve
+        positive = self.targets[self.sortind] == 1
         tpr = np.zeros(shape=(scores.size + 1), dtype=np.float64)
         fpr = np.zeros(shape=(scores.size + 1), dtype=np.float64)
-
-        for i in range(1, scores.size + 1):
-            if self.targets[sortind[i - 1]] == 1:
-                tpr[i] = tpr[i - 1] + 1
-                fpr[i] = fpr[i - 1]
-            else:
-                tpr[i] = tpr[i - 1]
-                fpr[i] = fpr[i - 1] + 1
+        tpr[1:] = np.cumsum(positive)
+        fpr[1:] = np.cumsum(~positive)
 
         tpr /= (self.targets.sum() * 1.0)
         fpr /= ((self.targets - 1.0).sum() * -1.0)
 
-        for n in range(1, scores.size + 1):
-            if fpr[n] >= max_fpr:
-                break
+        # first n >= 1 with fpr[n] >= max_fpr, or the last point
+        if fpr[-1] >= max_fpr:
+            n = min(int(np.searchsorted(fpr[1:], max_fpr, side='left')) + 1, scores.size)
+        else:
+            n = scores.size
 
         # calculating area under curve using trapezoidal rule
         #n = tpr.shape[0]
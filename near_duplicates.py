@@ -0,0 +1,397 @@
+"""
+Offline detection of near-duplicate questions across a whole corpus.
+
+Neural variant (default): every question is encoded into a vector store (see
+build_index.py; an existing --index is reused) and bucketed by random-hyperplane
+LSH: --tables hash tables, each keyed by the signs of --bits random
+projections. Lexical variant (--method minhash): questions are bucketed by
+MinHash banding over the crc32 ids of their tokens, --tables bands of --bits
+hashes each.
+
+Every pair sharing a bucket in any table is verified exactly (cosine of the
+question vectors, or cosine of the binary token sets for minhash), and the
+pairs scoring at least --threshold are written to --output as "id id" lines,
+like dev.pos.txt.
+
+Signatures are computed block by block and kept in memory-mapped files under
+--work_dir (a temporary directory, removed at the end, unless given), and
+tables are verified in parallel worker processes, so only one bucket of
+vectors is in memory per worker. A bucket larger than --max_bucket is split
+again by the keys of the other tables; rows whose keys agree in every table
+(such as exact duplicates) are verified tile by tile, once.
+
+Usage:
+python2 near_duplicates.py --index <index directory> --output <pairs path> [--threshold <0.9>] [--tables <8>] [--bits <16>] [--num_workers <cores>]
+python2 near_duplicates.py --corpus <gzipped corpus path> --embeddings <gzipped embeddings path> --load_model <model path> --index <new index directory> --output <pairs path> [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>]
+python2 near_duplicates.py --method minhash --corpus <gzipped corpus path> --output <pairs path> [--threshold <0.8>] [--tables <16>] [--bits <4>]
+
+Example Usage:
+python2 near_duplicates.py --index indexes/askubuntu_lstm3 --output askubuntu_duplicates.txt --threshold 0.95
+python2 near_duplicates.py --method minhash --corpus ../Android/corpus.tsv.gz --output android_duplicates.txt --threshold 0.8 --tables 16 --bits 4
+"""
+
+import os
+import sys
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import collections
+import multiprocessing
+
+import numpy as np
+
+import corpus
+from vector_store import VectorStore
+
+PRIME = (1 << 31) - 1
+
+# resources opened once per worker process by init_worker
+WORKER = {}
+
+def hyperplane_keys(store, tables, bits, path, seed=1, block_size=65536):
+    """(rows x tables) uint64 memmap of random-hyperplane LSH keys.
+    """
+    assert bits <= 64, "at most 64 bits per table"
+    planes = np.random.RandomState(seed).randn(store.dim, tables * bits).astype(np.float32)
+    powers = (np.uint64(1) << np.arange(bits, dtype=np.uint64))
+    keys = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint64, shape=(len(store), tables))
+    for offset, block in store.blocks(block_size):
+        signs = (np.dot(np.asarray(block), planes) > 0).reshape(len(block), tables, bits)
+        keys[offset:offset + len(block)] = (signs * powers).sum(axis=2, dtype=np.uint64)
+    keys.flush()
+    return keys
+
+def token_ids(title, body):
+    """Sorted unique crc32 ids of the tokens of a question.
+    """
+    tokens = set(title) | set(body)
+    return np.unique(np.array([zlib.crc32(token.encode("utf-8") if not isinstance(token, bytes) else token) & 0xffffffff
+                               for token in tokens], dtype=np.int64))
+
+def minhash(chunk):
+    """MinHash signatures (len(chunk) x hashes) of the token id arrays of chunk,
+    with the (a, b) hash coefficients in WORKER.
+    """
+    a, b = WORKER["coefficients"]
+    signatures = np.full((len(chunk), len(a)), PRIME, dtype=np.int64)
+    for i, tokens in enumerate(chunk):
+        if len(tokens):
+            signatures[i] = ((np.outer(a, tokens % PRIME) + b[:, None]) % PRIME).min(axis=1)
+    return signatures
+
+def band_keys(signatures, tables, bits):
+    """One key per band of bits consecutive MinHash values.
+    """
+    bands = signatures.reshape(len(signatures), tables, bits).astype(np.uint64)
+    keys = np.zeros((len(signatures), tables), dtype=np.uint64)
+    for j in range(bits):
+        # FNV-style mixing of the band's values, wrapping around 2^64
+        keys = (keys * np.uint64(1099511628211)) ^ bands[:, :, j]
+    return keys
+
+def open_keys(path, tables):
+    """(rows x tables) uint64 keys of hyperplane_keys (.npy) or minhash_keys (raw).
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    if not os.path.getsize(path):
+        return np.zeros((0, tables), dtype=np.uint64)
+    return np.memmap(path, dtype=np.uint64, mode="r").reshape(-1, tables)
+
+def minhash_keys(path, tables, bits, work_dir, pool, seed=1, chunk_size=10000, window=4):
+    """Streams the corpus at path and returns (ids, (rows x tables) uint64
+    memmap of band keys, flat memmap of token ids, row offsets into it).
+    At most window chunks are hashed or waiting to be written at a time.
+    """
+    ids = []
+    lengths = []
+    pending = collections.deque()
+    tokens_path = os.path.join(work_dir, "tokens.bin")
+    keys_path = os.path.join(work_dir, "keys.bin")
+    with open(tokens_path, "wb") as tokens_file, open(keys_path, "wb") as keys_file:
+
+        def write_keys(limit):
+            # in corpus order, oldest chunk first
+            while len(pending) > limit:
+                band_keys(pending.popleft().get(), tables, bits).tofile(keys_file)
+
+        chunk = []
+        for id, title, body in corpus.iter_corpus(path):
+            tokens = token_ids(title, body)
+            ids.append(id)
+            lengths.append(len(tokens))
+            tokens.tofile(tokens_file)
+            chunk.append(tokens)
+            if len(chunk) == chunk_size:
+                pending.append(pool.apply_async(minhash, (chunk,)))
+                chunk = []
+                write_keys(window)
+        if chunk:
+            pending.append(pool.apply_async(minhash, (chunk,)))
+        write_keys(0)
+    keys = open_keys(keys_path, tables)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    tokens = np.memmap(tokens_path, dtype=np.int64, mode="r") if offsets[-1] else np.zeros(0, dtype=np.int64)
+    return ids, keys, tokens, offsets
+
+def init_worker(resources):
+    WORKER.clear()
+    WORKER.update(resources)
+    if "index" in resources:
+        WORKER["store"] = VectorStore(resources["index"])
+    if "keys" in resources:
+        WORKER["keys"] = open_keys(resources["keys"], resources["tables"])
+    if "tokens" in resources and os.path.getsize(resources["tokens"]):
+        WORKER["tokens"] = np.memmap(resources["tokens"], dtype=np.int64, mode="r")
+
+def group(rows, keys):
+    """Splits rows (ascending) into the arrays of at least two rows sharing a
+    key, each ascending.
+    """
+    order = np.argsort(keys, kind="mergesort")
+    rows, keys = rows[order], keys[order]
+    bounds = np.concatenate([[0], np.nonzero(keys[1:] != keys[:-1])[0] + 1, [len(keys)]])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end - start > 1:
+            yield rows[start:end]
+
+def buckets(keys, table, live, max_bucket, oversized):
+    """Yields the arrays of (live) rows sharing a key of table, at most
+    max_bucket rows each. A larger bucket is split again by the keys of the
+    next tables in turn; rows still sharing a bucket larger than max_bucket
+    after all tables (their keys agree in every table) are appended to
+    oversized instead.
+    """
+    tables = keys.shape[1]
+    rows = np.nonzero(live)[0]
+    stack = [(bucket, 1) for bucket in group(rows, np.asarray(keys[rows, table]))]
+    while stack:
+        rows, depth = stack.pop()
+        if len(rows) <= max_bucket:
+            yield rows
+        elif depth == tables:
+            oversized.append(rows)
+        else:
+            next_table = (table + depth) % tables
+            stack.extend((bucket, depth + 1) for bucket in group(rows, np.asarray(keys[rows, next_table])))
+
+def vector_pairs(rows, threshold, others=None):
+    """(row, row, cosine) of the pairs of rows, or of rows with others, scoring
+    at least threshold.
+    """
+    vectors = WORKER["store"].rows(rows)
+    if others is None:
+        scores = np.dot(vectors, vectors.T)
+        i, j = np.nonzero(np.triu(scores >= threshold, 1))
+        return rows[i], rows[j], scores[i, j]
+    scores = np.dot(vectors, WORKER["store"].rows(others).T)
+    i, j = np.nonzero(scores >= threshold)
+    return rows[i], others[j], scores[i, j]
+
+def token_pairs(rows, threshold, others=None):
+    tokens, offsets = WORKER["tokens"], WORKER["offsets"]
+    sets = [tokens[offsets[row]:offsets[row + 1]] for row in rows]
+    other_sets = sets if others is None else [tokens[offsets[row]:offsets[row + 1]] for row in others]
+    first, second, scores = [], [], []
+    for i in range(len(rows)):
+        for j in (range(i + 1, len(rows)) if others is None else range(len(others))):
+            if not len(sets[i]) or not len(other_sets[j]):
+                continue
+            score = (len(np.intersect1d(sets[i], other_sets[j], assume_unique=True))
+                     / np.sqrt(len(sets[i]) * len(other_sets[j])))
+            if score >= threshold:
+                first.append(rows[i])
+                second.append(rows[j] if others is None else others[j])
+                scores.append(score)
+    return np.array(first, dtype=np.int64), np.array(second, dtype=np.int64), np.array(scores)
+
+def tiled_pairs(rows, verify, threshold, size):
+    """verify over size x size tiles of a bucket too large to verify at once.
+    """
+    for start in range(0, len(rows), size):
+        yield verify(rows[start:start + size], threshold)
+        for other in range(start + size, len(rows), size):
+            yield verify(rows[start:start + size], threshold, rows[other:other + size])
+
+def table_pairs(table):
+    """Verified (row, row, score) pairs of one LSH table, the number of
+    candidate pairs checked and the number of rows in buckets that could not
+    be split below max_bucket. Those buckets are the same in every table and
+    are verified (tile by tile) in table 0 only.
+    """
+    keys = WORKER["keys"]
+    live = WORKER["store"].live if "store" in WORKER else np.ones(len(keys), dtype=bool)
+    verify = vector_pairs if "store" in WORKER else token_pairs
+    threshold = WORKER["threshold"]
+    pairs = {}
+    candidates = 0
+    oversized = []
+    for rows in buckets(keys, table, live, WORKER["max_bucket"], oversized):
+        candidates += len(rows) * (len(rows) - 1) // 2
+        for i, j, score in zip(*verify(rows, threshold)):
+            pairs[(int(i), int(j))] = float(score)
+    if table == 0:
+        for rows in oversized:
+            candidates += len(rows) * (len(rows) - 1) // 2
+            for tile in tiled_pairs(rows, verify, threshold, WORKER["max_bucket"]):
+                for i, j, score in zip(*tile):
+                    pairs[(int(i), int(j))] = float(score)
+    return pairs, candidates, sum(len(rows) for rows in oversized)
+
+def find_duplicates(resources, tables, num_workers):
+    """Returns ({(row, row): score} of all verified pairs, candidate pairs
+    checked, rows in buckets that had to be verified tile by tile).
+    """
+    pool = multiprocessing.Pool(num_workers, init_worker, (resources,))
+    pairs = {}
+    candidates = 0
+    oversized = 0
+    try:
+        for table_result, table_candidates, table_oversized in pool.imap_unordered(table_pairs, range(tables)):
+            pairs.update(table_result)
+            candidates += table_candidates
+            oversized = max(oversized, table_oversized)
+    finally:
+        pool.close()
+        pool.join()
+    return pairs, candidates, oversized
+
+def encode_corpus(args):
+    """Encode args.corpus into the vector store args.index (resuming an
+    interrupted build), as build_index.py does.
+    """
+    import torch
+    import encoder
+    import build_index
+    torch.set_num_threads(args.num_workers or multiprocessing.cpu_count())
+    model = encoder.load_model(args)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    store = build_index.open_index(args.index, args)
+    build_index.build_index(args, store, model, vocab_map, embeddings, padding_id)
+    return store
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="near_duplicates")
+    try:
+        find(args, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def find(args, work_dir):
+    num_workers = args.num_workers or multiprocessing.cpu_count()
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    time_begin = time.time()
+    if args.method == "minhash":
+        pool = multiprocessing.Pool(num_workers, init_worker,
+                                    ({"coefficients": np.random.RandomState(args.seed).randint(1, PRIME, size=(2, args.tables * args.bits))},))
+        try:
+            ids, keys, tokens, offsets = minhash_keys(args.corpus, args.tables, args.bits, work_dir, pool, args.seed,
+                                                      window=2 * num_workers)
+        finally:
+            pool.close()
+            pool.join()
+        resources = {"keys": os.path.join(work_dir, "keys.bin"), "tokens": os.path.join(work_dir, "tokens.bin"),
+                     "offsets": offsets}
+    else:
+        if args.corpus:
+            store = encode_corpus(args)
+        else:
+            store = VectorStore(args.index)
+        ids = store.ids
+        hyperplane_keys(store, args.tables, args.bits, os.path.join(work_dir, "keys.npy"), args.seed)
+        resources = {"keys": os.path.join(work_dir, "keys.npy"), "index": args.index}
+    print("hashed " + str(len(ids)) + " questions in " + ("%.1f" % (time.time() - time_begin)) + "s")
+
+    resources.update({"threshold": args.threshold, "max_bucket": args.max_bucket, "tables": args.tables})
+    pairs, candidates, oversized = find_duplicates(resources, args.tables, num_workers)
+    with open(args.output, "w") as fout:
+        for i, j in sorted(pairs):
+            fout.write(ids[i] + " " + ids[j] + "\n")
+    print("verified " + str(candidates) + " candidate pairs, wrote " + str(len(pairs)) + " pairs to "
+          + args.output + " in " + ("%.1f" % (time.time() - time_begin)) + "s")
+    if oversized:
+        print(str(oversized) + " questions with the same keys in every table were in buckets larger than "
+              + "--max_bucket " + str(args.max_bucket) + " and verified tile by tile")
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--method",
+            type = str,
+            default = "hyperplane"
+        )
+    argparser.add_argument("--index",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--corpus",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--output",
+            type = str
+        )
+    argparser.add_argument("--threshold",
+            type = float,
+            default = 0.9
+        )
+    argparser.add_argument("--tables",
+            type = int,
+            default = 8
+        )
+    argparser.add_argument("--bits",
+            type = int,
+            default = 16
+        )
+    argparser.add_argument("--max_bucket",
+            type = int,
+            default = 1000
+        )
+    argparser.add_argument("--seed",
+            type = int,
+            default = 1
+        )
+    argparser.add_argument("--num_workers",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--work_dir",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--load_model",
+            type = str
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 512
+        )
+    argparser.add_argument("--chunk_size",
+            type = int,
+            default = 50000
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,235 @@
+"""Lightweight wall-clock timing of named stages (spans), for seeing where the
+time of a run goes without attaching a profiler.
+
+Spans are recorded process-wide, so the helpers in corpus.py and encoder.py
+time themselves whichever script calls them:
+
+    corpus_read       corpus.read_corpus
+    embedding_load    corpus.load_embeddings (reading the embeddings file)
+    id_mapping        corpus.map_corpus
+    batch_build       corpus.create_batches, create_eval_batches, domain_classifier_batch
+    embedding_gather  corpus.get_embeddings, encoder.embed
+
+and the training scripts add forward, backward, optimizer_step and evaluation.
+With --cuda, forward and backward time the kernel launches, not the GPU work.
+
+Durations are only kept once enable() has been called, which the scripts do
+for --profile_file, so that long-running processes that import these helpers
+(server.py, shard.py workers, build_index.py, ...) do not accumulate them.
+A script run with --profile_file <path> appends one JSON line per span to it
+(at the end of every epoch for the training scripts, cumulative), e.g.
+
+    {"script": "main.py", "epoch": 0, "span": "forward", "count": 640, "total_s": 95.1,
+     "mean_ms": 148.6, "p50_ms": 131.2, "p95_ms": 290.4, "max_ms": 512.9}
+
+With --profile_steps a:b the same scripts also capture an operator-level torch
+profile of those steps (StepProfiler), written to --profile_dir.
+
+From Python:
+    with profiling.span("forward"):
+        ...
+    profiling.begin("forward"); ...; profiling.end("forward")
+    @profiling.timed("id_mapping")
+    def map_corpus(...): ...
+"""
+
+import os
+import sys
+import json
+import time
+import array
+import functools
+import collections
+
+import numpy as np
+
+# span name -> durations in seconds
+DURATIONS = collections.defaultdict(lambda: array.array("d"))
+_STARTED = {}
+# the StepProfiler currently recording, if any
+RECORDING = []
+# non-empty once enable() has been called
+ENABLED = []
+
+def enable(on=True):
+    """Start (or, with on False, stop) keeping span durations.
+    """
+    del ENABLED[:]
+    if on:
+        ENABLED.append(True)
+
+def _label(name):
+    """While a StepProfiler records, open a torch profiler range named name so
+    that the span shows up in its trace and operator table.
+    """
+    if not RECORDING:
+        return None
+    try:
+        from torch.autograd.profiler import record_function
+    except ImportError:
+        return None
+    label = record_function(name)
+    label.__enter__()
+    return label
+
+def _close(label):
+    if label is not None:
+        label.__exit__(None, None, None)
+
+def record(name, seconds):
+    if ENABLED:
+        DURATIONS[name].append(seconds)
+
+def begin(name):
+    _STARTED[name] = (time.time(), _label(name))
+
+def end(name):
+    time_begin, label = _STARTED.pop(name)
+    _close(label)
+    record(name, time.time() - time_begin)
+
+class span(object):
+    """Context manager recording the time spent in its block under name.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.label = _label(self.name)
+        self.time_begin = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _close(self.label)
+        record(self.name, time.time() - self.time_begin)
+        return False
+
+def timed(name):
+    """Decorator recording every call of a function under name.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED and not RECORDING:
+                return function(*args, **kwargs)
+            label = _label(name)
+            time_begin = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _close(label)
+                record(name, time.time() - time_begin)
+        return wrapper
+    return decorate
+
+class StepProfiler(object):
+    """Operator-level torch profile of steps a to b - 1 of a loop, for
+    --profile_steps a:b. Steps are counted by begin_step from 0 across epochs.
+
+    Uses torch.profiler (with memory tracking) when available, otherwise
+    torch.autograd.profiler. When the last step ends, a Chrome trace
+    (<name>_steps<a>-<b>.trace.json, open in chrome://tracing) and the
+    operator tables sorted by time and by memory (<name>_steps<a>-<b>.ops.txt)
+    are written to results_dir. Spans of this module appear as labelled ranges.
+    """
+
+    def __init__(self, steps, results_dir, name, cuda=False):
+        self.first, self.last = [int(x) for x in steps.split(":")] if steps else (-1, -1)
+        self.results_dir = results_dir
+        self.name = name
+        self.cuda = cuda
+        self.step = -1
+        self.profiler = None
+
+    def begin_step(self):
+        self.step += 1
+        if self.step == self.first and self.first < self.last:
+            self.start()
+
+    def end_step(self):
+        if self.profiler is not None and self.step >= self.last - 1:
+            self.stop()
+
+    def close(self):
+        """Stop and export early if the loop ended before step b."""
+        if self.profiler is not None:
+            self.stop()
+
+    def start(self):
+        try:
+            from torch.profiler import profile, ProfilerActivity
+            activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if self.cuda else [])
+            self.profiler = profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.memory = True
+        except ImportError:
+            from torch.autograd.profiler import profile
+            try:
+                self.profiler = profile(use_cuda=bool(self.cuda), record_shapes=True, profile_memory=True)
+                self.memory = True
+            except TypeError:
+                self.profiler = profile(use_cuda=bool(self.cuda))
+                self.memory = False
+        self.profiler.__enter__()
+        RECORDING.append(self)
+        print("profiling steps " + str(self.first) + " to " + str(self.last - 1))
+
+    def stop(self):
+        self.profiler.__exit__(None, None, None)
+        RECORDING.remove(self)
+        if not os.path.exists(self.results_dir):
+            os.makedirs(self.results_dir)
+        prefix = os.path.join(self.results_dir, self.name + "_steps" + str(self.first) + "-" + str(self.step + 1))
+        self.profiler.export_chrome_trace(prefix + ".trace.json")
+
+        device = "cuda" if self.cuda else "cpu"
+        sort_keys = ["self_" + device + "_time_total", device + "_time_total"]
+        if self.memory:
+            sort_keys.append("self_" + device + "_memory_usage")
+        averages = self.profiler.key_averages()
+        with open(prefix + ".ops.txt", "w") as fout:
+            for sort_by in sort_keys:
+                try:
+                    try:
+                        table = averages.table(sort_by=sort_by, row_limit=50)
+                    except TypeError:
+                        # older torch: no row_limit
+                        table = averages.table(sort_by=sort_by)
+                except (AttributeError, KeyError):
+                    # sort key unknown to this torch version
+                    continue
+                fout.write("sorted by " + sort_by + "\n" + table + "\n\n")
+        print("wrote " + prefix + ".trace.json and " + prefix + ".ops.txt")
+        self.profiler = None
+
+def summary():
+    """One dict per span, in order of total time: count, total_s, mean_ms,
+    p50_ms, p95_ms and max_ms.
+    """
+    rows = []
+    for name, durations in DURATIONS.items():
+        if not len(durations):
+            continue
+        ms = np.array(durations, dtype=np.float64) * 1000.0
+        rows.append(collections.OrderedDict([
+            ("span", name), ("count", len(ms)), ("total_s", round(float(ms.sum()) / 1000.0, 6)),
+            ("mean_ms", round(float(ms.mean()), 4)), ("p50_ms", round(float(np.percentile(ms, 50)), 4)),
+            ("p95_ms", round(float(np.percentile(ms, 95)), 4)), ("max_ms", round(float(ms.max()), 4))]))
+    return sorted(rows, key=lambda row: -row["total_s"])
+
+def dump(path, **fields):
+    """Append the summary to path as JSON lines, each with the script name and
+    fields (e.g. epoch=3). Does nothing when path is empty.
+    """
+    if not path:
+        return
+    with open(path, "a") as fout:
+        for row in summary():
+            line = collections.OrderedDict([("script", os.path.basename(sys.argv[0]))])
+            line.update(sorted(fields.items()))
+            line.update(row)
+            fout.write(json.dumps(line) + "\n")
+
+def reset():
+    DURATIONS.clear()
+    _STARTED.clear()
@@ -0,0 +1,265 @@
+"""
+Compressed copies of the question vectors of a VectorStore (see
+build_index.py), so that a serving replica does not need to hold the full
+float32 matrix in memory.
+
+PQStore uses product quantization: each vector is cut into m sub-vectors and
+each sub-vector is replaced by the 1-byte id of its closest centroid. Int8Store
+quantizes every dimension to 8 bits with a per-dimension scale. Both search with
+asymmetric distance computation (the query stays uncompressed) and can
+optionally re-score a shortlist of the best compressed matches exactly against
+the memory-mapped float32 vectors.
+
+Usage:
+python2 quantize.py --index <index directory> --build [--type <pq | int8>] [--m <dim / 4>]
+python2 quantize.py --index <index directory> --benchmark [--type <pq | int8>] [--rescore <0,50,100>] [--num_queries <1000>] [--k <10>]
+
+Example Usage:
+python2 quantize.py --index indexes/askubuntu_lstm3 --build --type pq --m 25
+python2 quantize.py --index indexes/askubuntu_lstm3 --benchmark --type pq --rescore 0,100
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import ann
+import search
+from vector_store import VectorStore, normalize
+
+class CompressedStore(object):
+    """Search over compressed codes. Subclasses implement encode(block), the
+    codes of a block of vectors, and scores(query), the approximate cosine of
+    the query with every stored vector. segments are the store segments the
+    codes cover (see refresh).
+    """
+
+    def __init__(self, store, codes, segments):
+        self.store = store
+        self.codes = codes
+        self.segments = list(segments)
+
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def encode_rows(self, start=0, block_size=65536):
+        codes = [self.codes[:0]]
+        for offset, block in self.store.blocks(block_size):
+            if offset + len(block) > start:
+                codes.append(self.encode(block[max(0, start - offset):]))
+        return np.concatenate(codes)
+
+    def refresh(self):
+        """Encode the rows appended to the store since the last refresh (all
+        rows, with the same codebooks, after store.compact()). Rows that are no
+        longer live are skipped at search time.
+        """
+        start = self.store.rows_since(self.segments)
+        if start is None:
+            self.codes = self.encode_rows(0)
+        else:
+            self.codes = np.concatenate([self.codes[:start], self.encode_rows(start)])
+        self.segments = self.store.segment_list()
+
+    def search(self, queries, k=10, rescore=0):
+        """Returns, for every row of queries, k (question id, score) pairs, best
+        first. With rescore > k, the best rescore compressed matches are scored
+        again exactly and the scores returned are exact cosines.
+        """
+        if self.store.rows_since(self.segments) is None:
+            # the store was compacted since the codes were saved
+            self.refresh()
+        queries = normalize(np.atleast_2d(queries))
+        rows = np.arange(len(self.codes))
+        live = self.store.live[:len(self.codes)]
+        results = []
+        for query in queries:
+            scores = self.scores(query)
+            scores[~live] = -np.inf
+            top_rows, scores = ann.top_k(scores, rows, max(k, rescore))
+            top_rows = top_rows[np.isfinite(scores)]
+            scores = scores[np.isfinite(scores)]
+            if rescore > k:
+                exact = np.array([np.dot(self.store.row(row), query) for row in top_rows], dtype=np.float32)
+                top_rows, scores = ann.top_k(exact, top_rows, k)
+            results.append([(self.store.ids[row], float(score)) for row, score in zip(top_rows[:k], scores[:k])])
+        return results
+
+class PQStore(CompressedStore):
+    FILE = "pq.npz"
+
+    def __init__(self, store, codebooks, codes, segments):
+        super(PQStore, self).__init__(store, codes, segments)
+        # m x 256 x sub-vector size
+        self.codebooks = codebooks
+
+    @staticmethod
+    def split(vectors, m):
+        """(N x dim) -> (m x N x dim/m), zero-padding dim up to a multiple of m.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        padding = (-vectors.shape[1]) % m
+        if padding:
+            vectors = np.hstack([vectors, np.zeros((len(vectors), padding), dtype=np.float32)])
+        return vectors.reshape(len(vectors), m, -1).transpose(1, 0, 2)
+
+    @staticmethod
+    def build(store, m=0, iterations=10):
+        m = m or max(1, store.dim // 4)
+        sub_vectors = PQStore.split(store.to_array()[store.live], m)
+        codebooks = np.stack([ann.kmeans(sub, 256, iterations, spherical=False) for sub in sub_vectors])
+        compressed = PQStore(store, codebooks, np.zeros((0, m), dtype=np.uint8), [])
+        compressed.refresh()
+        return compressed
+
+    def encode(self, block):
+        codes = np.zeros((len(block), len(self.codebooks)), dtype=np.uint8)
+        for j, sub in enumerate(self.split(block, len(self.codebooks))):
+            codes[:, j] = ann.assign(sub, self.codebooks[j], spherical=False)
+        return codes
+
+    def save(self, path=None):
+        np.savez(path or os.path.join(self.store.path, self.FILE), codebooks=self.codebooks, codes=self.codes,
+                 segments=np.array(self.segments, dtype=str))
+
+    @staticmethod
+    def load(store, path=None):
+        data = np.load(path or os.path.join(store.path, PQStore.FILE))
+        return PQStore(store, data["codebooks"], data["codes"], [str(x) for x in data["segments"]])
+
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def scores(self, query):
+        # m x 256 lookup table of sub-vector inner products
+        table = np.einsum("mkd,md->mk", self.codebooks, self.split(query[None, :], len(self.codebooks))[:, 0, :])
+        scores = np.zeros(len(self.codes), dtype=np.float32)
+        for j in range(len(table)):
+            scores += table[j][self.codes[:, j]]
+        return scores
+
+class Int8Store(CompressedStore):
+    FILE = "int8.npz"
+
+    def __init__(self, store, minimum, scale, codes, segments):
+        super(Int8Store, self).__init__(store, codes, segments)
+        self.minimum = minimum
+        self.scale = scale
+
+    @staticmethod
+    def build(store, block_size=65536):
+        minimum = np.full(store.dim, np.inf, dtype=np.float32)
+        maximum = np.full(store.dim, -np.inf, dtype=np.float32)
+        for _, block in store.blocks(block_size):
+            minimum = np.minimum(minimum, block.min(axis=0))
+            maximum = np.maximum(maximum, block.max(axis=0))
+        scale = np.maximum(maximum - minimum, 1e-10) / 255.0
+        compressed = Int8Store(store, minimum, scale, np.zeros((0, store.dim), dtype=np.uint8), [])
+        compressed.refresh()
+        return compressed
+
+    def encode(self, block):
+        # vectors appended later may fall outside the range seen at build time
+        return np.clip(np.round((block - self.minimum) / self.scale), 0, 255).astype(np.uint8)
+
+    def save(self, path=None):
+        np.savez(path or os.path.join(self.store.path, self.FILE), minimum=self.minimum, scale=self.scale,
+                 codes=self.codes, segments=np.array(self.segments, dtype=str))
+
+    @staticmethod
+    def load(store, path=None):
+        data = np.load(path or os.path.join(store.path, Int8Store.FILE))
+        return Int8Store(store, data["minimum"], data["scale"], data["codes"], [str(x) for x in data["segments"]])
+
+    def scores(self, query, block_size=65536):
+        # (code * scale + minimum) . query = code . (scale * query) + minimum . query
+        scaled = (self.scale * query).astype(np.float32)
+        scores = np.zeros(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), block_size):
+            scores[start:start + block_size] = np.dot(self.codes[start:start + block_size].astype(np.float32), scaled)
+        return scores + np.dot(self.minimum, query)
+
+STORE_TYPES = {"pq": PQStore, "int8": Int8Store}
+
+def benchmark(compressed, store, qids, k=10, rescores=(0,)):
+    """Returns (rescore depth, recall@k against exact search, queries per
+    second) for every rescore depth, querying with the stored vectors of the
+    questions qids. A query's own question is left out of both result lists
+    (the compressed store is searched for k + 1), so that it does not count
+    as a hit.
+    """
+    queries = store.get(qids)
+    exact = search.search_ids(store, qids, k)
+    exact = [set(id for id, _ in result) for result in exact]
+    rows = []
+    for rescore in rescores:
+        time_begin = time.time()
+        approximate = compressed.search(queries, k + 1, rescore)
+        elapsed = time.time() - time_begin
+        approximate = [[id for id, _ in result if id != qid][:k] for qid, result in zip(qids, approximate)]
+        recall = np.mean([len(truth & set(result)) / float(len(truth))
+                          for truth, result in zip(exact, approximate) if truth])
+        rows.append((rescore, recall, len(queries) / elapsed))
+    return rows
+
+def main(args):
+    store = VectorStore(args.index)
+    print("loaded index of " + str(len(store)) + " questions")
+    if args.build:
+        time_begin = time.time()
+        if args.type == "pq":
+            compressed = PQStore.build(store, args.m)
+        else:
+            compressed = Int8Store.build(store)
+        compressed.save()
+        print("built " + args.type + " codes in " + str(time.time() - time_begin) + "s")
+    if args.benchmark:
+        compressed = STORE_TYPES[args.type].load(store)
+        full_bytes = len(store) * store.dim * 4
+        print("float32 vectors: " + str(full_bytes) + " bytes, " + args.type + ": " + str(compressed.nbytes())
+              + " bytes (" + ("%.1f" % (full_bytes / float(compressed.nbytes()))) + "x smaller)")
+        rng = np.random.RandomState(1)
+        live_rows = np.nonzero(store.live)[0]
+        qids = [store.ids[row] for row in rng.choice(live_rows, min(args.num_queries, len(live_rows)), replace=False)]
+        rescores = [int(x) for x in args.rescore.split(",")]
+        print("rescore\trecall@" + str(args.k) + "\tqueries/s")
+        for rescore, recall, qps in benchmark(compressed, store, qids, args.k, rescores):
+            print(str(rescore) + "\t" + ("%.4f" % recall) + "\t" + ("%.1f" % qps))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--index",
+            type = str
+        )
+    argparser.add_argument("--type",
+            type = str,
+            default = "pq"
+        )
+    argparser.add_argument("--build",
+            action = "store_true"
+        )
+    argparser.add_argument("--benchmark",
+            action = "store_true"
+        )
+    argparser.add_argument("--m",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--rescore",
+            type = str,
+            default = "0,50,100"
+        )
+    argparser.add_argument("--num_queries",
+            type = int,
+            default = 1000
+        )
+    argparser.add_argument("--k",
+            type = int,
+            default = 10
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,235 @@
+"""
+Scores caller-supplied candidate lists against a query question, for callers
+that already have candidates (e.g. from site search) and only need them
+ranked.
+
+The query and every candidate is either a question id or a question text
+({"title": ..., "body": ...}). Ids that are in the vector store given by
+--index are read from it; other ids (looked up in --corpus) and texts are
+encoded, all of a batch of requests in one forward pass and through an
+encoding cache (cache.py). Scores are cosine similarities.
+
+From Python:
+    reranker = rerank.load_reranker(args)
+    scores = reranker.score("262144", ["399541", {"title": "...", "body": "..."}])
+
+The same scoring is served by server.py at POST /rerank.
+
+Usage:
+python2 rerank.py --embeddings <gzipped embeddings path> --load_model <model path> [--index <index directory>] [--corpus <gzipped corpus path>] [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] --requests <json lines path> [--output <json lines path>] [--batch_size <256>]
+python2 rerank.py ... --query_id <id> --candidate_ids <id,id,...>
+
+Each line of --requests is {"query": <id or text>, "candidates": [<id or text>, ...]};
+each output line is {"scores": [...]}, aligned with the candidates.
+
+Example Usage:
+python2 rerank.py --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --load_model lstm_models/lstm_model3/epoch9 --index indexes/askubuntu_lstm3 --query_id 262144 --candidate_ids 399541,15814,216
+"""
+
+import sys
+import json
+import argparse
+
+import numpy as np
+
+import corpus
+from vector_store import VectorStore, normalize
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+def check_text(title, body):
+    """Raises TypeError unless title and body are strings.
+    """
+    for name, text in (("title", title), ("body", body)):
+        if not isinstance(text, string_types):
+            raise TypeError(name + " must be a string, got " + type(text).__name__)
+
+def map_text(vocab_map, title, body):
+    """Tokenize like corpus.read_corpus and map to ids like corpus.map_corpus.
+    """
+    return corpus.map_question(vocab_map, title.lower().strip().split(), body.lower().strip().split())
+
+class Reranker(object):
+    """encode maps a list of (title ids, body ids) pairs to their vectors and
+    text_ids a (title, body) text to its (title ids, body ids).
+    """
+
+    def __init__(self, encode, text_ids, store=None, ids_corpus=None):
+        self.encode = encode
+        self.text_ids = text_ids
+        self.store = store
+        self.ids_corpus = ids_corpus or {}
+
+    def resolve(self, item):
+        """("row", store row) for indexed ids, ("question", (title ids, body
+        ids)) for everything that must be encoded.
+        """
+        if isinstance(item, dict):
+            return "question", self.text_ids(item.get("title", ""), item.get("body", ""))
+        if isinstance(item, (tuple, list)):
+            return "question", self.text_ids(item[0], item[1])
+        if self.store is not None and item in self.store:
+            return "row", self.store.id2row[item]
+        if item in self.ids_corpus:
+            return "question", self.ids_corpus[item]
+        raise KeyError("unknown question id " + str(item))
+
+    def validate(self, query, candidates):
+        """Raises KeyError for ids that can be neither read nor encoded and
+        TypeError for texts whose title or body is not a string.
+        """
+        if not isinstance(candidates, (tuple, list)):
+            raise TypeError("candidates must be a list")
+        for item in [query] + list(candidates):
+            if isinstance(item, dict):
+                check_text(item.get("title", ""), item.get("body", ""))
+            elif isinstance(item, (tuple, list)):
+                if len(item) != 2:
+                    raise TypeError("a question text must be (title, body)")
+                check_text(item[0], item[1])
+            else:
+                self.resolve(item)
+
+    def score_batch(self, requests):
+        """requests: list of (query, candidates). Returns, for each, the numpy
+        array of cosine scores of its candidates.
+        """
+        rows = []
+        questions = []
+        refs = {}
+        slots = []
+        for query, candidates in requests:
+            request_slots = []
+            for item in [query] + list(candidates):
+                key = item if not isinstance(item, (dict, tuple, list)) else None
+                if key is None or key not in refs:
+                    kind, value = self.resolve(item)
+                    if kind == "row":
+                        ref = (0, len(rows))
+                        rows.append(value)
+                    else:
+                        ref = (1, len(questions))
+                        questions.append(value)
+                    if key is not None:
+                        refs[key] = ref
+                else:
+                    ref = refs[key]
+                request_slots.append(ref)
+            slots.append(request_slots)
+
+        parts = []
+        if rows:
+            parts.append(self.store.rows(rows))
+        if questions:
+            parts.append(normalize(self.encode(questions)))
+        vectors = np.vstack(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+        results = []
+        for request_slots in slots:
+            matrix = vectors[[i + source * len(rows) for source, i in request_slots]]
+            results.append(np.dot(matrix[1:], matrix[0]))
+        return results
+
+    def score(self, query, candidates):
+        return self.score_batch([(query, candidates)])[0]
+
+def load_reranker(args):
+    """A Reranker for args.load_model / args.embeddings, reading indexed
+    questions from args.index and encoding ids of args.corpus (both optional).
+    """
+    import encoder
+    from cache import EncodingCache
+    model = encoder.load_model(args)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    store = VectorStore(args.index) if args.index else None
+    ids_corpus = corpus.map_corpus(vocab_map, corpus.read_corpus(args.corpus)) if args.corpus else None
+    cache = EncodingCache(args.cache_size)
+    encode = lambda questions: encoder.encode_questions(args, model, questions, embeddings, padding_id, cache=cache)
+    return Reranker(encode, lambda title, body: map_text(vocab_map, title, body), store, ids_corpus)
+
+def main(args):
+    reranker = load_reranker(args)
+    if args.query_id:
+        candidates = args.candidate_ids.split(",")
+        scores = reranker.score(args.query_id, candidates)
+        for id, score in sorted(zip(candidates, scores), key=lambda x: -x[1]):
+            print(id + "\t" + ("%.4f" % score))
+        return
+
+    fout = open(args.output, "w") if args.output else sys.stdout
+    with open(args.requests) as fin:
+        batch = []
+        for line in fin:
+            if line.strip():
+                request = json.loads(line)
+                batch.append((request["query"], request["candidates"]))
+            if len(batch) == args.batch_size:
+                for scores in reranker.score_batch(batch):
+                    fout.write(json.dumps({"scores": [float(x) for x in scores]}) + "\n")
+                batch = []
+        for scores in reranker.score_batch(batch):
+            fout.write(json.dumps({"scores": [float(x) for x in scores]}) + "\n")
+    if args.output:
+        fout.close()
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--requests",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--output",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--query_id",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--candidate_ids",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--index",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--corpus",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--load_model",
+            type = str
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 256
+        )
+    argparser.add_argument("--cache_size",
+            type = int,
+            default = 100000
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,182 @@
+"""
+Exact top-k retrieval of similar questions over a whole corpus, using the
+vectors written by build_index.py.
+
+Scores are cosine similarities. The memory-mapped matrix is scanned in blocks
+of rows; every block is multiplied with all queries at once on a thread pool
+(numpy releases the GIL inside the matrix product) and its best k rows per
+query are merged into a bounded heap. Ties are broken by store row, so results
+are identical to sorting the full cosine matrix (see brute_force).
+
+Usage:
+python2 search.py --index <index directory> --query_ids <id,id,...> [--k <10>] [--num_threads <cores>]
+python2 search.py --index <index directory> --queries <corpus path> --embeddings <gzipped embeddings path> --load_model <model path> [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] [--k <10>]
+
+Example Usage:
+python2 search.py --index indexes/askubuntu_lstm3 --query_ids 262144,399541 --k 20
+"""
+
+import sys
+import argparse
+import heapq
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from vector_store import VectorStore, normalize
+
+def block_top_k(block, queries, k, live=None):
+    """Scores one block of rows against all queries and returns, per query, the
+    (score, row in block) candidates that can be in its top k. Every row tying
+    with the k-th best score is kept so that the merge can break ties by row.
+    Rows where live is False (deleted questions) are skipped.
+    """
+    if k <= 0:
+        raise ValueError("k must be positive, got " + str(k))
+    scores = np.dot(queries, np.asarray(block).T)
+    if live is None:
+        live = np.ones(scores.shape[1], dtype=bool)
+    elif not live.all():
+        scores[:, ~live] = -np.inf
+    if live.sum() <= k:
+        rows = np.nonzero(live)[0]
+        return [[(float(q[row]), int(row)) for row in rows] for q in scores]
+    kth = np.partition(scores, scores.shape[1] - k, axis=1)[:, scores.shape[1] - k]
+    results = []
+    for q, threshold in zip(scores, kth):
+        rows = np.nonzero((q >= threshold) & live)[0]
+        results.append([(float(q[row]), int(row)) for row in rows])
+    return results
+
+def merge_top_k(heap, candidates, offset, k):
+    """Push (score, row) candidates into a bounded min-heap of size k, keyed by
+    (score, -row) so that on equal scores the lower row wins.
+    """
+    for score, row in candidates:
+        item = (score, -(offset + row))
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+def search_vectors(store, queries, k=10, block_size=16384, query_batch_size=256, num_threads=0, pool=None):
+    """Returns, for every row of queries, its k most similar questions in the
+    store as a list of (question id, cosine score), best first. The lists
+    are empty when k <= 0 or the store has no live questions.
+    """
+    queries = normalize(np.atleast_2d(queries))
+    k = min(k, store.num_live())
+    if k <= 0:
+        return [[] for _ in range(len(queries))]
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPool(num_threads or multiprocessing.cpu_count())
+    results = []
+    try:
+        for start in range(0, len(queries), query_batch_size):
+            batch = queries[start:start + query_batch_size]
+            heaps = [[] for _ in range(len(batch))]
+            blocks = list(store.blocks(block_size))
+            block_results = pool.imap(lambda block: block_top_k(block[1], batch, k, store.live[block[0]:block[0] + len(block[1])]), blocks)
+            for (offset, _), candidates in zip(blocks, block_results):
+                for heap, query_candidates in zip(heaps, candidates):
+                    merge_top_k(heap, query_candidates, offset, k)
+            for heap in heaps:
+                ranked = sorted(heap, reverse=True)
+                results.append([(store.ids[-row], score) for score, row in ranked])
+    finally:
+        if own_pool:
+            pool.close()
+    return results
+
+def search_ids(store, qids, k=10, exclude_self=True, **kwargs):
+    """Top-k search for questions that are already in the store. The query
+    question itself is left out of its results unless exclude_self is False.
+    """
+    extra = 1 if exclude_self else 0
+    results = search_vectors(store, store.get(qids), k + extra, **kwargs)
+    if exclude_self:
+        results = [[(id, score) for id, score in result if id != qid][:k]
+                   for qid, result in zip(qids, results)]
+    return results
+
+def brute_force(store, queries, k=10):
+    """Reference implementation: full cosine matrix, sorted by (-score, row).
+    """
+    queries = normalize(np.atleast_2d(queries))
+    scores = np.dot(queries, store.to_array().T)
+    scores[:, ~store.live] = -np.inf
+    results = []
+    for q in scores:
+        order = np.lexsort((np.arange(len(q)), -q))[:min(k, store.num_live())]
+        results.append([(store.ids[row], float(q[row])) for row in order])
+    return results
+
+def main(args):
+    store = VectorStore(args.index)
+    print("loaded index of " + str(len(store)) + " questions")
+    if args.query_ids:
+        qids = args.query_ids.split(",")
+        results = search_ids(store, qids, args.k, num_threads=args.num_threads)
+    else:
+        import corpus
+        import encoder
+        model = encoder.load_model(args)
+        list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+        ids_corpus = corpus.map_corpus(vocab_map, corpus.read_corpus(args.queries))
+        qids = list(ids_corpus.keys())
+        vectors = encoder.encode_questions(args, model, [ids_corpus[id] for id in qids], embeddings, padding_id)
+        results = search_vectors(store, vectors, args.k, num_threads=args.num_threads)
+
+    for qid, result in zip(qids, results):
+        print(qid + "\t" + " ".join(id + ":" + ("%.4f" % score) for id, score in result))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--index",
+            type = str
+        )
+    argparser.add_argument("--query_ids",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--queries",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--embeddings",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--load_model",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--k",
+            type = int,
+            default = 10
+        )
+    argparser.add_argument("--num_threads",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
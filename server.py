@@ -0,0 +1,405 @@
+"""
+Long-running local HTTP service that returns the questions of an index most
+similar to a new question.
+
+Requests are handled on their own threads, but encoding is done by a single
+micro-batching worker: requests that arrive within --max_wait seconds of each
+other (up to --max_batch_size of them) are tokenized like corpus.read_corpus,
+mapped with corpus.questions_to_ids and encoded together in one forward pass.
+
+POST /similar   {"title": "...", "body": "...", "k": 10}
+                -> {"ids": [...], "scores": [...]}
+POST /rerank    {"query": <id or {"title", "body"}>, "candidates": [<id or text>, ...]}
+                -> {"scores": [...]} (see rerank.py)
+POST /reload    {"load_model": "<checkpoint path>", "index": "<index directory>"}
+                loads a new checkpoint and the index built with it ("index"
+                defaults to the current one); a checkpoint the index was not
+                built with, or that changed since, is refused with 400
+GET  /stats     -> request latency percentiles (ms), batch sizes and
+                   encoding cache hits/misses
+
+Malformed requests (k outside 1 to the index size, a title or body that is not
+a string, unknown ids) are answered with 400 before they reach a batch; a
+request that fails inside a batch is answered with 500 without failing the
+others batched with it.
+
+Encodings are kept in an LRU cache (cache.py) of --cache_size entries, so a
+question asked again is not re-encoded; loading a checkpoint empties it.
+
+Usage:
+python2 server.py --index <index directory> --embeddings <gzipped embeddings path> --load_model <model path> [--model <lstm | cnn>] [--hidden_size <100>] [--embedding_size <200 | 300>] [--port <8080>] [--max_batch_size <32>] [--max_wait <0.005>] [--ann <exact | ivf | hnsw>] [--knob <nprobe or ef_search>] [--cache_size <100000>] [--cache_bytes <0>]
+
+Example Usage:
+python2 server.py --index indexes/askubuntu_lstm3 --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --load_model lstm_models/lstm_model3/epoch9 --port 8080
+curl -d '{"title": "how do i install skype", "body": "", "k": 5}' localhost:8080/similar
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+import collections
+
+try:
+    from Queue import Queue, Empty
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from queue import Queue, Empty
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import numpy as np
+
+import corpus
+import encoder
+import search
+import build_index
+from rerank import Reranker, map_text, check_text
+from cache import EncodingCache, model_version
+from vector_store import VectorStore
+
+class LatencyStats(object):
+    """Keeps the last window latencies (seconds) and batch sizes.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+
+    def add_latency(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes.append(size)
+
+    def value(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            batch_sizes = np.array(self.batch_sizes)
+            requests = self.requests
+        stats = {"requests": requests}
+        if len(latencies):
+            for p in (50, 90, 95, 99):
+                stats["p" + str(p) + "_ms"] = float(np.percentile(latencies, p))
+            stats["max_ms"] = float(latencies.max())
+        if len(batch_sizes):
+            stats["mean_batch_size"] = float(batch_sizes.mean())
+        return stats
+
+class MicroBatcher(object):
+    """Coalesces items submitted from many threads into batches for process,
+    a function from a list of items to the list of their results.
+    """
+
+    def __init__(self, process, max_batch_size=32, max_wait=0.005, stats=None):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        """Blocks until the item's batch has been processed and returns its result.
+        """
+        done = threading.Event()
+        slot = [item, done, None, None]
+        self.queue.put(slot)
+        done.wait()
+        if slot[3] is not None:
+            raise slot[3]
+        return slot[2]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+            if self.stats is not None:
+                self.stats.add_batch(len(batch))
+            try:
+                results = self.process([slot[0] for slot in batch])
+                for slot, result in zip(batch, results):
+                    slot[2] = result
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][3] = e
+                else:
+                    # process the items one by one so that only the failing ones fail
+                    for slot in batch:
+                        try:
+                            slot[2] = self.process([slot[0]])[0]
+                        except Exception as e:
+                            slot[3] = e
+            for slot in batch:
+                slot[1].set()
+
+class QuestionService(object):
+    """Encodes new questions and searches the index for similar ones.
+    """
+
+    def __init__(self, args, model, vocab_map, embeddings, padding_id, store, index=None):
+        self.args = args
+        self.model = model
+        self.vocab_map = vocab_map
+        self.embeddings = embeddings
+        self.padding_id = padding_id
+        self.store = store
+        self.index = index
+        self.cache = EncodingCache(args.cache_size, args.cache_bytes, model_version(args.load_model))
+        self.lock = threading.Lock()
+        self.stats = LatencyStats()
+        self.batcher = MicroBatcher(self.similar_batch, args.max_batch_size, args.max_wait, self.stats)
+        self.reranker = Reranker(self.encode, self.map_question, store)
+        self.rerank_stats = LatencyStats()
+        self.rerank_batcher = MicroBatcher(self.rerank_batch, args.max_batch_size, args.max_wait,
+                                           self.rerank_stats)
+
+    def map_question(self, title, body):
+        """Tokenize like corpus.read_corpus and map to ids like corpus.map_corpus.
+        """
+        return map_text(self.vocab_map, title, body)
+
+    def encode(self, questions):
+        # callers hold self.lock, so that a reload cannot swap the model,
+        # cache version or index mid-batch
+        return encoder.encode_questions(self.args, self.model, questions, self.embeddings, self.padding_id,
+                                        cache=self.cache)
+
+    def load_checkpoint(self, path, index_path=None):
+        """Swap in a new checkpoint of the same architecture, together with the
+        index at index_path built with it (by default the current one), and
+        invalidate the cached encodings of the old checkpoint. Raises
+        ValueError if the index was not built with this checkpoint.
+        """
+        store = VectorStore(index_path) if index_path else self.store
+        build_index.check_checkpoint(store.meta, path)
+        model = encoder.load_model(self.args, path)
+        index = load_ann(self.args, store) if index_path else self.index
+        with self.lock:
+            self.cache.set_version(model_version(path))
+            self.model = model
+            self.args.load_model = path
+            self.store = store
+            self.index = index
+            self.reranker.store = store
+
+    def search(self, vectors, k):
+        if self.index is None:
+            return search.search_vectors(self.store, vectors, k)
+        return self.index.search(vectors, k, self.args.knob)
+
+    def similar_batch(self, requests):
+        """requests: list of (title, body, k). One forward pass for all of them.
+        """
+        questions = [self.map_question(title, body) for title, body, k in requests]
+        with self.lock:
+            vectors = self.encode(questions)
+            results = self.search(vectors, max(k for _, _, k in requests))
+        return [result[:k] for (_, _, k), result in zip(requests, results)]
+
+    def rerank_batch(self, requests):
+        with self.lock:
+            return self.reranker.score_batch(requests)
+
+    def validate_similar(self, title, body, k):
+        """Raises TypeError unless title and body are strings and ValueError
+        unless 1 <= k <= the number of live indexed questions.
+        """
+        check_text(title, body)
+        if not 1 <= k <= self.store.num_live():
+            raise ValueError("k must be between 1 and " + str(self.store.num_live()) + ", got " + str(k))
+
+    def similar(self, title, body, k=10):
+        time_begin = time.time()
+        self.validate_similar(title, body, k)
+        result = self.batcher.submit((title, body, k))
+        self.stats.add_latency(time.time() - time_begin)
+        return result
+
+    def rerank(self, query, candidates):
+        """Cosine scores of candidates (ids or texts) against query. Raises
+        KeyError for ids that are not indexed.
+        """
+        time_begin = time.time()
+        self.reranker.validate(query, candidates)
+        scores = self.rerank_batcher.submit((query, candidates))
+        self.rerank_stats.add_latency(time.time() - time_begin)
+        return scores
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the default listen backlog of 5 resets connections under bursts
+    request_queue_size = 256
+
+def make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                stats = service.stats.value()
+                stats["cache"] = service.cache.stats()
+                stats["rerank"] = service.rerank_stats.value()
+                self.send_json(200, stats)
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path == "/reload":
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    index_path = request.get("index")
+                    service.load_checkpoint(str(request["load_model"]), str(index_path) if index_path else None)
+                except (ValueError, KeyError, IOError, OSError) as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+                self.send_json(200, {"load_model": service.args.load_model, "index": service.store.path})
+                return
+            if self.path == "/rerank":
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    query, candidates = request["query"], request["candidates"]
+                    service.reranker.validate(query, candidates)
+                except (ValueError, TypeError, AttributeError, KeyError) as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+                try:
+                    scores = service.rerank(query, candidates)
+                except Exception as e:
+                    self.send_json(500, {"error": str(e)})
+                    return
+                self.send_json(200, {"scores": [float(score) for score in scores]})
+                return
+            if self.path != "/similar":
+                self.send_json(404, {"error": "not found"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                title = request.get("title", "")
+                body = request.get("body", "")
+                k = int(request.get("k", 10))
+                service.validate_similar(title, body, k)
+            except (ValueError, TypeError, AttributeError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            try:
+                result = service.similar(title, body, k)
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+                return
+            self.send_json(200, {"ids": [id for id, _ in result], "scores": [score for _, score in result]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def load_ann(args, store):
+    if args.ann == "exact":
+        return None
+    import ann
+    return ann.INDEX_TYPES[args.ann].load(store)
+
+def main(args):
+    store = VectorStore(args.index)
+    try:
+        build_index.check_checkpoint(store.meta, args.load_model)
+    except ValueError as e:
+        sys.exit(str(e))
+    model = encoder.load_model(args)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    print("loaded embeddings")
+    print("loaded index of " + str(len(store)) + " questions")
+    service = QuestionService(args, model, vocab_map, embeddings, padding_id, store, load_ann(args, store))
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print("serving on " + args.host + ":" + str(args.port))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--index",
+            type = str
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--load_model",
+            type = str
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--embedding_size",
+            type = int,
+            default = 200
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--host",
+            type = str,
+            default = "127.0.0.1"
+        )
+    argparser.add_argument("--port",
+            type = int,
+            default = 8080
+        )
+    argparser.add_argument("--max_batch_size",
+            type = int,
+            default = 32
+        )
+    argparser.add_argument("--max_wait",
+            type = float,
+            default = 0.005
+        )
+    argparser.add_argument("--ann",
+            type = str,
+            default = "exact"
+        )
+    argparser.add_argument("--knob",
+            type = int,
+            default = 8
+        )
+    argparser.add_argument("--cache_size",
+            type = int,
+            default = 100000
+        )
+    argparser.add_argument("--cache_bytes",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
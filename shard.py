@@ -0,0 +1,359 @@
+"""
+Sharded exact retrieval for corpora whose vectors do not fit in one process.
+
+The vector store of build_index.py is partitioned by question id into N shard
+stores (--split). Each shard is served by its own worker process, started
+locally or on another host (--serve), and a coordinator (ShardedSearcher) fans
+every batch of queries out to all shards, waits at most --timeout seconds and
+merges the per-shard top-k lists. Shards that miss the deadline, answer with
+an error or have lost their connection are left out of that answer and
+reported, along with per-shard latencies.
+
+Connections to --serve workers unpickle what they receive, so they are
+authenticated with a shared secret read from --authkey_file or, without it,
+the SHARD_AUTHKEY environment variable; --serve refuses to start without one
+and listens on 127.0.0.1 unless --host says otherwise.
+
+Usage:
+python2 shard.py --index <index directory> --split <N> --output <shards directory>
+python2 shard.py --serve <shard directory> [--host <127.0.0.1>] [--port <6000>] [--authkey_file <path>]
+python2 shard.py --shards <shard directory,...> --query_ids <id,id,...> [--k <10>] [--timeout <1.0>]
+python2 shard.py --shards <shard directory,...> --remote <host:port,...> [--authkey_file <path>] --query_ids <id,id,...>
+
+Example Usage:
+python2 shard.py --index indexes/askubuntu_lstm3 --split 4 --output indexes/askubuntu_lstm3_shards
+python2 shard.py --shards indexes/askubuntu_lstm3_shards/shard_0,indexes/askubuntu_lstm3_shards/shard_1,indexes/askubuntu_lstm3_shards/shard_2,indexes/askubuntu_lstm3_shards/shard_3 --query_ids 262144,399541 --k 20
+"""
+
+import os
+import sys
+import time
+import zlib
+import heapq
+import argparse
+import threading
+import collections
+import traceback
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import numpy as np
+
+import search
+from vector_store import VectorStore
+
+AUTHKEY_VARIABLE = "SHARD_AUTHKEY"
+
+def load_authkey(path=""):
+    """The shared secret of --serve workers and their clients: the contents of
+    path if given, else the SHARD_AUTHKEY environment variable, else None.
+    """
+    if path:
+        with open(path, "rb") as fin:
+            key = fin.read().strip()
+    else:
+        key = os.environ.get(AUTHKEY_VARIABLE, "").encode("utf-8")
+    return key or None
+
+def shard_of(id, num_shards):
+    """Shard of a question id; stable across processes and runs.
+    """
+    return zlib.crc32(id.encode("utf-8") if not isinstance(id, bytes) else id) % num_shards
+
+def split_store(store, num_shards, output, block_size=65536):
+    """Partition the live rows of store by id into num_shards new stores
+    output/shard_<i>, one segment per block per shard.
+    """
+    shards = [VectorStore.create(os.path.join(output, "shard_" + str(i)), dict(store.meta))
+              for i in range(num_shards)]
+    for offset, block in store.blocks(block_size):
+        ids = store.ids[offset:offset + len(block)]
+        assignment = np.array([shard_of(id, num_shards) for id in ids], dtype=np.int64)
+        assignment[~store.live[offset:offset + len(block)]] = -1
+        for i, shard in enumerate(shards):
+            shard_ids = [ids[row] for row in np.nonzero(assignment == i)[0]]
+            if not shard_ids:
+                continue
+            hashes = None
+            if all(id in store.hashes for id in shard_ids):
+                hashes = [store.hashes[id] for id in shard_ids]
+            shard.append(shard_ids, np.asarray(block)[assignment == i], hashes)
+    return shards
+
+def answer(store, message):
+    if message[0] == "search":
+        _, request_id, queries, k = message
+        return search.search_vectors(store, queries, k)
+    _, request_id, ids = message
+    found = [id for id in ids if id in store]
+    return (found, store.get(found))
+
+def serve_shard(path, conn, store=None):
+    """Worker loop: answers ("search", request id, queries, k) and ("get",
+    request id, ids) messages on conn with (request id, result, seconds,
+    error) until it receives None or the other end goes away. A request that
+    fails is answered with its error message and no result.
+    """
+    if store is None:
+        store = VectorStore(path)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, IOError, OSError):
+            break
+        if message is None:
+            break
+        time_begin = time.time()
+        try:
+            result, error = answer(store, message), None
+        except Exception:
+            result, error = None, traceback.format_exc()
+        try:
+            conn.send((message[1], result, time.time() - time_begin, error))
+        except (EOFError, IOError, OSError):
+            break
+    conn.close()
+
+class ShardedSearcher(object):
+    """Coordinator over shard workers. shards are shard store directories to
+    serve from local worker processes; remotes are (host, port) addresses of
+    workers started with --serve, reached with authkey. A shard whose
+    connection breaks is marked dead and left out of every later answer.
+    """
+
+    def __init__(self, shards=(), remotes=(), timeout=1.0, authkey=None):
+        if remotes and not authkey:
+            raise ValueError("remote shards need an authkey (--authkey_file or " + AUTHKEY_VARIABLE + ")")
+        self.timeout = timeout
+        self.processes = []
+        self.conns = []
+        for path in shards:
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_shard, args=(path, child))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.conns.append(parent)
+        for address in remotes:
+            self.conns.append(Client(address, authkey=authkey))
+        # held for a whole scatter: request ids and the response queue are shared
+        self.lock = threading.Lock()
+        self.responses = Queue()
+        self.request_id = 0
+        self.dead = set()
+        self.latencies = [collections.deque(maxlen=10000) for _ in self.conns]
+        for shard, conn in enumerate(self.conns):
+            reader = threading.Thread(target=self.read, args=(shard, conn))
+            reader.daemon = True
+            reader.start()
+
+    def read(self, shard, conn):
+        while True:
+            try:
+                request_id, result, compute_time, error = conn.recv()
+            except (EOFError, IOError, OSError):
+                break
+            self.responses.put((request_id, shard, result, compute_time, error, time.time()))
+        self.dead.add(shard)
+        # wakes up a scatter waiting for this shard
+        self.responses.put((None, shard, None, 0.0, "connection lost", time.time()))
+
+    def scatter(self, message):
+        """Send message (without request id) to every live shard and gather the
+        answers that arrive before the timeout. Returns (answers by shard,
+        latency report). The report lists the shards that timed out, that
+        answered with an error (failed, with the error) and that are dead.
+        """
+        with self.lock:
+            self.request_id += 1
+            request_id = self.request_id
+            time_begin = time.time()
+            pending = set()
+            for shard, conn in enumerate(self.conns):
+                if shard in self.dead:
+                    continue
+                try:
+                    conn.send((message[0], request_id) + tuple(message[1:]))
+                    pending.add(shard)
+                except (EOFError, IOError, OSError):
+                    self.dead.add(shard)
+            answers = {}
+            report = {"shards": {}, "timed_out": [], "failed": {}, "dead": []}
+            deadline = time_begin + self.timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    response_id, shard, result, compute_time, error, received = self.responses.get(timeout=remaining)
+                except Empty:
+                    break
+                if response_id is None:
+                    pending.discard(shard)
+                    continue
+                if response_id != request_id:
+                    # late answer to an earlier request
+                    continue
+                pending.discard(shard)
+                if error is not None:
+                    report["failed"][shard] = error
+                    continue
+                answers[shard] = result
+                self.latencies[shard].append(received - time_begin)
+                report["shards"][shard] = {"latency_ms": (received - time_begin) * 1000.0,
+                                           "compute_ms": compute_time * 1000.0}
+            report["dead"] = sorted(self.dead)
+            report["timed_out"] = sorted(shard for shard in pending if shard not in self.dead)
+            return answers, report
+
+    def search(self, queries, k=10):
+        """Returns (for every row of queries its k most similar questions over
+        all shards as (question id, cosine score) lists, latency report).
+        """
+        queries = np.atleast_2d(queries)
+        answers, report = self.scatter(("search", queries, k))
+        results = []
+        for q in range(len(queries)):
+            candidates = [(-score, shard, rank, id)
+                          for shard, shard_results in answers.items()
+                          for rank, (id, score) in enumerate(shard_results[q])]
+            results.append([(id, -score) for score, _, _, id in heapq.nsmallest(k, candidates)])
+        return results, report
+
+    def get(self, ids):
+        """(found ids, their vectors) of question ids, from whichever shards
+        hold them. Ids that are in no shard, or only in one that did not
+        answer, are left out.
+        """
+        answers, _ = self.scatter(("get", list(ids)))
+        vectors = {}
+        for found, found_vectors in answers.values():
+            vectors.update(zip(found, found_vectors))
+        found = [id for id in ids if id in vectors]
+        return found, np.array([vectors[id] for id in found])
+
+    def latency_percentiles(self):
+        """p50/p95/p99 round-trip latency (ms) of every shard so far.
+        """
+        report = {}
+        for shard, latencies in enumerate(self.latencies):
+            if latencies:
+                latencies = np.array(latencies) * 1000.0
+                report[shard] = dict(("p" + str(p), float(np.percentile(latencies, p))) for p in (50, 95, 99))
+        return report
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (EOFError, IOError, OSError):
+                pass
+        for process in self.processes:
+            process.join(1.0)
+
+def main(args):
+    if args.split:
+        store = VectorStore(args.index)
+        shards = split_store(store, args.split, args.output)
+        for i, shard in enumerate(shards):
+            print("shard " + str(i) + ": " + str(shard.num_live()) + " questions")
+    elif args.serve:
+        authkey = load_authkey(args.authkey_file)
+        if authkey is None:
+            sys.exit("refusing to serve without an authkey: set --authkey_file or " + AUTHKEY_VARIABLE)
+        store = VectorStore(args.serve)
+        listener = Listener((args.host, args.port), authkey=authkey)
+        print("serving " + args.serve + " on " + args.host + ":" + str(args.port))
+        while True:
+            try:
+                conn = listener.accept()
+            except (multiprocessing.AuthenticationError, EOFError, IOError, OSError) as e:
+                print("rejected connection: " + str(e))
+                continue
+            serve_shard(args.serve, conn, store)
+    else:
+        remotes = []
+        for address in filter(None, args.remote.split(",")):
+            host, port = address.split(":")
+            remotes.append((host, int(port)))
+        searcher = ShardedSearcher(filter(None, args.shards.split(",")), remotes, args.timeout,
+                                   load_authkey(args.authkey_file) if remotes else None)
+        qids = args.query_ids.split(",")
+        found, vectors = searcher.get(qids)
+        missing = [qid for qid in qids if qid not in set(found)]
+        if missing:
+            print("not found (or on a shard that did not answer): " + ",".join(missing))
+        if not found:
+            searcher.close()
+            return
+        results, report = searcher.search(vectors, args.k)
+        for qid, result in zip(found, results):
+            print(qid + "\t" + " ".join(id + ":" + ("%.4f" % score) for id, score in result))
+        for shard, latency in sorted(report["shards"].items()):
+            print("shard " + str(shard) + ": " + ("%.1f" % latency["latency_ms"]) + " ms")
+        if report["timed_out"]:
+            print("timed out: " + ", ".join(str(shard) for shard in report["timed_out"]))
+        for shard, error in sorted(report["failed"].items()):
+            print("shard " + str(shard) + " failed: " + error.strip().split("\n")[-1])
+        if report["dead"]:
+            print("dead: " + ", ".join(str(shard) for shard in report["dead"]))
+        searcher.close()
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--index",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--split",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--output",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--serve",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--host",
+            type = str,
+            default = "127.0.0.1"
+        )
+    argparser.add_argument("--port",
+            type = int,
+            default = 6000
+        )
+    argparser.add_argument("--authkey_file",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--shards",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--remote",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--query_ids",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--k",
+            type = int,
+            default = 10
+        )
+    argparser.add_argument("--timeout",
+            type = float,
+            default = 1.0
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,322 @@
+"""
+Parallel hyperparameter sweep of the question retrieval encoder of main.py
+(optionally with the gradient-reversal domain loss of adversarial_domain.py).
+
+The corpora, embeddings and annotations are read and mapped once. The
+embeddings and the mapped word ids of every question are then written to
+.npy files in --work_dir and memory-mapped read-only by the workers, so
+trials share one copy of them in the page cache instead of each holding its
+own. Every trial runs in a fresh worker process (one per core by default),
+trains for --epochs and is evaluated on --dev after every epoch.
+
+--grid lists the values of each hyperparameter, as
+"name=value,value;name=value,..." over model, hidden_size, margin, batch_size
+and lam (lam > 0 needs --android_path). Every combination is run, or
+--trials of them drawn at random. Unlike main.py, the CNN keeps the margin it
+is given.
+
+One row per trial goes to --results_file: the hyperparameters, the best dev
+epoch with its MAP, MRR, P@1 and P@5, the trial's runtime in seconds, and
+its memory: the peak resident set size (ru_maxrss) of the worker when the
+trial starts, which is inherited from the forked parent, and how much the
+trial raised that peak, in MB. Pages of the memory-mapped shared data that a
+trial touches count in its resident set even though trials share them.
+
+Usage:
+python2 sweep.py --corpus <gzipped corpus path> --embeddings <gzipped embeddings path> --train <train questions path> --dev <dev questions path> --results_file <csv path> --grid <grid> [--trials <0>] [--epochs <10>] [--android_path <Android directory>] [--work_dir <sweep_data>] [--processes <0>] [--threads <1>] [--seed <1>]
+
+Example Usage:
+python2 sweep.py --corpus ../askubuntu/text_tokenized.txt.gz --embeddings ../askubuntu/vector/vectors_pruned.200.txt.gz --train ../askubuntu/train_random.txt --dev ../askubuntu/dev.txt --results_file sweep_results.csv --grid "model=lstm,cnn;hidden_size=100,200;margin=0.2,0.3" --epochs 5
+"""
+
+import os
+import sys
+import csv
+import copy
+import time
+import random
+import argparse
+import itertools
+import resource
+import multiprocessing
+
+import numpy as np
+
+import torch
+from torch.optim import Adam
+import torch.nn.functional as F
+import torch.autograd as autograd
+
+import corpus
+import encoder
+from distill import triple_scores, evaluate
+from adversarial_domain import FeedForward, GradientReversal, concatenate_batches, android_pairs_to_annotations
+
+PARAMS = {"model": str, "hidden_size": int, "margin": float, "batch_size": int, "lam": float}
+
+# set in the parent before the pool forks, read by the workers
+SHARED = {}
+
+def parse_grid(grid):
+    """{"name": [values]} of a "name=value,value;name=value" string.
+    """
+    values = {}
+    for part in grid.split(";"):
+        if part.strip():
+            name, choices = part.split("=")
+            name = name.strip()
+            assert name in PARAMS, "unknown hyperparameter " + name
+            values[name] = [PARAMS[name](x) for x in choices.split(",")]
+    return values
+
+def trial_configs(args):
+    """The hyperparameters of every trial: the full grid, or --trials random
+    points of it.
+    """
+    values = parse_grid(args.grid)
+    names = sorted(values)
+    configs = [dict(zip(names, point)) for point in itertools.product(*[values[name] for name in names])]
+    if args.trials and args.trials < len(configs):
+        configs = random.Random(args.seed).sample(configs, args.trials)
+    return configs
+
+def write_shared_corpus(work_dir, name, ids_corpus):
+    """Write the word ids of every question of ids_corpus to <name>.tokens.npy
+    (titles and bodies back to back) with their offsets and question ids.
+    """
+    ids = sorted(ids_corpus)
+    lengths = np.zeros(2 * len(ids), dtype=np.int64)
+    for i, id in enumerate(ids):
+        lengths[2 * i] = len(ids_corpus[id][0])
+        lengths[2 * i + 1] = len(ids_corpus[id][1])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    tokens = np.lib.format.open_memmap(os.path.join(work_dir, name + ".tokens.npy"), mode="w+",
+                                       dtype=np.int64, shape=(int(max(offsets[-1], 1)),))
+    for i, id in enumerate(ids):
+        tokens[offsets[2 * i]:offsets[2 * i + 1]] = ids_corpus[id][0]
+        tokens[offsets[2 * i + 1]:offsets[2 * i + 2]] = ids_corpus[id][1]
+    tokens.flush()
+    np.save(os.path.join(work_dir, name + ".offsets.npy"), offsets)
+    with open(os.path.join(work_dir, name + ".ids.txt"), "w") as fout:
+        fout.write("\n".join(ids))
+
+def read_shared_corpus(work_dir, name):
+    """ids_corpus of write_shared_corpus, as views of the memory-mapped word ids.
+    """
+    with open(os.path.join(work_dir, name + ".ids.txt")) as fin:
+        ids = fin.read().split("\n")
+    tokens = np.load(os.path.join(work_dir, name + ".tokens.npy"), mmap_mode="r")
+    offsets = np.load(os.path.join(work_dir, name + ".offsets.npy"))
+    return dict((id, (tokens[offsets[2 * i]:offsets[2 * i + 1]], tokens[offsets[2 * i + 1]:offsets[2 * i + 2]]))
+                for i, id in enumerate(ids))
+
+def preprocess(args):
+    """Read and map everything once, write the shared arrays to args.work_dir
+    and keep only the (small) annotations in SHARED.
+    """
+    time_begin = time.time()
+    if not os.path.exists(args.work_dir):
+        os.makedirs(args.work_dir)
+    list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+    print("loaded embeddings")
+    np.save(os.path.join(args.work_dir, "embeddings.npy"), embeddings.astype(np.float32))
+    write_shared_corpus(args.work_dir, "ubuntu", corpus.map_corpus(vocab_map, corpus.read_corpus(args.corpus)))
+    SHARED["annotations"] = corpus.read_annotations(args.train)
+    SHARED["dev"] = corpus.read_annotations(args.dev)
+    if args.android_path:
+        android_corpus = corpus.map_corpus(vocab_map, corpus.read_corpus(os.path.join(args.android_path, "corpus.tsv.gz")))
+        write_shared_corpus(args.work_dir, "android", android_corpus)
+        SHARED["android_annotations"] = android_pairs_to_annotations(os.path.join(args.android_path, "dev.pos.txt"),
+                                                                     os.path.join(args.android_path, "dev.neg.txt"))
+    SHARED["args"] = args
+    SHARED["padding_id"] = padding_id
+    SHARED["embedding_size"] = embeddings.shape[1]
+    print("time to preprocess: " + ("%.1f" % (time.time() - time_begin)) + "s")
+
+def train_step(args, model, optimizer, batch, data, discriminator=None, discriminator_optimizer=None):
+    """One step of main.py's margin loss on batch, plus the reversed domain loss
+    of adversarial_domain.py with a discriminator. Returns the loss.
+    """
+    embeddings, padding_id = data["embeddings"], data["padding_id"]
+    optimizer.zero_grad()
+    titles, bodies, triples = batch
+    if discriminator is None:
+        hidden = encoder.encode_batch(args, model, titles, bodies, embeddings, padding_id)
+    else:
+        discriminator_optimizer.zero_grad()
+        ubuntu_batch = corpus.domain_classifier_batch(data["ids_corpus"], data["annotations"], padding_id)
+        android_batch = corpus.domain_classifier_batch(data["android_corpus"], data["android_annotations"], padding_id)
+        titles, bodies, sizes = concatenate_batches([batch, ubuntu_batch, android_batch], padding_id)
+        hidden = encoder.encode_batch(args, model, titles, bodies, embeddings, padding_id)
+        domain_labels = torch.LongTensor([1] * sizes[1] + [0] * sizes[2])
+        if args.cuda:
+            domain_labels = domain_labels.cuda()
+        output = discriminator(GradientReversal.apply(hidden[sizes[0]:], args.lam))
+        domain_loss = F.cross_entropy(output, autograd.Variable(domain_labels))
+        hidden = hidden[:sizes[0]]
+
+    targets = torch.zeros(triples.shape[0]).type(torch.LongTensor)
+    if args.cuda:
+        targets = targets.cuda()
+    loss = F.multi_margin_loss(triple_scores(args, hidden, triples, args.hidden_size), autograd.Variable(targets),
+                               margin=args.margin)
+    if discriminator is not None:
+        loss = loss + domain_loss
+    loss.backward()
+    optimizer.step()
+    if discriminator is not None:
+        discriminator_optimizer.step()
+    return float(loss.cpu().data.numpy())
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB.
+    """
+    # ru_maxrss is in KB on Linux but in bytes on macOS
+    scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def run_trial(trial):
+    """[trial, hyperparameters..., best epoch, MAP, MRR, P@1, P@5, seconds,
+    start MB, added peak MB] of one (index, config) trial.
+    """
+    index, config = trial
+    time_begin = time.time()
+    start_mb = peak_rss_mb()
+    args = copy.copy(SHARED["args"])
+    for name, value in config.items():
+        setattr(args, name, value)
+    args.embedding_size = SHARED["embedding_size"]
+    torch.set_num_threads(args.threads)
+    random.seed(args.seed + index)
+    np.random.seed(args.seed + index)
+    torch.manual_seed(args.seed + index)
+
+    data = {"padding_id": SHARED["padding_id"], "annotations": SHARED["annotations"],
+            "embeddings": np.load(os.path.join(args.work_dir, "embeddings.npy"), mmap_mode="r"),
+            "ids_corpus": read_shared_corpus(args.work_dir, "ubuntu")}
+    training_batches = corpus.create_batches(data["ids_corpus"], data["annotations"], args.batch_size, data["padding_id"])
+    eval_batches = corpus.create_eval_batches(data["ids_corpus"], SHARED["dev"], data["padding_id"])
+
+    model = encoder.create_model(args)
+    optimizer = Adam(model.parameters())
+    discriminator = discriminator_optimizer = None
+    if args.lam > 0:
+        assert args.android_path, "lam > 0 needs --android_path"
+        data["android_corpus"] = read_shared_corpus(args.work_dir, "android")
+        data["android_annotations"] = SHARED["android_annotations"]
+        discriminator = FeedForward(args)
+        if args.cuda:
+            discriminator.cuda()
+        discriminator_optimizer = Adam(discriminator.parameters())
+
+    best = None
+    for epoch in range(args.epochs):
+        for batch in training_batches:
+            train_step(args, model, optimizer, batch, data, discriminator, discriminator_optimizer)
+        metrics = evaluate(args, model, eval_batches, None, data["embeddings"], data["padding_id"])
+        print("trial " + str(index) + " epoch " + str(epoch) + " MAP: " + str(metrics[0]))
+        if best is None or metrics[0] > best[1]:
+            best = [epoch] + metrics
+
+    return [index] + [getattr(args, name) for name in sorted(PARAMS)] + best + [
+        time.time() - time_begin, start_mb, peak_rss_mb() - start_mb]
+
+def main(args):
+    configs = trial_configs(args)
+    print("running " + str(len(configs)) + " trials")
+    preprocess(args)
+
+    # one fresh process per trial, so that the peak memory of one trial does
+    # not carry over to the next
+    pool = multiprocessing.Pool(args.processes or multiprocessing.cpu_count(), maxtasksperchild=1)
+    rows = pool.map(run_trial, list(enumerate(configs)), chunksize=1)
+    pool.close()
+    pool.join()
+
+    header = ['Trial'] + sorted(PARAMS) + ['Epoch', 'MAP', 'MRR', 'P@1', 'P@5', 'seconds', 'start MB', 'added peak MB']
+    with open(args.results_file, 'w') as results_file:
+        writer = csv.writer(results_file, dialect='excel')
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+
+    print("\t".join(header))
+    for row in sorted(rows, key=lambda row: -row[len(PARAMS) + 2]):
+        print("\t".join(["%.4f" % x if isinstance(x, float) else str(x) for x in row]))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--corpus",
+            type = str
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--train",
+            type = str
+        )
+    argparser.add_argument("--dev",
+            type = str
+        )
+    argparser.add_argument("--android_path",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--results_file",
+            type = str
+        )
+    argparser.add_argument("--grid",
+            type = str,
+            default = "model=lstm,cnn"
+        )
+    argparser.add_argument("--trials",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--epochs",
+            type = int,
+            default = 10
+        )
+    argparser.add_argument("--model",
+            type = str,
+            default = "lstm"
+        )
+    argparser.add_argument("--hidden_size",
+            type = int,
+            default = 100
+        )
+    argparser.add_argument("--margin",
+            type = float,
+            default = 0.3
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 25
+        )
+    argparser.add_argument("--lam",
+            type = float,
+            default = 0.0
+        )
+    argparser.add_argument("--work_dir",
+            type = str,
+            default = "sweep_data"
+        )
+    argparser.add_argument("--processes",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--threads",
+            type = int,
+            default = 1
+        )
+    argparser.add_argument("--seed",
+            type = int,
+            default = 1
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,157 @@
+"""
+Incrementally updates a vector store built by build_index.py, and the search
+indexes saved next to it (ann.py, quantize.py), without re-encoding the whole
+corpus.
+
+Only questions of --corpus that are new, or whose text changed since they
+were encoded, go through the encoder; they are appended as a new segment.
+Ids listed in --deleted (one per line) are tombstoned, as are, with --full 1,
+the ids of the store missing from --corpus. When more than --compact_ratio of
+the rows are dead (or with --compact 1) the store is compacted.
+
+The model, checkpoint and embeddings default to the ones recorded in the
+store's meta.json. A checkpoint other than the recorded one (or the recorded
+one, changed since) is refused unless --full 1 --corpus re-encodes every
+question with it; meta.json then records the new checkpoint.
+
+Usage:
+python2 update_index.py --index <index directory> [--corpus <corpus path>] [--deleted <ids path>] [--full <0 | 1>] [--compact <0 | 1>] [--compact_ratio <0.2>] [--load_model <model path>] [--embeddings <gzipped embeddings path>]
+
+Example Usage:
+python2 update_index.py --index indexes/askubuntu_lstm3 --corpus ../askubuntu/new_questions.txt.gz --deleted ../askubuntu/deleted_ids.txt
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+
+import torch
+
+import corpus
+import encoder
+import build_index
+from cache import model_version
+from vector_store import VectorStore
+
+def search_indexes(store):
+    """The ann.py / quantize.py indexes saved in the store's directory.
+    """
+    import ann
+    import quantize
+    indexes = []
+    for index_type in (ann.IVFIndex, ann.HNSWIndex, quantize.PQStore, quantize.Int8Store):
+        if os.path.exists(os.path.join(store.path, index_type.FILE)):
+            indexes.append(index_type.load(store))
+    return indexes
+
+def read_ids(path):
+    with open(path) as fin:
+        return [line.strip() for line in fin if line.strip()]
+
+def main(args):
+    store = VectorStore(args.index)
+    for name in ("model", "embedding_size", "hidden_size", "embeddings"):
+        if getattr(args, name) is None:
+            setattr(args, name, store.meta[name])
+    args.load_model = args.load_model or store.meta["checkpoint"]
+    try:
+        build_index.check_checkpoint(store.meta, args.load_model)
+        reencode = False
+    except ValueError as e:
+        if not (args.full and args.corpus):
+            sys.exit(str(e) + "; re-encode the whole corpus with it (--full 1 --corpus) or build a new index")
+        reencode = True
+    print("loaded index of " + str(store.num_live()) + " questions")
+
+    if args.corpus:
+        torch.set_num_threads(args.num_threads or multiprocessing.cpu_count())
+        model = encoder.load_model(args)
+        list_words, vocab_map, embeddings, padding_id = corpus.load_embeddings(corpus.load_embedding_iterator(args.embeddings))
+        print("loaded embeddings")
+        rows_before = len(store)
+        seen = set()
+        build_index.build_index(args, store, model, vocab_map, embeddings, padding_id, changed_only=True, seen=seen,
+                                reencode=reencode)
+        print("encoded " + str(len(store) - rows_before) + (" questions" if reencode else " new or edited questions"))
+    deleted = read_ids(args.deleted) if args.deleted else []
+    if args.full and args.corpus:
+        deleted.extend(id for id in store.id2row.keys() if id not in seen)
+    live_before = store.num_live()
+    store.delete(deleted)
+    print("deleted " + str(live_before - store.num_live()) + " questions")
+    if reencode:
+        # every live question is encoded with the new checkpoint now
+        store.set_meta(dict(store.meta, checkpoint=args.load_model, model_version=model_version(args.load_model)))
+        print("re-encoded the index with " + args.load_model)
+
+    dead = len(store) - store.num_live()
+    if args.compact or (len(store) and dead > args.compact_ratio * len(store)):
+        print("compacting " + str(dead) + " dead rows")
+        store.compact()
+
+    for index in search_indexes(store):
+        index.refresh()
+        index.save()
+        print("refreshed " + index.FILE)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--index",
+            type = str
+        )
+    argparser.add_argument("--corpus",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--deleted",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--full",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--compact",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--compact_ratio",
+            type = float,
+            default = 0.2
+        )
+    argparser.add_argument("--embeddings",
+            type = str
+        )
+    argparser.add_argument("--load_model",
+            type = str,
+            default = ""
+        )
+    argparser.add_argument("--model",
+            type = str
+        )
+    argparser.add_argument("--hidden_size",
+            type = int
+        )
+    argparser.add_argument("--embedding_size",
+            type = int
+        )
+    argparser.add_argument("--batch_size",
+            type = int,
+            default = 512
+        )
+    argparser.add_argument("--chunk_size",
+            type = int,
+            default = 50000
+        )
+    argparser.add_argument("--num_threads",
+            type = int,
+            default = 0
+        )
+    argparser.add_argument("--cuda",
+            type = int,
+            default = 0
+        )
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,324 @@
+"""On-disk store of encoded question vectors.
+
+A store is a directory made of segments. Each segment is a float32 matrix of
+L2-normalized question vectors (segment_<n>.npy, opened memory-mapped) and the
+question ids of its rows, one per line (segment_<n>.ids). The ids file is
+written last and renamed into place, so a segment without one is an interrupted
+(or ongoing) write: readers skip it and the next write removes it. meta.json
+records how the vectors were made.
+
+Segments are never modified, only appended and tombstoned:
+- segment_<n>.hashes (optional) holds a hash of each question's text, so
+  that edited questions can be detected and re-encoded
+- segment_<n>.deleted lists the rows of the segment that were deleted
+- when an id appears in several segments, only its last row is live, so an
+  edited question is simply appended again
+compact() rewrites the live rows into a single segment to reclaim the space.
+"""
+
+import os
+import json
+import bisect
+import hashlib
+
+import numpy as np
+
+META_FILE = "meta.json"
+
+def normalize(vectors, eps=1e-10):
+    """L2-normalize the rows of a matrix, as float32.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.sqrt((vectors * vectors).sum(axis=-1, keepdims=True))
+    return vectors / (norms + eps)
+
+def question_hash(title, body):
+    """Hash of a tokenized question (as returned by corpus.iter_corpus), used to
+    detect edited questions.
+    """
+    text = " ".join(title) + "\t" + " ".join(body)
+    return hashlib.sha1(text.encode("utf-8") if not isinstance(text, bytes) else text).hexdigest()
+
+def meta_differences(stored, meta):
+    """The keys whose values differ between two store metas, as "key: stored != new".
+    """
+    return [str(key) + ": " + str(stored.get(key)) + " != " + str(meta.get(key))
+            for key in sorted(set(stored) | set(meta)) if stored.get(key) != meta.get(key)]
+
+class VectorStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as fin:
+            self.meta = json.load(fin)
+        self.dim = self.meta["dim"]
+        self.load()
+
+    @staticmethod
+    def create(path, meta):
+        """Create an empty store at path (or open it if it already exists, so
+        that an interrupted build can be resumed). meta must contain "dim".
+        Raises ValueError if the existing store was made with another meta.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        meta_path = os.path.join(path, META_FILE)
+        if not os.path.exists(meta_path):
+            with open(meta_path, "w") as fout:
+                json.dump(meta, fout, indent=2, sort_keys=True)
+        else:
+            with open(meta_path) as fin:
+                stored = json.load(fin)
+            # compare through json, as the stored meta went through it
+            differing = meta_differences(stored, json.loads(json.dumps(meta)))
+            if differing:
+                raise ValueError("the store at " + path + " was made with other settings ("
+                                 + ", ".join(differing) + "); use another path or remove it")
+        store = VectorStore(path)
+        store.remove_incomplete()
+        return store
+
+    def set_meta(self, meta):
+        """Replace meta.json (it must keep the same "dim").
+        """
+        assert meta["dim"] == self.dim, "the dimension of a store cannot change"
+        meta_path = os.path.join(self.path, META_FILE)
+        with open(meta_path + ".tmp", "w") as fout:
+            json.dump(meta, fout, indent=2, sort_keys=True)
+        os.rename(meta_path + ".tmp", meta_path)
+        self.meta = meta
+
+    def file(self, name, extension):
+        return os.path.join(self.path, name + extension)
+
+    def segment_names(self, complete=True):
+        names = set()
+        for name in os.listdir(self.path):
+            if name.startswith("segment_"):
+                names.add(name.split(".")[0])
+        if not complete:
+            return sorted(names)
+        return sorted(name for name in names if os.path.exists(self.file(name, ".ids")))
+
+    def remove_incomplete(self):
+        """Remove what is left of interrupted writes or compactions. Only writers
+        call this; readers skip incomplete segments, which may still be being
+        written.
+        """
+        for name in self.segment_names(complete=False):
+            if not os.path.exists(self.file(name, ".ids")):
+                for extension in (".npy", ".hashes", ".deleted", ".ids.tmp"):
+                    if os.path.exists(self.file(name, extension)):
+                        os.remove(self.file(name, extension))
+
+    def remove(self):
+        """Delete the segments and meta.json of the store; other files in its
+        directory are left alone.
+        """
+        for name in self.segment_names(complete=False):
+            # the ids file goes first: without it the rest is ignored
+            for extension in (".ids", ".npy", ".hashes", ".deleted", ".ids.tmp"):
+                if os.path.exists(self.file(name, extension)):
+                    os.remove(self.file(name, extension))
+        os.remove(os.path.join(self.path, META_FILE))
+        self.segments = []
+        self.load()
+
+    def read_lines(self, name, extension):
+        if not os.path.exists(self.file(name, extension)):
+            return None
+        with open(self.file(name, extension)) as fin:
+            return [line.rstrip("\n") for line in fin]
+
+    def load(self):
+        """(Re)read the segments from disk.
+        """
+        self.segments = []
+        self.offsets = []
+        self.ids = []
+        row_hashes = []
+        dead = []
+        for name in self.segment_names():
+            seg_ids = self.read_lines(name, ".ids")
+            vectors = np.load(self.file(name, ".npy"), mmap_mode="r")
+            assert vectors.shape == (len(seg_ids), self.dim), "corrupt segment " + name
+            self.segments.append((name, seg_ids, vectors))
+            self.offsets.append(len(self.ids))
+            for position in self.read_lines(name, ".deleted") or []:
+                dead.append(len(self.ids) + int(position))
+            row_hashes.extend(self.read_lines(name, ".hashes") or [None] * len(seg_ids))
+            self.ids.extend(seg_ids)
+
+        self.live = np.ones(len(self.ids), dtype=bool)
+        self.live[dead] = False
+        self.id2row = {}
+        self.hashes = {}
+        for row, id in enumerate(self.ids):
+            if id in self.id2row:
+                # superseded by a later row
+                self.live[self.id2row[id]] = False
+            self.id2row[id] = row
+        for row, id in enumerate(self.ids):
+            if not self.live[row] and self.id2row.get(id) == row:
+                del self.id2row[id]
+        for id, row in self.id2row.items():
+            if row_hashes[row] is not None:
+                self.hashes[id] = row_hashes[row]
+
+    def __len__(self):
+        """Number of rows, including deleted ones that compact() has not
+        reclaimed yet.
+        """
+        return len(self.ids)
+
+    def num_live(self):
+        return len(self.id2row)
+
+    def __contains__(self, id):
+        return id in self.id2row
+
+    def next_segment_name(self):
+        if not self.segments:
+            return "segment_%06d" % 0
+        return "segment_%06d" % (int(self.segments[-1][0][len("segment_"):]) + 1)
+
+    def write_segment(self, name, ids, vectors, hashes=None):
+        if vectors is not None:
+            np.save(self.file(name, ".npy"), vectors)
+        if hashes is not None:
+            with open(self.file(name, ".hashes"), "w") as fout:
+                for h in hashes:
+                    fout.write(h + "\n")
+        with open(self.file(name, ".ids.tmp"), "w") as fout:
+            for id in ids:
+                fout.write(id + "\n")
+        os.rename(self.file(name, ".ids.tmp"), self.file(name, ".ids"))
+
+    def append(self, ids, vectors, hashes=None):
+        """Write one new segment with the given question ids and vectors (which
+        are L2-normalized here), and optionally the hashes of their text. Ids
+        already in the store are replaced.
+        """
+        assert len(ids) == len(vectors), "number of ids and vectors does not match"
+        if len(ids) == 0:
+            return
+        self.remove_incomplete()
+        name = self.next_segment_name()
+        self.write_segment(name, ids, normalize(vectors), hashes)
+        self.segments.append((name, list(ids), np.load(self.file(name, ".npy"), mmap_mode="r")))
+        self.offsets.append(len(self.ids))
+        self.live = np.concatenate([self.live, np.ones(len(ids), dtype=bool)])
+        for i, id in enumerate(ids):
+            if id in self.id2row:
+                self.live[self.id2row[id]] = False
+            self.id2row[id] = len(self.ids)
+            self.ids.append(id)
+            if hashes is not None:
+                self.hashes[id] = hashes[i]
+            else:
+                self.hashes.pop(id, None)
+
+    def delete(self, ids):
+        """Tombstone the given question ids (unknown ids are ignored).
+        """
+        deleted = {}
+        for id in ids:
+            row = self.id2row.pop(id, None)
+            if row is None:
+                continue
+            self.hashes.pop(id, None)
+            self.live[row] = False
+            segment = bisect.bisect_right(self.offsets, row) - 1
+            deleted.setdefault(segment, []).append(row - self.offsets[segment])
+        for segment, positions in deleted.items():
+            with open(self.file(self.segments[segment][0], ".deleted"), "a") as fout:
+                for position in positions:
+                    fout.write(str(position) + "\n")
+
+    def compact(self, block_size=65536):
+        """Rewrite the live rows into one new segment and remove the old
+        segments, reclaiming the space of deleted and superseded rows. The new
+        segment is complete on disk before any old one is removed.
+        """
+        if not self.segments:
+            return
+        self.remove_incomplete()
+        old_names = [name for name, _, _ in self.segments]
+        name = self.next_segment_name()
+        live_rows = np.nonzero(self.live)[0]
+        if len(live_rows):
+            vectors = np.lib.format.open_memmap(self.file(name, ".npy"), mode="w+",
+                                                dtype=np.float32, shape=(len(live_rows), self.dim))
+            position = 0
+            for offset, block in self.blocks(block_size):
+                keep = self.live[offset:offset + len(block)]
+                vectors[position:position + keep.sum()] = block[keep]
+                position += keep.sum()
+            vectors.flush()
+            del vectors
+        else:
+            np.save(self.file(name, ".npy"), np.zeros((0, self.dim), dtype=np.float32))
+        ids = [self.ids[row] for row in live_rows]
+        hashes = None
+        if all(id in self.hashes for id in ids):
+            hashes = [self.hashes[id] for id in ids]
+        self.write_segment(name, ids, None, hashes)
+
+        self.segments = []
+        for old_name in old_names:
+            # the ids file goes first: without it the rest is ignored
+            for extension in (".ids", ".npy", ".hashes", ".deleted"):
+                if os.path.exists(self.file(old_name, extension)):
+                    os.remove(self.file(old_name, extension))
+        self.load()
+
+    def segment_list(self):
+        return [name for name, _, _ in self.segments]
+
+    def rows_since(self, names):
+        """For an index built when the store had segments names: the first row
+        it does not cover, or None if compaction has renumbered the rows and
+        the index must be rebuilt.
+        """
+        if self.segment_list()[:len(names)] != list(names):
+            return None
+        return sum(len(seg_ids) for _, seg_ids, _ in self.segments[:len(names)])
+
+    def blocks(self, block_size=65536):
+        """Yields (first row, matrix) blocks covering every row of the store, in
+        order, at most block_size rows each. Rows that are not live (see
+        self.live) are included.
+        """
+        offset = 0
+        for _, seg_ids, vectors in self.segments:
+            for start in range(0, len(seg_ids), block_size):
+                yield offset + start, vectors[start:start + block_size]
+            offset += len(seg_ids)
+
+    def get(self, ids):
+        """Returns the (len(ids) x dim) matrix of vectors for the given question ids.
+        """
+        return self.rows([self.id2row[id] for id in ids])
+
+    def rows(self, rows):
+        """Returns the (len(rows) x dim) matrix of vectors at the given store rows.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        result = np.zeros((len(rows), self.dim), dtype=np.float32)
+        segments = np.searchsorted(self.offsets, rows, side="right") - 1
+        for segment in np.unique(segments):
+            mask = segments == segment
+            result[mask] = self.segments[segment][2][rows[mask] - self.offsets[segment]]
+        return result
+
+    def row(self, row):
+        segment = bisect.bisect_right(self.offsets, row) - 1
+        return self.segments[segment][2][row - self.offsets[segment]]
+
+    def to_array(self):
+        """Returns all vectors (including rows that are not live) as one
+        in-memory matrix.
+        """
+        if not self.segments:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.vstack([np.asarray(vectors) for _, _, vectors in self.segments])